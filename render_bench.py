@@ -0,0 +1,53 @@
+# 绘图基准测试，在项目根目录下执行:
+#   python render_bench.py [用例名 ...] [--repeat N] [--fixtures PATH] [--output PATH]
+#   pytest render_bench.py
+# 合成画布用例分别走 render_canvas 的 direct/banded/tiled 路径
+# 真实绘图函数的测试数据默认读取 data/sekai/render_bench/fixtures.json，格式见 load_render_bench_fixtures
+import argparse
+import asyncio
+import nonebot
+from nonebot.adapters.onebot.v11 import Adapter
+
+nonebot.init()
+nonebot.get_driver().register_adapter(Adapter)
+nonebot.load_from_toml("pyproject.toml")
+
+from src.plugins.utils import load_json
+from src.plugins.sekai.modules.render_bench import (
+    RENDER_BENCH_CASES,
+    run_render_bench,
+    save_render_bench_result,
+    format_render_bench_result,
+)
+
+
+async def bench(case_names=None, repeat=3, fixture_path=None, output=None):
+    result = await run_render_bench(case_names, repeat, fixture_path)
+    path = await save_render_bench_result(result, output)
+    return result, path
+
+def main():
+    parser = argparse.ArgumentParser(description="绘图基准测试")
+    parser.add_argument("cases", nargs="*", help="用例名，默认运行所有用例")
+    parser.add_argument("--repeat", type=int, default=3, help="每个用例的重复次数")
+    parser.add_argument("--fixtures", default=None, help="真实绘图函数的测试数据路径")
+    parser.add_argument("--output", default=None, help="结果json的保存路径")
+    args = parser.parse_args()
+    result, path = asyncio.run(bench(args.cases or None, args.repeat, args.fixtures, args.output))
+    print(format_render_bench_result(result))
+    print(f"结果已保存到 {path}")
+
+# pytest入口，每个合成画布用例的所有绘制路径都能得到非空的结果
+def test_render_bench(tmp_path):
+    output = str(tmp_path / "bench.json")
+    _, path = asyncio.run(bench(list(RENDER_BENCH_CASES.keys()), 1, None, output))
+    result = load_json(path)
+    for name in RENDER_BENCH_CASES:
+        case = result['cases'][name]
+        assert case['size'][0] > 0 and case['size'][1] > 0
+        for path_result in case['paths'].values():
+            assert path_result['encoded_bytes'] > 0
+
+
+if __name__ == '__main__':
+    main()
@@ -168,13 +168,15 @@ async def _(ctx: HandlerContext):
         smsg.insert(0, {'type': 'text', 'data': {'text': f'【广播组{name}的消息】\n'}})
     else:
         smsg = f"【广播组{name}的消息】\n{smsg.strip()}"
-    for guid in bc[name]:
-        try:
-            await send_msg_to(ctx, guid, smsg)
-            sended_list.append(guid)
-        except Exception as e:
-            logger.error(f"发送广播 {name} 失败: {e}")
-            failed_list.append((guid, str(e)))
+    # 广播消息以通知优先级排队，不抢占其他指令的回复
+    with send_priority(SEND_PRIORITY_NOTIFY):
+        for guid in bc[name]:
+            try:
+                await send_msg_to(ctx, guid, smsg)
+                sended_list.append(guid)
+            except Exception as e:
+                logger.error(f"发送广播 {name} 失败: {e}")
+                failed_list.append((guid, str(e)))
 
     if reply_msg:
         msg = f"在广播组{name}中广播回复的消息\n"
@@ -122,7 +122,7 @@ async def _(ctx: HandlerContext):
 
             if args.gif:
                 with TempFilePath("gif") as gif_path:
-                    await run_in_pool(convert_video_to_gif, tmp_save_path, gif_path)
+                    await run_in_pool(convert_video_to_gif, tmp_save_path, gif_path, kind='cpu')
                     await ctx.asend_msg(await get_image_cq(gif_path))
     
             else:
@@ -1490,5 +1490,5 @@ async def _(ctx: HandlerContext):
     assert_and_reply(filesize <= 1024 * 1024 * 10, "视频文件过大，无法处理")
     async with TempNapcatFilePath('video', video['file']) as video_path:
         with TempFilePath("gif") as gif_path:
-            await run_in_pool(convert_video_to_gif, video_path, gif_path, args.max_fps, args.max_size, args.max_frame_num)
+            await run_in_pool(convert_video_to_gif, video_path, gif_path, args.max_fps, args.max_size, args.max_frame_num, kind='cpu')
             return await ctx.asend_reply_msg(await get_image_cq(gif_path))
\ No newline at end of file
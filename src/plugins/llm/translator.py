@@ -71,7 +71,7 @@ class Translator:
         x2, y2 = p2
         draw.rectangle([x1, y1, x2, y2], outline=color)
         label_size = 16
-        font = ImageFont.truetype(self.font_path, label_size)
+        font = get_font(self.font_path, label_size)
         draw.rectangle([x2 - label_size - 2, y2 - label_size - 2, x2, y2], fill=(255, 255, 255, 150))
         draw.text((x2 - label_size, y2 - label_size), str(label), fill=color, font=font)
 
@@ -86,7 +86,7 @@ class Translator:
         font_size_start, font_size_end, font_size_step = 32, 6, 3
         font_size = font_size_start
         border = 2
-        font = ImageFont.truetype(self.font_path, font_size)
+        font = get_font(self.font_path, font_size)
         while font_size > font_size_end:
             font = font.font_variant(size=font_size)
             cur_text = ""
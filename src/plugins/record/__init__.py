@@ -56,11 +56,10 @@ async def record_message(bot: Bot, event: GroupMessageEvent):
         except: logger.print_exc(f"记录消息前hook {hook.__name__} 执行失败")
 
     time = datetime.fromtimestamp(event.time)
-    msg_obj = await get_msg_obj(bot, event.message_id)
+    # 直接使用事件中的原始消息，避免每条消息都调用get_msg
+    msg = get_msg_from_event(event)
 
-    msg = msg_obj['message']
-
-    msg_id = msg_obj['message_id']
+    msg_id = event.message_id
     msg_text = extract_text(msg)
     img_urls = extract_image_url(msg)
     img_ids = extract_image_id(msg)
@@ -186,11 +185,11 @@ async def _(ctx: HandlerContext):
 # 私聊转发hook
 @before_record_hook
 async def private_forward_hook(bot: Bot, event: MessageEvent):
-    user_id = event.sender.user_id
-    nickname = event.sender.nickname
-    msg = await get_msg(bot, event.message_id)
     if is_group_msg(event):
         return
+    user_id = event.sender.user_id
+    nickname = event.sender.nickname
+    msg = get_msg_from_event(event)
 
     for forward_user_id in file_db.get('private_forward_list', []):
         if user_id == forward_user_id:
@@ -243,3 +242,43 @@ async def _(ctx: HandlerContext):
         msg += f"{context.trigger_cmd} {context.arg_text}"
         msg += "\n\n"
     return await ctx.asend_fold_msg_adaptive(msg.strip(), 100, True)
+
+
+# 查看消息写入统计
+record_stats = CmdHandler(["/record_stats"], logger)
+record_stats.check_superuser()
+@record_stats.handle()
+async def _(ctx: HandlerContext):
+    st = write_stats
+    pending_count, pending_lag = get_pending_info()
+    msg = f"待写入 {pending_count} 条 最早等待 {pending_lag:.2f}s\n"
+    msg += f"已写入 {st.rows} 条 共 {st.batches} 批 失败 {st.failed} 次\n"
+    if st.batches:
+        msg += f"平均批大小 {st.rows / st.batches:.1f} 最大批大小 {st.max_batch}\n"
+        msg += f"平均写入耗时 {st.total_flush_time / st.batches * 1000:.1f}ms\n"
+    msg += f"写入延迟 最近 {st.last_lag:.2f}s 最大 {st.max_lag:.2f}s"
+    if st.consecutive_failures:
+        msg += f"\n连续失败 {st.consecutive_failures}/{WRITE_MAX_RETRIES} 次: {st.last_error}"
+    if st.dead_letters or st.dropped:
+        msg += f"\n死信 {st.dead_letters} 条 缓冲区满丢弃 {st.dropped} 条 见 {DEAD_LETTER_PATH}"
+    return await ctx.asend_reply_msg(msg)
+
+
+record_plan = CmdHandler(["/record_plan"], logger)
+record_plan.check_superuser()
+@record_plan.handle()
+async def _(ctx: HandlerContext):
+    args = ctx.get_args().strip()
+    group_id = int(args) if args else ctx.group_id
+    assert_and_reply(group_id, "请在群聊中使用或指定群号")
+    plans = await check_query_plans(group_id)
+    assert_and_reply(plans is not None, f"群 {group_id} 没有消息记录")
+    st = migration_status
+    msg = f"消息表迁移 {st.migrated_tables}/{st.total_tables} {'进行中' if st.running else f'耗时 {st.total_time:.1f}s'}\n"
+    if st.backfill:
+        msg += f"回填进度: {st.backfill}\n"
+    if st.error:
+        msg += f"迁移失败: {st.error}\n"
+    for name, (plan, use_index) in plans.items():
+        msg += f"{'✓' if use_index else '✗'} {name}: {plan}\n"
+    return await ctx.asend_reply_msg(msg.strip())
@@ -1,4 +1,5 @@
 from ..utils import *
+from typing import AsyncIterator
 import aiosqlite
 
 config = get_config('record')
@@ -8,21 +9,236 @@ logger = get_logger("Record")
 DB_PATH = "data/record/record.sqlite"
 MSG_TABLE_NAME  = "msg_{}"
 
+WRITE_BATCH_SIZE = config.get('write_batch_size', 256)          # 待写入消息达到该数量时立即写入
+WRITE_FLUSH_INTERVAL = config.get('write_flush_interval', 1.0)  # 待写入消息的最长等待时间（秒）
+WRITE_MAX_RETRIES = config.get('write_max_retries', 5)          # 批量写入连续失败该次数后逐群逐条写入，仍失败的消息写入死信文件
+WRITE_MAX_PENDING = config.get('write_max_pending', 100000)     # 写缓冲区的最大消息数，超出时新消息直接写入死信文件
+DEAD_LETTER_PATH = "data/record/dead_letter.jsonl"
+
+# 连接时设置的pragma，WAL模式下读写不互相阻塞，synchronous=NORMAL只在checkpoint时fsync
+DB_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA busy_timeout=5000",
+]
+
 _conn: aiosqlite.Connection = None         # 连接
 _created_table_group_ids = set()             # 是否创建过表
+_msg_table_versions: Dict[str, int] = {}     # 消息表的迁移版本
+MIGRATION_BACKFILL_CHUNK = 5000              # 迁移回填时每次读取的消息数
+
+# 按 (群, 小时, 用户) 聚合的消息统计，写入消息时增量更新
+# 按UTC整点分桶，本地时区与UTC相差整小时时可以直接合并为本地日期
+ROLLUP_TABLE_NAME = "msg_hourly_rollup"
+ROLLUP_BUCKET = 3600
+
+# 消息的聚合值 (文本长度, 是否含图片)
+def _get_rollup_values(content: str) -> Tuple[int, int]:
+    msg = loads_json(content)
+    return len(extract_text(msg)), int(has_image(msg))
+
+# 将消息表格式的row聚合为 {(小时, 用户ID): [消息数, 文本长度, 图片消息数]}
+def _aggregate_rollup(rows: List[tuple], agg: Dict[Tuple[int, int], List[int]] = None) -> Dict[Tuple[int, int], List[int]]:
+    agg = agg if agg is not None else {}
+    for row in rows:
+        text_len, image = _get_rollup_values(row[5])
+        v = agg.setdefault((int(row[1]) // ROLLUP_BUCKET * ROLLUP_BUCKET, row[3]), [0, 0, 0])
+        v[0] += 1
+        v[1] += text_len
+        v[2] += image
+    return agg
+
+async def _upsert_rollup(conn: aiosqlite.Connection, group_id: int, agg: Dict[Tuple[int, int], List[int]]):
+    await conn.executemany(f'''
+        INSERT INTO {ROLLUP_TABLE_NAME} (group_id, hour, user_id, count, text_len, image_count)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (group_id, hour, user_id) DO UPDATE SET
+            count = count + excluded.count,
+            text_len = text_len + excluded.text_len,
+            image_count = image_count + excluded.image_count
+    ''', [(group_id, hour, user_id, *v) for (hour, user_id), v in agg.items()])
+
+# 回填开始前清空该群的聚合数据，之后截止ID以内的消息由回填计入，之后的消息由写入计入，不会重复计数
+async def _prepare_rollup_backfill(conn: aiosqlite.Connection, table: str, group_id: int):
+    await conn.execute(f"DELETE FROM {ROLLUP_TABLE_NAME} WHERE group_id = ?", (group_id,))
+
+# 消息纯文本表及其全文索引，写入消息时同步写入，全文索引由触发器维护
+# trigram分词只能匹配长度不小于3的关键词，更短的关键词在时间范围内直接扫描纯文本
+MSG_TEXT_TABLE_NAME = "msg_text_{}"
+MSG_FTS_TABLE_NAME  = "msg_fts_{}"
+FTS_MIN_TERM_LEN = 3
+
+# 将消息表格式的row转换为纯文本表的row (ID, 时间戳, 用户ID, 文本)，跳过没有文本的消息
+def _get_text_rows(rows: List[tuple]) -> List[Tuple[int, float, int, str]]:
+    ret = []
+    for row in rows:
+        text = extract_text(loads_json(row[5]))
+        if text:
+            ret.append((row[0], row[1], row[3], text))
+    return ret
+
+async def _insert_text_rows(conn: aiosqlite.Connection, group_id: int, text_rows: List[tuple]):
+    await conn.executemany(f'''
+        INSERT INTO {MSG_TEXT_TABLE_NAME.format(group_id)} (id, time, user_id, text) VALUES (?, ?, ?, ?)
+    ''', text_rows)
+
+# 回填开始前重建纯文本表和全文索引，丢弃之前的残留数据，之后由分块回填和写入填充
+async def _prepare_text_backfill(conn: aiosqlite.Connection, table: str, group_id: int):
+    text_table, fts_table = MSG_TEXT_TABLE_NAME.format(group_id), MSG_FTS_TABLE_NAME.format(group_id)
+    await conn.execute(f"DROP TABLE IF EXISTS {fts_table}")
+    await conn.execute(f"DROP TABLE IF EXISTS {text_table}")
+    await conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {text_table} (
+            id INTEGER PRIMARY KEY,
+            time INTEGER,
+            user_id INTEGER,
+            text TEXT
+        )
+    ''')
+    await conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{text_table}_time ON {text_table} (time)")
+    await conn.execute(f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} USING fts5(
+            text, content='{text_table}', content_rowid='id', tokenize='trigram case_sensitive 1'
+        )
+    ''')
+    await conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {text_table}_ai AFTER INSERT ON {text_table} BEGIN
+            INSERT INTO {fts_table} (rowid, text) VALUES (new.id, new.text);
+        END
+    ''')
+
+# 由消息表中已有消息回填派生数据的迁移步骤
+# 开始时执行prepare并记录当前最大ID作为截止ID，之后按ID分块回填到截止ID，进度持久化，重启后从中断处继续
+# 回填开始后写入的消息ID都大于截止ID，由写入时维护，块之间释放写锁，解码在线程池中进行
+@dataclass
+class MsgTableBackfill:
+    kind: str
+    prepare: Callable       # async prepare(conn, table, group_id)
+    compute: Callable       # compute(rows) -> result，在线程池中执行
+    write: Callable         # async write(conn, group_id, result)
+
+# 消息表的迁移 (版本号, 名称, sql模板/异步函数 func(conn, table, group_id)/MsgTableBackfill)，按版本号顺序对每个消息表执行
+# 已有的消息表由后台任务逐表迁移，新建的消息表创建时直接迁移到最新版本
+MSG_TABLE_MIGRATIONS = [
+    (1, "time_index",      "CREATE INDEX IF NOT EXISTS idx_{table}_time ON {table} (time)"),
+    (2, "user_time_index", "CREATE INDEX IF NOT EXISTS idx_{table}_user_time ON {table} (user_id, time)"),
+    (3, "hourly_rollup",   MsgTableBackfill("rollup", _prepare_rollup_backfill, _aggregate_rollup, _upsert_rollup)),
+    (4, "text_index",      MsgTableBackfill("text", _prepare_text_backfill, _get_text_rows, _insert_text_rows)),
+]
+ROLLUP_VERSION = 3                           # 达到该版本的消息表可以从聚合数据查询
+TEXT_INDEX_VERSION = 4                       # 达到该版本的消息表可以从全文索引查询
+SCHEMA_VERSION_TABLE = "record_schema_versions"
+BACKFILL_STATE_TABLE = "record_backfill_states"
+
+_backfill_states: Dict[Tuple[str, str], Tuple[int, int]] = {}    # (表名, 回填类型) -> (截止ID, 已回填到的ID)
+_migration_task: asyncio.Task = None
+_migration_rerun = False                     # 迁移进行中出现了新的消息表，完成后需要再检查一次
 
-# 获得连接 
-async def get_conn(group_id):
+@dataclass
+class MigrationStatus:
+    total_tables: int = 0
+    migrated_tables: int = 0
+    running: bool = False
+    total_time: float = 0.
+    error: str = None
+    backfill: str = None                     # 正在进行的回填进度
+
+migration_status = MigrationStatus()
+
+# 写缓冲区 group_id -> 与数据库中格式相同的行 (id=None, 时间戳, 消息ID, 用户ID, 昵称, json内容)
+_pending: Dict[int, List[tuple]] = {}
+_pending_count = 0
+_pending_since: float = None                 # 缓冲区中最早的消息进入的时间
+_flush_event: asyncio.Event = None
+_flush_task: asyncio.Task = None
+# 写入事务和读取都持有该锁，保证读取时缓冲区中的消息要么已提交要么仍在缓冲区中
+_write_lock = asyncio.Lock()
+
+# 批量写入的统计
+@dataclass
+class RecordWriteStats:
+    batches: int = 0
+    rows: int = 0
+    max_batch: int = 0
+    failed: int = 0
+    total_flush_time: float = 0.
+    last_lag: float = 0.
+    max_lag: float = 0.
+    consecutive_failures: int = 0
+    last_error: str = None
+    dead_letters: int = 0                    # 写入失败后放入死信文件的消息数
+    dropped: int = 0                         # 缓冲区已满时放入死信文件的消息数
+
+write_stats = RecordWriteStats()
+
+# 获得连接，指定group_id时确保该群的消息表存在
+async def get_conn(group_id: int = None):
     global _conn, _created_table_group_ids
     if _conn is None:
         create_parent_folder(DB_PATH)
         _conn = await aiosqlite.connect(DB_PATH)
+        for pragma in DB_PRAGMAS:
+            await _conn.execute(pragma)
+        await _conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {SCHEMA_VERSION_TABLE} (
+                table_name TEXT PRIMARY KEY,
+                version INTEGER,
+                updated_at INTEGER
+            )
+        """)
+        await _conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {ROLLUP_TABLE_NAME} (
+                group_id INTEGER,
+                hour INTEGER,
+                user_id INTEGER,
+                count INTEGER,
+                text_len INTEGER,
+                image_count INTEGER,
+                PRIMARY KEY (group_id, hour, user_id)
+            ) WITHOUT ROWID
+        """)
+        await _conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {BACKFILL_STATE_TABLE} (
+                table_name TEXT,
+                kind TEXT,
+                end_id INTEGER,
+                done_id INTEGER,
+                PRIMARY KEY (table_name, kind)
+            )
+        """)
+        await _conn.commit()
+        cursor = await _conn.execute(f"SELECT table_name, version FROM {SCHEMA_VERSION_TABLE}")
+        _msg_table_versions.update(await cursor.fetchall())
+        await cursor.close()
+        cursor = await _conn.execute(f"SELECT table_name, kind, end_id, done_id FROM {BACKFILL_STATE_TABLE}")
+        _backfill_states.update({(table, kind): (end_id, done_id) for table, kind, end_id, done_id in await cursor.fetchall()})
+        await cursor.close()
         logger.info(f"连接sqlite数据库 {DB_PATH} 成功")
+        start_msg_table_migrations()
+
+    if group_id is not None and group_id not in _created_table_group_ids:
+        async with _write_lock:
+            await _ensure_msg_table(group_id)
+            await _conn.commit()
+    return _conn
 
-    # 创建消息表 (ID, 时间戳, 消息ID, 用户ID, 昵称, json内容)
-    if group_id not in _created_table_group_ids:
+async def _msg_table_exists(table: str) -> bool:
+    cursor = await _conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    exists = await cursor.fetchone() is not None
+    await cursor.close()
+    return exists
+
+# 创建消息表 (ID, 时间戳, 消息ID, 用户ID, 昵称, json内容)，不提交，调用方需持有写锁
+# 只创建基础表，索引、聚合数据和全文索引由后台迁移建立，失败时记录在 migration_status 中而不影响写入
+async def _ensure_msg_table(group_id: int):
+    if group_id in _created_table_group_ids:
+        return
+    table = MSG_TABLE_NAME.format(group_id)
+    if not await _msg_table_exists(table):
         await _conn.execute(f"""
-            CREATE TABLE IF NOT EXISTS {MSG_TABLE_NAME.format(group_id)} (
+            CREATE TABLE IF NOT EXISTS {table} (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 time INTEGER,
                 msg_id INTEGER,
@@ -31,23 +247,335 @@ async def get_conn(group_id):
                 content TEXT
             )
         """)
+        # 迁移需要等待写锁，会在创建表的事务提交后开始
+        start_msg_table_migrations()
+    _created_table_group_ids.add(group_id)
+
+# 获取消息表的迁移版本
+async def _get_msg_table_version(table: str) -> int:
+    cursor = await _conn.execute(f"SELECT version FROM {SCHEMA_VERSION_TABLE} WHERE table_name = ?", (table,))
+    row = await cursor.fetchone()
+    await cursor.close()
+    return row[0] if row else 0
+
+async def _save_backfill_state(table: str, kind: str, state: Tuple[int, int]):
+    await _conn.execute(f"""
+        INSERT OR REPLACE INTO {BACKFILL_STATE_TABLE} (table_name, kind, end_id, done_id) VALUES (?, ?, ?, ?)
+    """, (table, kind, *state))
+
+# 开始回填，返回 (截止ID, 已回填到的ID)，已开始过的回填直接返回保存的进度，调用方需持有写锁并提交
+async def _start_backfill(table: str, group_id: int, step: MsgTableBackfill) -> Tuple[int, int]:
+    state = _backfill_states.get((table, step.kind))
+    if state is not None:
+        return state
+    await step.prepare(_conn, table, group_id)
+    cursor = await _conn.execute(f"SELECT MAX(id) FROM {table}")
+    end_id = (await cursor.fetchone())[0] or 0
+    await cursor.close()
+    state = (end_id, 0)
+    await _save_backfill_state(table, step.kind, state)
+    return state
+
+# 执行一个迁移步骤并单独提交，返回该步骤是否完成，未完成的回填需要在释放写锁后调用 _run_backfill，调用方需持有写锁
+async def _apply_msg_table_step(table: str, group_id: int, version: int, name: str, step) -> bool:
+    done, state = True, None
+    try:
+        if isinstance(step, MsgTableBackfill):
+            state = await _start_backfill(table, group_id, step)
+            done = state[1] >= state[0]
+        elif callable(step):
+            await step(_conn, table, group_id)
+        else:
+            await _conn.execute(step.format(table=table, group_id=group_id))
+        if done:
+            await _conn.execute(f"""
+                INSERT OR REPLACE INTO {SCHEMA_VERSION_TABLE} (table_name, version, updated_at) VALUES (?, ?, ?)
+            """, (table, version, int(time.time())))
         await _conn.commit()
-        _created_table_group_ids.add(group_id)
-    return _conn
+    except:
+        await _conn.rollback()
+        raise
+    if state is not None:
+        _backfill_states[(table, step.kind)] = state
+    if done:
+        _msg_table_versions[table] = version
+        logger.debug(f"消息表 {table} 迁移到版本 {version}({name})")
+    return done
+
+# 按ID分块回填到截止ID，读取和写入分别持有写锁，块之间释放写锁，每块单独提交并保存进度
+async def _run_backfill(table: str, group_id: int, step: MsgTableBackfill):
+    end_id, done_id = _backfill_states[(table, step.kind)]
+    while done_id < end_id:
+        async with _write_lock:
+            cursor = await _conn.execute(f"""
+                SELECT * FROM {table} WHERE id > ? AND id <= ? ORDER BY id LIMIT ?
+            """, (done_id, end_id, MIGRATION_BACKFILL_CHUNK))
+            rows = await cursor.fetchall()
+            await cursor.close()
+        result = await run_in_pool(step.compute, rows) if rows else None
+        next_id = rows[-1][0] if rows else end_id
+        async with _write_lock:
+            try:
+                if rows:
+                    await step.write(_conn, group_id, result)
+                await _save_backfill_state(table, step.kind, (end_id, next_id))
+                await _conn.commit()
+            except:
+                await _conn.rollback()
+                raise
+        _backfill_states[(table, step.kind)] = (end_id, next_id)
+        done_id = next_id
+        migration_status.backfill = f"{table} {step.kind} {done_id}/{end_id}"
+
+def _is_rollup_ready(group_id: int) -> bool:
+    return _msg_table_versions.get(MSG_TABLE_NAME.format(group_id), 0) >= ROLLUP_VERSION
+
+def _is_text_index_ready(group_id: int) -> bool:
+    return _msg_table_versions.get(MSG_TABLE_NAME.format(group_id), 0) >= TEXT_INDEX_VERSION
+
+# 消息表是否已开始维护某种派生数据，开始回填之后写入的消息需要由写入时维护
+def _is_maintained(group_id: int, kind: str, version: int) -> bool:
+    table = MSG_TABLE_NAME.format(group_id)
+    return (table, kind) in _backfill_states or _msg_table_versions.get(table, 0) >= version
+
+# 获取所有已存在的消息表 (表名, 群号)
+async def _get_msg_tables() -> List[Tuple[str, int]]:
+    cursor = await _conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    rows = await cursor.fetchall()
+    await cursor.close()
+    prefix = MSG_TABLE_NAME.format('')
+    return [(name, int(name[len(prefix):])) for name, in rows if name.startswith(prefix) and name[len(prefix):].isdigit()]
+
+# 将已有的消息表从指定版本迁移到最新版本，每个步骤持有写锁执行，回填在块之间释放写锁
+async def _migrate_msg_table(table: str, group_id: int, from_version: int):
+    for version, name, step in MSG_TABLE_MIGRATIONS:
+        if version <= from_version:
+            continue
+        async with _write_lock:
+            done = await _apply_msg_table_step(table, group_id, version, name, step)
+        if not done:
+            await _run_backfill(table, group_id, step)
+            async with _write_lock:
+                await _apply_msg_table_step(table, group_id, version, name, step)
+            migration_status.backfill = None
+
+# 逐表迁移已有的消息表，期间新消息进入写缓冲区，写入只在迁移步骤之间等待写锁
+async def run_msg_table_migrations():
+    global _migration_rerun
+    latest = MSG_TABLE_MIGRATIONS[-1][0]
+    status = migration_status
+    status.running, status.error = True, None
+    start = time.time()
+    try:
+        _migration_rerun = True
+        while _migration_rerun:
+            _migration_rerun = False
+            tables = await _get_msg_tables()
+            status.total_tables, status.migrated_tables = len(tables), 0
+            for table, group_id in tables:
+                async with _write_lock:
+                    version = await _get_msg_table_version(table)
+                if version < latest:
+                    t = time.time()
+                    await _migrate_msg_table(table, group_id, version)
+                    logger.info(f"消息表 {table} 从版本 {version} 迁移到 {latest} 耗时 {time.time() - t:.2f}s")
+                status.migrated_tables += 1
+                await asyncio.sleep(0)
+        # 迁移完成后检查查询是否都使用了索引
+        if tables:
+            for name, (plan, use_index) in (await check_query_plans(tables[0][1])).items():
+                if not use_index:
+                    logger.warning(f"查询 {name} 未使用索引: {plan}")
+    except Exception as e:
+        status.error = get_exc_desc(e)
+        logger.print_exc(f"消息表迁移失败: {status.error}")
+    finally:
+        status.running = False
+        status.total_time = time.time() - start
+
+def start_msg_table_migrations():
+    global _migration_task, _migration_rerun
+    if _migration_task is None or _migration_task.done():
+        _migration_task = asyncio.create_task(run_msg_table_migrations())
+    else:
+        _migration_rerun = True
+
+# 检查查询使用的执行计划，返回 {查询名: (执行计划, 是否避免了全表扫描)}，消息表不存在时返回None
+async def check_query_plans(group_id: int) -> Optional[Dict[str, Tuple[str, bool]]]:
+    conn = await get_conn()
+    table = MSG_TABLE_NAME.format(group_id)
+    if not await _msg_table_exists(table):
+        return None
+    queries = {
+        "query_msg_by_range":   (f"SELECT * FROM {table} WHERE time >= ? AND time <= ?", (0, 1)),
+        "query_msg_count":      (f"SELECT COUNT(*) FROM {table} WHERE time >= ? AND time <= ?", (0, 1)),
+        "query_msg_count_user": (f"SELECT COUNT(*) FROM {table} WHERE time >= ? AND time <= ? AND user_id = ?", (0, 1, 0)),
+        "query_msg_by_user_id": (f"SELECT * FROM {table} WHERE user_id = ?", (0,)),
+        "query_msg_before":     (f"SELECT * FROM {table} WHERE time <= ? ORDER BY time DESC LIMIT ?", (0, 1)),
+        "query_recent_msg":     (f"SELECT * FROM {table} ORDER BY time DESC LIMIT ?", (1,)),
+    }
+    ret = {}
+    for name, (query, params) in queries.items():
+        cursor = await conn.execute(f"EXPLAIN QUERY PLAN {query}", params)
+        details = [row[-1] for row in await cursor.fetchall()]
+        await cursor.close()
+        full_scan = any(d.startswith("SCAN") and "INDEX" not in d for d in details)
+        ret[name] = ("; ".join(details), not full_scan)
+    return ret
+
+# 将无法写入的消息追加到死信文件，之后可以手动导入
+def _append_dead_letters(records: List[Tuple[int, tuple, str]]):
+    create_parent_folder(DEAD_LETTER_PATH)
+    with open(DEAD_LETTER_PATH, 'a', encoding='utf-8') as f:
+        for group_id, row, error in records:
+            f.write(dumps_json({ 'group_id': group_id, 'row': list(row), 'error': error }) + '\n')
 
-# 插入到消息表
+# 将待写入的消息放入缓冲区
+def _add_pending(group_id: int, row: tuple):
+    global _pending_count, _pending_since, _flush_event, _flush_task
+    if _pending_count >= WRITE_MAX_PENDING:
+        # 持续写入失败时避免缓冲区无限增长
+        if write_stats.dropped % 1000 == 0:
+            logger.warning(f"写缓冲区已满({_pending_count}条)，新消息写入死信文件 {DEAD_LETTER_PATH}")
+        write_stats.dropped += 1
+        run_in_pool_nowait(_append_dead_letters, [(group_id, row, "写缓冲区已满")])
+        return
+    _pending.setdefault(group_id, []).append(row)
+    _pending_count += 1
+    if _pending_since is None:
+        _pending_since = time.time()
+    if _flush_task is None or _flush_task.done():
+        _flush_event = asyncio.Event()
+        _flush_task = asyncio.create_task(_flush_loop())
+    if _pending_count >= WRITE_BATCH_SIZE:
+        _flush_event.set()
+
+async def _flush_loop():
+    while True:
+        try:
+            await asyncio.wait_for(_flush_event.wait(), WRITE_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _flush_event.clear()
+        try:
+            await flush_pending_msgs()
+        except Exception as e:
+            logger.print_exc(f"批量写入消息失败: {get_exc_desc(e)}")
+
+# 写入一个群的消息并维护派生数据，不提交，调用方需持有写锁
+async def _insert_rows(group_id: int, rows: List[tuple]):
+    # 新出现的群在首次写入时创建消息表
+    await _ensure_msg_table(group_id)
+    await _conn.executemany(f'''
+        INSERT INTO {MSG_TABLE_NAME.format(group_id)} (time, msg_id, user_id, nickname, content)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [row[1:] for row in rows])
+    if _is_maintained(group_id, "rollup", ROLLUP_VERSION):
+        await _upsert_rollup(_conn, group_id, _aggregate_rollup(rows))
+    if _is_maintained(group_id, "text", TEXT_INDEX_VERSION):
+        # 单连接且持有写锁，同一批插入的ID是连续的
+        cursor = await _conn.execute("SELECT last_insert_rowid()")
+        last_id = (await cursor.fetchone())[0]
+        await cursor.close()
+        first_id = last_id - len(rows) + 1
+        text_rows = _get_text_rows([(first_id + i, *row[1:]) for i, row in enumerate(rows)])
+        await _insert_text_rows(_conn, group_id, text_rows)
+
+# 在单独的事务中写入，失败时回滚并返回错误描述
+async def _try_insert_rows(group_id: int, rows: List[tuple]) -> Optional[str]:
+    try:
+        await _insert_rows(group_id, rows)
+        await _conn.commit()
+        return None
+    except Exception as e:
+        await _conn.rollback()
+        _created_table_group_ids.discard(group_id)
+        return get_exc_desc(e)
+
+# 批量写入连续失败时逐群写入，失败的群再逐条写入，仍然失败的消息写入死信文件，返回写入成功的消息数
+async def _flush_isolated(batch: Dict[int, List[tuple]]) -> int:
+    written, dead = 0, []
+    for group_id, rows in batch.items():
+        if (error := await _try_insert_rows(group_id, rows)) is None:
+            written += len(rows)
+            continue
+        logger.warning(f"群 {group_id} 的 {len(rows)} 条消息写入失败，逐条重试: {error}")
+        for row in rows:
+            if (error := await _try_insert_rows(group_id, [row])) is None:
+                written += 1
+            else:
+                dead.append((group_id, row, error))
+    if dead:
+        write_stats.dead_letters += len(dead)
+        logger.error(f"{len(dead)} 条消息无法写入，已放入死信文件 {DEAD_LETTER_PATH}")
+        await run_in_pool(_append_dead_letters, dead)
+    return written
+
+# 将缓冲区中所有群的消息在一个事务中写入，失败时放回缓冲区等待下次重试
+# 连续失败 WRITE_MAX_RETRIES 次后逐群逐条写入，隔离无法写入的消息，避免阻塞所有群的记录
+async def flush_pending_msgs():
+    global _pending, _pending_count, _pending_since
+    async with _write_lock:
+        if not _pending_count:
+            return
+        batch, count, since = _pending, _pending_count, _pending_since
+        _pending, _pending_count, _pending_since = {}, 0, None
+        start = time.time()
+        try:
+            for group_id, rows in batch.items():
+                await _insert_rows(group_id, rows)
+            await _conn.commit()
+        except Exception as e:
+            await _conn.rollback()
+            _created_table_group_ids.difference_update(batch)
+            write_stats.failed += 1
+            write_stats.consecutive_failures += 1
+            write_stats.last_error = get_exc_desc(e)
+            if write_stats.consecutive_failures < WRITE_MAX_RETRIES:
+                for group_id, rows in batch.items():
+                    _pending[group_id] = rows + _pending.get(group_id, [])
+                _pending_count += count
+                _pending_since = since
+                raise
+            logger.warning(f"批量写入连续失败 {write_stats.consecutive_failures} 次，逐群写入: {write_stats.last_error}")
+            count = await _flush_isolated(batch)
+        write_stats.consecutive_failures = 0
+        end = time.time()
+        write_stats.batches += 1
+        write_stats.rows += count
+        write_stats.max_batch = max(write_stats.max_batch, count)
+        write_stats.total_flush_time += end - start
+        write_stats.last_lag = end - since
+        write_stats.max_lag = max(write_stats.max_lag, write_stats.last_lag)
+        logger.debug(f"批量写入 {len(batch)} 个群的 {count} 条消息 耗时 {end - start:.3f}s")
+
+# 获取缓冲区中的消息数和最早消息的等待时间
+def get_pending_info() -> Tuple[int, float]:
+    return _pending_count, (time.time() - _pending_since if _pending_since else 0.)
+
+@get_driver().on_shutdown
+async def _():
+    global _flush_task
+    if _flush_task is not None:
+        _flush_task.cancel()
+        _flush_task = None
+    if _conn is not None:
+        await flush_pending_msgs()
+        await _conn.close()
+        logger.info(f"关闭sqlite数据库 {DB_PATH}")
+
+# 插入到消息表，消息先进入写缓冲区，由后台任务批量写入
 async def insert_msg(group_id, time: datetime, msg_id: int, user_id: int, nickname: str, msg: dict):
     time = time.timestamp()
     content = dumps_json(msg)
 
-    conn = await get_conn(group_id)
-    insert_query = f'''
-        INSERT INTO {MSG_TABLE_NAME.format(group_id)} (time, msg_id, user_id, nickname, content)
-        VALUES (?, ?, ?, ?, ?)
-    '''
-    await conn.execute(insert_query, (time, msg_id, user_id, nickname, content))
-    await conn.commit()
-    logger.debug(f"插入消息 {msg_id} 到 {MSG_TABLE_NAME.format(group_id)} 表")
+    await get_conn()
+    _add_pending(group_id, (None, time, msg_id, user_id, nickname, content))
+    logger.debug(f"插入消息 {msg_id} 到 {MSG_TABLE_NAME.format(group_id)} 表的写缓冲区")
+
+# 获取缓冲区中尚未写入的消息，用于读取时合并
+def _get_pending_rows(group_id: int, pred: Callable[[tuple], bool] = None) -> List[tuple]:
+    return [row for row in _pending.get(group_id, []) if pred is None or pred(row)]
     
 # 消息表row转换为返回值
 def msg_row_to_ret(row):
@@ -60,15 +588,32 @@ def msg_row_to_ret(row):
         "msg": loads_json(row[5])
     }
 
+MSG_COLUMNS = ("id", "time", "msg_id", "user_id", "nickname", "content")
+STREAM_CHUNK_SIZE = 2000
+
+# 投影后的消息表row转换为返回值，只包含选择的列，content列解码后作为msg
+def _projected_row_to_ret(row: tuple, columns: List[str]) -> dict:
+    ret = {}
+    for col, value in zip(columns, row):
+        if col == "time":
+            ret["time"] = datetime.fromtimestamp(value)
+        elif col == "content":
+            ret["msg"] = loads_json(value)
+        else:
+            ret[col] = value
+    return ret
+
 # 获取消息表中的所有消息
 async def query_all_msg(group_id: int):
     conn = await get_conn(group_id)
     query = f'''
         SELECT * FROM {MSG_TABLE_NAME.format(group_id)}
     '''
-    cursor = await conn.execute(query)
-    rows = await cursor.fetchall()
-    await cursor.close()
+    async with _write_lock:
+        cursor = await conn.execute(query)
+        rows = await cursor.fetchall()
+        await cursor.close()
+        rows += _get_pending_rows(group_id)
     logger.debug(f"获取 {MSG_TABLE_NAME.format(group_id)} 表中的所有消息 {len(rows)} 条")
     return [msg_row_to_ret(row) for row in rows]
 
@@ -81,9 +626,12 @@ async def query_msg_by_range(group_id: int, start_time: datetime, end_time: date
         SELECT * FROM {MSG_TABLE_NAME.format(group_id)}
         WHERE time >= ? AND time <= ?
     '''
-    cursor = await conn.execute(query, (start_time.timestamp(), end_time.timestamp()))
-    rows = await cursor.fetchall()
-    await cursor.close()
+    start_ts, end_ts = start_time.timestamp(), end_time.timestamp()
+    async with _write_lock:
+        cursor = await conn.execute(query, (start_ts, end_ts))
+        rows = await cursor.fetchall()
+        await cursor.close()
+        rows += _get_pending_rows(group_id, lambda r: start_ts <= r[1] <= end_ts)
     logger.debug(f"获取 {MSG_TABLE_NAME.format(group_id)} 表中的 从 {start_time} 到 {end_time} 的消息 {len(rows)} 条")
     return [msg_row_to_ret(row) for row in rows]
 
@@ -95,9 +643,13 @@ async def query_recent_msg(group_id: int, limit: int):
         ORDER BY time DESC
         LIMIT ?
     '''
-    cursor = await conn.execute(query, (limit,))
-    rows = await cursor.fetchall()
-    await cursor.close()
+    async with _write_lock:
+        cursor = await conn.execute(query, (limit,))
+        rows = await cursor.fetchall()
+        await cursor.close()
+        pending = _get_pending_rows(group_id)
+    if pending:
+        rows = sorted(rows + pending, key=lambda r: r[1], reverse=True)[:limit]
     logger.debug(f"获取 {MSG_TABLE_NAME.format(group_id)} 表中的 最近 {limit} 条消息 {len(rows)} 条")
     return [msg_row_to_ret(row) for row in rows]
 
@@ -106,22 +658,25 @@ async def query_msg_count(group_id: int, start_time: datetime, end_time: datetim
     if start_time is None: start_time = datetime.fromtimestamp(0)
     if end_time is None: end_time = datetime.fromtimestamp(9999999999)
     conn = await get_conn(group_id)
-    if user_id is None:
-        query = f'''
-            SELECT COUNT(*) FROM {MSG_TABLE_NAME.format(group_id)}
-            WHERE time >= ? AND time <= ?
-        '''
-        cursor = await conn.execute(query, (start_time.timestamp(), end_time.timestamp()))
-    else:
-        query = f'''
-            SELECT COUNT(*) FROM {MSG_TABLE_NAME.format(group_id)}
-            WHERE time >= ? AND time <= ? AND user_id = ?
-        '''
-        cursor = await conn.execute(query, (start_time.timestamp(), end_time.timestamp(), user_id))
-    rows = await cursor.fetchall()
-    await cursor.close()
+    start_ts, end_ts = start_time.timestamp(), end_time.timestamp()
+    async with _write_lock:
+        if user_id is None:
+            query = f'''
+                SELECT COUNT(*) FROM {MSG_TABLE_NAME.format(group_id)}
+                WHERE time >= ? AND time <= ?
+            '''
+            cursor = await conn.execute(query, (start_ts, end_ts))
+        else:
+            query = f'''
+                SELECT COUNT(*) FROM {MSG_TABLE_NAME.format(group_id)}
+                WHERE time >= ? AND time <= ? AND user_id = ?
+            '''
+            cursor = await conn.execute(query, (start_ts, end_ts, user_id))
+        rows = await cursor.fetchall()
+        await cursor.close()
+        pending_count = len(_get_pending_rows(group_id, lambda r: start_ts <= r[1] <= end_ts and (user_id is None or r[3] == user_id)))
     logger.debug(f"获取 {MSG_TABLE_NAME.format(group_id)} 表中的 从 {start_time} 到 {end_time} 的消息数")
-    return rows[0][0]
+    return rows[0][0] + pending_count
 
 # 按用户名获取消息表中的消息
 async def query_msg_by_user_id(group_id: int, user_id: int):
@@ -130,9 +685,11 @@ async def query_msg_by_user_id(group_id: int, user_id: int):
         SELECT * FROM {MSG_TABLE_NAME.format(group_id)}
         WHERE user_id = ?
     '''
-    cursor = await conn.execute(query, (user_id,))
-    rows = await cursor.fetchall()
-    await cursor.close()
+    async with _write_lock:
+        cursor = await conn.execute(query, (user_id,))
+        rows = await cursor.fetchall()
+        await cursor.close()
+        rows += _get_pending_rows(group_id, lambda r: r[3] == user_id)
     logger.debug(f"获取 {MSG_TABLE_NAME.format(group_id)} 表中的 用户 {user_id} 的消息 {len(rows)} 条")
     return [msg_row_to_ret(row) for row in rows]
 
@@ -145,9 +702,186 @@ async def query_msg_before(group_id: int, time: datetime, limit: int):
         ORDER BY time DESC
         LIMIT ?
     '''
-    cursor = await conn.execute(query, (time.timestamp(), limit))
-    rows = await cursor.fetchall()
-    await cursor.close()
+    ts = time.timestamp()
+    async with _write_lock:
+        cursor = await conn.execute(query, (ts, limit))
+        rows = await cursor.fetchall()
+        await cursor.close()
+        pending = _get_pending_rows(group_id, lambda r: r[1] <= ts)
+    if pending:
+        rows = sorted(rows + pending, key=lambda r: r[1], reverse=True)[:limit]
     logger.debug(f"获取 {MSG_TABLE_NAME.format(group_id)} 表中的 时间在 {time} 之前的 {limit} 条消息 {len(rows)} 条")
     return [msg_row_to_ret(row) for row in rows]
 
+# 按小时获取聚合的消息统计 [(小时开始时间, 用户ID, 消息数, 文本长度, 图片消息数)]，包含与时间范围有交集的小时
+async def query_hourly_rollup(group_id: int, start_time: datetime, end_time: datetime, user_id: int=None) -> List[Tuple[datetime, int, int, int, int]]:
+    if start_time is None: start_time = datetime.fromtimestamp(0)
+    if end_time is None: end_time = datetime.fromtimestamp(9999999999)
+    conn = await get_conn(group_id)
+    start_ts = int(start_time.timestamp()) // ROLLUP_BUCKET * ROLLUP_BUCKET
+    end_ts = end_time.timestamp()
+    user_cond = "" if user_id is None else "AND user_id = ?"
+    params = (start_ts, end_ts) if user_id is None else (start_ts, end_ts, user_id)
+    async with _write_lock:
+        if _is_rollup_ready(group_id):
+            cursor = await conn.execute(f'''
+                SELECT hour, user_id, count, text_len, image_count FROM {ROLLUP_TABLE_NAME}
+                WHERE group_id = ? AND hour >= ? AND hour <= ? {user_cond}
+            ''', (group_id, *params))
+            agg = { (hour, uid): list(v) for hour, uid, *v in await cursor.fetchall() }
+        else:
+            # 聚合数据尚未回填，直接从消息表统计
+            cursor = await conn.execute(f'''
+                SELECT NULL, time, NULL, user_id, NULL, content FROM {MSG_TABLE_NAME.format(group_id)}
+                WHERE time >= ? AND time <= ? {user_cond}
+            ''', params)
+            agg = _aggregate_rollup(await cursor.fetchall())
+        await cursor.close()
+        _aggregate_rollup(_get_pending_rows(group_id, lambda r: start_ts <= r[1] <= end_ts and (user_id is None or r[3] == user_id)), agg)
+    logger.debug(f"获取 {MSG_TABLE_NAME.format(group_id)} 表 从 {start_time} 到 {end_time} 的聚合统计 {len(agg)} 条")
+    return sorted((datetime.fromtimestamp(hour), uid, *v) for (hour, uid), v in agg.items())
+
+# 按本地日期获取消息数 {"%Y-%m-%d": 消息数}
+async def query_daily_msg_count(group_id: int, start_time: datetime, end_time: datetime, user_id: int=None) -> Dict[str, int]:
+    ret = {}
+    for hour, _, count, _, _ in await query_hourly_rollup(group_id, start_time, end_time, user_id):
+        date = hour.strftime("%Y-%m-%d")
+        ret[date] = ret.get(date, 0) + count
+    return ret
+
+# 按用户获取消息数 {用户ID: 消息数}
+async def query_user_msg_count(group_id: int, start_time: datetime, end_time: datetime) -> Dict[int, int]:
+    ret = {}
+    for _, user_id, count, _, _ in await query_hourly_rollup(group_id, start_time, end_time):
+        ret[user_id] = ret.get(user_id, 0) + count
+    return ret
+
+# 获取时间范围内包含任一关键词的消息 [(ID, 时间戳, 用户ID)]，缓冲区中的消息ID为None，调用方需持有写锁
+async def _query_text_match(conn: aiosqlite.Connection, group_id: int, terms: List[str], start_ts: float, end_ts: float, user_id: int=None) -> List[tuple]:
+    user_cond = "" if user_id is None else "AND user_id = ?"
+    params = (start_ts, end_ts) if user_id is None else (start_ts, end_ts, user_id)
+    if not _is_text_index_ready(group_id):
+        # 全文索引尚未回填，直接从消息表提取文本匹配
+        cursor = await conn.execute(f'''
+            SELECT id, time, NULL, user_id, NULL, content FROM {MSG_TABLE_NAME.format(group_id)}
+            WHERE time >= ? AND time <= ? {user_cond}
+        ''', params)
+        ret = []
+        for row in await cursor.fetchall():
+            text = extract_text(loads_json(row[5]))
+            if any(term in text for term in terms):
+                ret.append((row[0], row[1], row[3]))
+    elif all(len(term) >= FTS_MIN_TERM_LEN for term in terms):
+        text_table, fts_table = MSG_TEXT_TABLE_NAME.format(group_id), MSG_FTS_TABLE_NAME.format(group_id)
+        match = " OR ".join('"' + term.replace('"', '""') + '"' for term in terms)
+        cursor = await conn.execute(f'''
+            SELECT t.id, t.time, t.user_id FROM {fts_table} f JOIN {text_table} t ON t.id = f.rowid
+            WHERE {fts_table} MATCH ? AND t.time >= ? AND t.time <= ? {"" if user_id is None else "AND t.user_id = ?"}
+        ''', (match, *params))
+        ret = await cursor.fetchall()
+    else:
+        term_cond = " OR ".join("instr(text, ?) > 0" for _ in terms)
+        cursor = await conn.execute(f'''
+            SELECT id, time, user_id FROM {MSG_TEXT_TABLE_NAME.format(group_id)}
+            WHERE time >= ? AND time <= ? {user_cond} AND ({term_cond})
+        ''', (*params, *terms))
+        ret = await cursor.fetchall()
+    await cursor.close()
+    pending = _get_pending_rows(group_id, lambda r: start_ts <= r[1] <= end_ts and (user_id is None or r[3] == user_id))
+    ret = list(ret) + [(None, t, uid) for _, t, uid, text in _get_text_rows(pending) if any(term in text for term in terms)]
+    return ret
+
+# 按本地日期和用户统计包含任一关键词的消息数 {("%Y-%m-%d", 用户ID): 消息数}
+async def query_term_count(group_id: int, terms: List[str], start_time: datetime, end_time: datetime) -> Dict[Tuple[str, int], int]:
+    if start_time is None: start_time = datetime.fromtimestamp(0)
+    if end_time is None: end_time = datetime.fromtimestamp(9999999999)
+    conn = await get_conn(group_id)
+    async with _write_lock:
+        rows = await _query_text_match(conn, group_id, terms, start_time.timestamp(), end_time.timestamp())
+    ret = {}
+    for _, time, user_id in rows:
+        key = (datetime.fromtimestamp(time).strftime("%Y-%m-%d"), user_id)
+        ret[key] = ret.get(key, 0) + 1
+    logger.debug(f"获取 {MSG_TABLE_NAME.format(group_id)} 表 从 {start_time} 到 {end_time} 包含 {terms} 的消息 {len(rows)} 条")
+    return ret
+
+# 按关键词搜索消息，返回时间范围内包含任一关键词的最近若干条消息
+async def search_msg(group_id: int, terms: List[str], start_time: datetime=None, end_time: datetime=None, user_id: int=None, limit: int=100):
+    if start_time is None: start_time = datetime.fromtimestamp(0)
+    if end_time is None: end_time = datetime.fromtimestamp(9999999999)
+    conn = await get_conn(group_id)
+    start_ts, end_ts = start_time.timestamp(), end_time.timestamp()
+    async with _write_lock:
+        matches = await _query_text_match(conn, group_id, terms, start_ts, end_ts, user_id)
+        matches = sorted(matches, key=lambda r: r[1], reverse=True)[:limit]
+        ids = [id for id, _, _ in matches if id is not None]
+        rows = []
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            cursor = await conn.execute(f'''
+                SELECT * FROM {MSG_TABLE_NAME.format(group_id)} WHERE id IN ({", ".join("?" * len(chunk))})
+            ''', chunk)
+            rows += await cursor.fetchall()
+            await cursor.close()
+        if len(ids) < len(matches):
+            rows += [row for row in _get_pending_rows(group_id, lambda r: start_ts <= r[1] <= end_ts and (user_id is None or r[3] == user_id))
+                     if any(term in extract_text(loads_json(row[5])) for term in terms)]
+    rows = sorted(rows, key=lambda r: r[1], reverse=True)[:limit]
+    logger.debug(f"搜索 {MSG_TABLE_NAME.format(group_id)} 表中包含 {terms} 的消息 {len(rows)} 条")
+    return [msg_row_to_ret(row) for row in rows]
+
+# 将一块查询结果和缓冲区中的消息转换为返回格式
+def _project_chunk(rows: List[tuple], pending: List[tuple], columns: List[str]) -> List[dict]:
+    return [_projected_row_to_ret(row[2:], columns) for row in rows] + [_projected_row_to_ret(row, columns) for row in pending]
+
+async def iter_msg_by_range(group_id: int, start_time: datetime, end_time: datetime, columns: List[str] = None, chunk_size: int = STREAM_CHUNK_SIZE) -> AsyncIterator[List[dict]]:
+    """
+    按时间范围流式获取消息 None则不限制，按 (时间, ID) 顺序每次返回不超过 `chunk_size` 条，
+    `columns` 为需要的列（默认全部，不选择content时不解码消息内容）。
+    每次读取一块时持有锁，块之间写入不受影响，最后一块合并缓冲区中尚未写入的消息
+    """
+    columns = list(columns or MSG_COLUMNS)
+    for col in columns:
+        assert col in MSG_COLUMNS, f"未知的列 {col}"
+    if start_time is None: start_time = datetime.fromtimestamp(0)
+    if end_time is None: end_time = datetime.fromtimestamp(9999999999)
+    conn = await get_conn(group_id)
+    table = MSG_TABLE_NAME.format(group_id)
+    start_ts, end_ts = start_time.timestamp(), end_time.timestamp()
+    select = ", ".join(["time", "id"] + columns)
+    last_key = None
+    total = 0
+    while True:
+        async with _write_lock:
+            if last_key is None:
+                cursor = await conn.execute(f'''
+                    SELECT {select} FROM {table}
+                    WHERE time >= ? AND time <= ?
+                    ORDER BY time, id LIMIT ?
+                ''', (start_ts, end_ts, chunk_size))
+            else:
+                cursor = await conn.execute(f'''
+                    SELECT {select} FROM {table}
+                    WHERE (time, id) > (?, ?) AND time <= ?
+                    ORDER BY time, id LIMIT ?
+                ''', (*last_key, end_ts, chunk_size))
+            rows = await cursor.fetchall()
+            await cursor.close()
+            pending = []
+            if len(rows) < chunk_size:
+                pending = _get_pending_rows(group_id, lambda r: start_ts <= r[1] <= end_ts)
+                pending = [tuple(row[MSG_COLUMNS.index(col)] for col in columns) for row in sorted(pending, key=lambda r: r[1])]
+        if rows:
+            last_key = rows[-1][:2]
+        # 解码消息内容在线程池中执行，避免大块消息阻塞事件循环
+        chunk = await run_in_pool(_project_chunk, rows, pending, columns)
+        total += len(chunk)
+        if chunk:
+            yield chunk
+        if len(rows) < chunk_size:
+            break
+    logger.debug(f"流式获取 {table} 表中的 从 {start_time} 到 {end_time} 的消息 {total} 条")
+
+# 流式获取消息表中的所有消息
+def iter_all_msg(group_id: int, columns: List[str] = None, chunk_size: int = STREAM_CHUNK_SIZE) -> AsyncIterator[List[dict]]:
+    return iter_msg_by_range(group_id, None, None, columns, chunk_size)
@@ -739,17 +739,12 @@ class RegionRipAssetManger:
             )
         return cls._all_mgrs[region]
 
+    # timeout为0或None时不限制超时
     async def _download_data(self, url: str, timeout: int) -> bytes:
-        async def do_download():
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, verify_ssl=False) as resp:
-                    if resp.status != 200:
-                        raise Exception(f"请求失败: {resp.status}")
-                    return await resp.read()
-        if not timeout:
-            return await do_download()
-        else:
-            return await asyncio.wait_for(do_download(), timeout)
+        async with http_session_mgr.get(url, timeout=timeout or 0) as resp:
+            if resp.status != 200:
+                raise Exception(f"请求失败: {resp.status}")
+            return await resp.read()
 
     async def get_asset(
         self,
@@ -113,6 +113,10 @@ CARD_SKILL_NAMES = [
 
 UNKNOWN_IMG = Image.open(f"{SEKAI_ASSET_DIR}/static_images/unknown.png")
 
+# 是否是资源获取失败时的占位图片，占位图片不应该被缓存
+def is_placeholder_img(img: Image.Image) -> bool:
+    return img is UNKNOWN_IMG or img.info.get('placeholder', False)
+
 CHARACTER_NICKNAME_DATA: List[Dict[str, Any]] = load_json(f"{SEKAI_DATA_DIR}/character_nicknames.json")
 CHARACTER_FIRST_NICKNAME: Dict[int, str] = {}
 for item in CHARACTER_NICKNAME_DATA:
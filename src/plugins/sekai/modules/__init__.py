@@ -8,6 +8,7 @@ from .misc import *
 from .music import *
 from .mysekai import *
 from .profile import *
+from .render_bench import *
 from .resbox import *
 from .score import *
 from .sk import *
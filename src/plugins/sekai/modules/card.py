@@ -131,7 +131,7 @@ async def compose_card_list_image(ctx: SekaiHandlerContext, bg_unit: str, cards:
         except: 
             logger.print_exc(f"获取卡牌{card['id']}完整缩略图失败")
             return UNKNOWN_IMG, UNKNOWN_IMG
-    thumbs = await batch_gather(*[get_thumb_nothrow(card) for card in cards])
+    thumbs = await bounded_gather(*[get_thumb_nothrow(card) for card in cards], adaptive=True)
     card_and_thumbs = [(card, thumb) for card, thumb in zip(cards, thumbs) if thumb is not None]
     card_and_thumbs.sort(key=lambda x: (x[0]['releaseAt'], x[0]['id']), reverse=True)
 
@@ -372,7 +372,7 @@ async def compose_box_image(ctx: SekaiHandlerContext, qid: int, cards: dict, sho
             if only_has_after_training(card):
                 after_training = True
             return await get_card_full_thumbnail(ctx, card, after_training)
-    card_imgs = await batch_gather(*[get_card_full_thumbnail_nothrow(card) for card in cards])
+    card_imgs = await bounded_gather(*[get_card_full_thumbnail_nothrow(card) for card in cards], adaptive=True)
 
     # collect chara cards
     chara_cards = {}
@@ -431,7 +431,7 @@ async def compose_box_image(ctx: SekaiHandlerContext, qid: int, cards: dict, sho
                                 for card in part2: draw_card(card)
             
     add_watermark(canvas)
-    return await run_in_pool(canvas.get_img)
+    return await render_canvas(canvas, allow_tiled=True)
 
 # 获取指定ID的技能信息
 async def get_skill_info(ctx: SekaiHandlerContext, sid: int, card: dict):
@@ -646,7 +646,7 @@ async def compose_card_detail_image(ctx: SekaiHandlerContext, card_id: int):
     for cos3d in cos3ds:
         asset_name = cos3d['assetbundleName']
         cos3d_imgs.append(ctx.rip.img(f"thumbnail/costume_rip/{asset_name}.png"))
-    cos3d_imgs = await batch_gather(*cos3d_imgs)
+    cos3d_imgs = await bounded_gather(*cos3d_imgs)
 
     # ----------------------- 绘图 ----------------------- #
     title_style = TextStyle(font=DEFAULT_BOLD_FONT, size=24, color=BLACK)
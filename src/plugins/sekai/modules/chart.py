@@ -127,6 +127,7 @@ pjsk_chart = SekaiCmdHandler([
     "/谱面查询", "/铺面查询", "/谱面预览", "/铺面预览", "/谱面", "/铺面"
 ])
 pjsk_chart.check_cdrate(cd).check_wblist(gbl)
+pjsk_chart.coalesce(ttl=30, user_dependent=False)
 @pjsk_chart.handle()
 async def _(ctx: SekaiHandlerContext):
     query = ctx.get_args().strip()
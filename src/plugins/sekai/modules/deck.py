@@ -611,14 +611,13 @@ async def do_deck_recommend(
             'musicmetas_update_ts': last_deck_recommend_musicmetas_update_time[options.region].timestamp(),
             'options': options.to_dict(),
         }
-        async with aiohttp.ClientSession() as session:
-            async with session.post(RECOMMEND_SERVE_URL, json=payload) as resp:
-                if resp.status != 200:
-                    raise ReplyException(f"组卡请求失败: HTTP {resp.status}")
-                data = await resp.json()
-                if data['status'] != 'success':
-                    raise ReplyException(data['exception'])
-                return data
+        async with http_session_mgr.post(RECOMMEND_SERVE_URL, json=payload) as resp:
+            if resp.status != 200:
+                raise ReplyException(f"组卡请求失败: HTTP {resp.status}")
+            data = await resp.json()
+            if data['status'] != 'success':
+                raise ReplyException(data['exception'])
+            return data
 
     # 组卡!
     futs = []
@@ -789,7 +788,7 @@ async def compose_deck_recommend_image(
                 'eventBonus': deckcard.event_bonus_rate,
             }
             card_imgs.append(_get_thumb(card, pcard))
-    card_imgs = { cid: img for cid, img in await asyncio.gather(*card_imgs) }
+    card_imgs = { cid: img for cid, img in await bounded_gather(*card_imgs) }
 
     # 获取挑战live额外分数信息
     challenge_score_dlt = []
@@ -353,7 +353,7 @@ async def get_chara_ban_events(ctx: SekaiHandlerContext, cid: int) -> List[dict]
 # 合成活动列表图片
 async def compose_event_list_image(ctx: SekaiHandlerContext, filter: EventListFilter) -> Image.Image:
     events = sorted(await ctx.md.events.get(), key=lambda x: x['startAt'])    
-    details: List[EventDetail] = await batch_gather(*[get_event_detail(ctx, e, ['banner', 'card_thumbs']) for e in events])
+    details: List[EventDetail] = await bounded_gather(*[get_event_detail(ctx, e, ['banner', 'card_thumbs']) for e in events], adaptive=True)
 
     filtered_details = []
     for d in details:
@@ -389,7 +389,10 @@ async def compose_event_list_image(ctx: SekaiHandlerContext, filter: EventListFi
                     bg_color = (220, 220, 220, 200)
                 bg = roundrect_bg(bg_color, 5)
 
-                with HSplit().set_padding(4).set_sep(4).set_item_align('lt').set_content_align('lt').set_bg(bg):
+                with HSplit().set_padding(4).set_sep(4).set_item_align('lt').set_content_align('lt').set_bg(bg) as item:
+                    # 活动条目内容只由活动和进行状态决定，缓存渲染结果
+                    if not any(is_placeholder_img(img) for img in [d.event_banner, *d.event_card_thumbs[:6]]):
+                        item.set_cache_key(f"event_list_item:{ctx.region}_{d.eid}_{bg_color}")
                     with VSplit().set_padding(0).set_sep(2).set_item_align('lt').set_content_align('lt'):
                         ImageBox(d.event_banner, size=(None, 40))
                         with Grid(col_count=3).set_padding(0).set_sep(1, 1):
@@ -406,7 +409,7 @@ async def compose_event_list_image(ctx: SekaiHandlerContext, filter: EventListFi
                             if d.banner_cid: ImageBox(get_chara_icon_by_chara_id(d.banner_cid), size=(None, 24))
 
     add_watermark(canvas)
-    return await run_in_pool(canvas.get_img)
+    return await render_canvas(canvas)
 
 # 根据"昵称箱数"（比如saki1）获取活动，不存在返回None
 async def get_event_by_ban_name(ctx: SekaiHandlerContext, ban_name: str) -> Optional[dict]:
@@ -902,6 +905,7 @@ pjsk_event_list = SekaiCmdHandler([
     "/活动列表"
 ])
 pjsk_event_list.check_cdrate(cd).check_wblist(gbl)
+pjsk_event_list.coalesce(ttl=30, user_dependent=False)
 @pjsk_event_list.handle()
 async def _(ctx: SekaiHandlerContext):
     args = ctx.get_args().strip()
@@ -938,6 +942,7 @@ pjsk_event_list = SekaiCmdHandler([
     "/活动", "/查活动",
 ])
 pjsk_event_list.check_cdrate(cd).check_wblist(gbl)
+pjsk_event_list.coalesce(ttl=30, user_dependent=False)
 @pjsk_event_list.handle()
 async def _(ctx: SekaiHandlerContext):
     args = ctx.get_args().strip()
@@ -259,7 +259,7 @@ async def sync_music_alias():
             return False
         except Exception as e:
             logger.warning(f"同步歌曲 {mid} 的别名失败: {get_exc_desc(e)}")
-    updated_num = sum(await batch_gather(*[sync(mid) for mid in mids], batch_size=cfg.sync_batch_size))
+    updated_num = sum(await bounded_gather(*[sync(mid) for mid in mids], limit=cfg.sync_batch_size))
     logger.info(f"别名同步完成，{updated_num} 首歌曲的别名发生变更")
     
 
@@ -817,10 +817,10 @@ async def compose_music_detail_image(ctx: SekaiHandlerContext, mid: int, title:
     return await run_in_pool(canvas.get_img)    
 
 # 合成歌曲列表图片
-async def compose_music_list_image(ctx: SekaiHandlerContext, diff: str, lv_musics: List[Tuple[int, List[Dict]]], qid: int, show_id: bool, show_leak: bool) -> Image.Image:
+async def compose_music_list_image(ctx: SekaiHandlerContext, diff: str, lv_musics: List[Tuple[int, List[Dict]]], qid: int, show_id: bool, show_leak: bool) -> Union[Image.Image, EncodedImage]:
     for i in range(len(lv_musics)):
         lv, musics = lv_musics[i]
-        covers = await batch_gather(*[get_music_cover_thumb(ctx, m['id']) for m in musics])
+        covers = await bounded_gather(*[get_music_cover_thumb(ctx, m['id']) for m in musics], adaptive=True)
         for m, cover in zip(musics, covers):
             m['cover_img'] = cover
         
@@ -877,7 +877,7 @@ async def compose_music_list_image(ctx: SekaiHandlerContext, diff: str, lv_music
                                         TextBox(f"{musics[i]['id']}", TextStyle(font=DEFAULT_FONT, size=16, color=BLACK)).set_w(64)
                                 
     add_watermark(canvas)
-    return await run_in_pool(canvas.get_img)
+    return await render_canvas(canvas, allow_tiled=True)
 
 # 合成打歌进度图片
 async def compose_play_progress_image(ctx: SekaiHandlerContext, diff: str, qid: int) -> Image.Image:
@@ -736,7 +736,7 @@ async def compose_mysekai_fixture_list_image(
     
     # 获取家具图标
     fixture_icons = {}
-    result = await batch_gather(*[get_mysekai_fixture_icon(ctx, item) for item in all_fixtures])
+    result = await bounded_gather(*[get_mysekai_fixture_icon(ctx, item) for item in all_fixtures], adaptive=True)
     for fixture, icon in zip(all_fixtures, result):
         fixture_icons[fixture['id']] = icon
 
@@ -1361,7 +1361,7 @@ async def compose_mysekai_musicrecord_image(ctx: SekaiHandlerContext, qid: int,
 
     music_covers = {}
     for tag, mids in category_mids.items():
-        music_covers[tag] = await batch_gather(*[get_music_cover_thumb(ctx, i) for i in mids])
+        music_covers[tag] = await bounded_gather(*[get_music_cover_thumb(ctx, i) for i in mids], adaptive=True)
         
     with Canvas(bg=DEFAULT_BLUE_GRADIENT_BG).set_padding(BG_PADDING) as canvas:
         with VSplit().set_content_align('lt').set_item_align('lt').set_sep(16) as vs:
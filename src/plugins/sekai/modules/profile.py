@@ -31,6 +31,7 @@ class PlayerAvatarInfo:
     img: Image.Image
 
 DEFAULT_DATA_MODE = 'latest'
+PROFILE_CARD_CACHE_BUCKET = 60      # 玩家信息卡片的缓存按当前时间分桶的秒数，相对时间文本最多滞后该时长
 
 
 # ======================= 卡牌逻辑（防止循环依赖） ======================= #
@@ -146,6 +147,8 @@ async def get_card_full_thumbnail(
     if not pcard and ok_to_cache:
         create_parent_folder(cache_path)
         img.save(cache_path)
+    if not ok_to_cache:
+        img.info['placeholder'] = True
 
     return img
 
@@ -334,6 +337,14 @@ async def get_detailed_profile_card(ctx: SekaiHandlerContext, profile: dict, err
                     update_time = datetime.fromtimestamp(profile['upload_time'] / 1000)
                     update_time_text = update_time.strftime('%m-%d %H:%M:%S') + f" ({get_readable_datetime(update_time, show_original_time=False)})"
                     user_id = process_hide_uid(ctx, game_data['userId'])
+                    # 同一用户的多张图片使用相同的卡片，只由稳定的输入构造缓存key
+                    # 头像由卡牌ID和是否特训确定，相对时间文本由上传时间和当前时间所在的桶确定
+                    if not is_placeholder_img(avatar_info.img):
+                        leader = find_by(profile['userCards'], 'cardId', avatar_info.card_id)
+                        f.set_cache_key(f"profile_card:" + get_md5('|'.join(map(str, [
+                            ctx.region, avatar_info.card_id, leader['after_training'], game_data['name'], user_id,
+                            profile['upload_time'], int(time.time() // PROFILE_CARD_CACHE_BUCKET), source, mode, err_msg,
+                        ]))))
                     colored_text_box(
                         truncate(game_data['name'], 64),
                         TextStyle(font=DEFAULT_BOLD_FONT, size=24, color=BLACK),
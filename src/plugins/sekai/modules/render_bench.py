@@ -0,0 +1,283 @@
+from ...utils import *
+from ..common import *
+from ..handler import *
+from ..draw import *
+import resource
+import platform
+import statistics as stats_lib
+import importlib
+import PIL
+
+RENDER_BENCH_OUTPUT_DIR = f"{SEKAI_DATA_DIR}/render_bench"
+RENDER_BENCH_FIXTURE_PATH = f"{RENDER_BENCH_OUTPUT_DIR}/fixtures.json"
+RENDER_BENCH_SEED = 42
+
+
+# ======================= 测试数据 ======================= #
+
+# 生成确定性的测试图片，不依赖资源文件
+def _bench_img(seed: int, size: Tuple[int, int] = (128, 128), noise: bool = False) -> Image.Image:
+    rng = np.random.default_rng(RENDER_BENCH_SEED + seed)
+    c1, c2 = rng.integers(0, 256, 3), rng.integers(0, 256, 3)
+    t = np.linspace(0, 1, size[0], dtype=np.float32)[np.newaxis, :, np.newaxis]
+    arr = np.broadcast_to(c1 + (c2 - c1) * t, (size[1], size[0], 3)).astype(np.float32)
+    if noise:
+        arr = arr + rng.normal(0, 24, arr.shape)
+    arr = np.concatenate([np.clip(arr, 0, 255), np.full((size[1], size[0], 1), 255)], axis=-1)
+    return Image.fromarray(arr.astype(np.uint8), 'RGBA')
+
+def _bench_bg() -> WidgetBg:
+    return ImageBg(_bench_img(0, (1024, 768), noise=True))
+
+def _bench_text(rng: random.Random, n: int) -> str:
+    chars = "初音ミク星乃一歌天馬司宵崎奏ABCDEFGHIJ0123456789"
+    return ''.join(rng.choice(chars) for _ in range(n))
+
+
+# ======================= 测试用例 ======================= #
+
+# 榜线表格，结构同 compose_skp_image
+def build_bench_sk_table() -> Canvas:
+    rng = random.Random(RENDER_BENCH_SEED)
+    with Canvas(bg=DEFAULT_BLUE_GRADIENT_BG).set_padding(BG_PADDING) as canvas:
+        with VSplit().set_content_align('lt').set_item_align('lt').set_sep(16).set_item_bg(roundrect_bg()):
+            with HSplit().set_content_align('rt').set_item_align('rt').set_padding(16).set_sep(7):
+                with VSplit().set_content_align('lt').set_item_align('lt').set_sep(5):
+                    for _ in range(4):
+                        TextBox(_bench_text(rng, 24), TextStyle(font=DEFAULT_BOLD_FONT, size=18, color=BLACK))
+                ImageBox(_bench_img(1, (320, 120)), size=(140, None))
+            gh = 30
+            with Grid(col_count=3).set_content_align('c').set_sep(hsep=8, vsep=5).set_padding(16):
+                bg1 = FillBg((255, 255, 255, 200))
+                bg2 = FillBg((255, 255, 255, 100))
+                title_style = TextStyle(font=DEFAULT_BOLD_FONT, size=18, color=BLACK)
+                item_style  = TextStyle(font=DEFAULT_FONT,      size=20, color=BLACK)
+                for title in ("排名", "预测当前", "预测最终"):
+                    TextBox(title, title_style).set_bg(bg1).set_size((160, gh)).set_content_align('c')
+                for i in range(60):
+                    bg = bg2 if i % 2 == 0 else bg1
+                    for _ in range(3):
+                        TextBox(f"{rng.randint(0, 10 ** 8):,}", item_style, overflow='clip').set_bg(bg).set_size((160, gh)).set_content_align('r').set_padding((16, 0))
+    add_watermark(canvas)
+    return canvas
+
+# 300张卡牌缩略图的box，结构同 compose_box_image
+def build_bench_box_grid() -> Canvas:
+    sz = 48
+    thumbs = [_bench_img(100 + i, (sz * 2, sz * 2)) for i in range(300)]
+    with Canvas(bg=_bench_bg()).set_padding(BG_PADDING) as canvas:
+        with HSplit().set_bg(roundrect_bg()).set_content_align('lt').set_item_align('lt').set_padding(16).set_sep(4):
+            for chara in range(26):
+                with VSplit().set_content_align('lt').set_item_align('lt').set_sep(4):
+                    ImageBox(_bench_img(chara), size=(sz, sz))
+                    Spacer(w=sz, h=8)
+                    for i in range(chara, len(thumbs), 26):
+                        with Frame().set_content_align('rt'):
+                            ImageBox(thumbs[i], size=(sz, sz))
+                            if i % 3 == 0:
+                                Spacer(w=sz, h=sz).set_bg(RoundRectBg(fill=(0, 0, 0, 120), radius=2))
+                        TextBox(f"{i}", TextStyle(font=DEFAULT_FONT, size=12, color=BLACK)).set_w(sz)
+    add_watermark(canvas)
+    return canvas
+
+# 按等级分组的歌曲列表，结构同 compose_music_list_image
+def build_bench_music_list() -> Canvas:
+    rng = random.Random(RENDER_BENCH_SEED)
+    with Canvas(bg=_bench_bg()).set_padding(BG_PADDING) as canvas:
+        with VSplit().set_bg(roundrect_bg()).set_padding(16).set_sep(16).set_content_align('lt').set_item_align('lt'):
+            for lv in range(37, 25, -1):
+                TextBox(f"Lv.{lv}", TextStyle(font=DEFAULT_BOLD_FONT, size=24, color=BLACK))
+                with Grid(col_count=10).set_sep(8, 8).set_content_align('lt').set_item_align('lt'):
+                    for i in range(rng.randint(5, 30)):
+                        with VSplit().set_content_align('c').set_item_align('c').set_sep(5):
+                            ImageBox(_bench_img(1000 + lv * 100 + i, (128, 128)), size=(64, 64))
+                            TextBox(f"{lv * 100 + i}", TextStyle(font=DEFAULT_FONT, size=16, color=BLACK)).set_w(64)
+    add_watermark(canvas)
+    return canvas
+
+# 个人信息卡片，结构同 get_detailed_profile_card
+def build_bench_profile_card() -> Canvas:
+    rng = random.Random(RENDER_BENCH_SEED)
+    with Canvas(bg=DEFAULT_BLUE_GRADIENT_BG).set_padding(BG_PADDING) as canvas:
+        with HSplit().set_bg(roundrect_bg()).set_content_align('c').set_item_align('c').set_padding(16).set_sep(14):
+            ImageBox(_bench_img(7, (256, 256)), size=(80, 80), image_size_mode='fill')
+            with VSplit().set_content_align('c').set_item_align('l').set_sep(5):
+                TextBox(_bench_text(rng, 12), TextStyle(font=DEFAULT_BOLD_FONT, size=24, color=BLACK))
+                TextBox(f"ID: {rng.randint(10 ** 15, 10 ** 16)}", TextStyle(font=DEFAULT_FONT, size=16, color=BLACK))
+                TextBox(f"更新时间: {_bench_text(rng, 16)}", TextStyle(font=DEFAULT_FONT, size=16, color=BLACK))
+                TextBox(f"数据来源: {_bench_text(rng, 8)}", TextStyle(font=DEFAULT_FONT, size=12, color=(50, 50, 50, 255)))
+    add_watermark(canvas)
+    return canvas
+
+RENDER_BENCH_CASES: Dict[str, Callable[[], Canvas]] = {
+    'sk_table': build_bench_sk_table,
+    'box_grid': build_bench_box_grid,
+    'music_list': build_bench_music_list,
+    'profile_card': build_bench_profile_card,
+}
+
+
+# ======================= 测试执行 ======================= #
+
+RENDER_BENCH_PATHS = ['direct', 'banded', 'tiled']
+
+def _get_rss_mb() -> float:
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 1024 / 1024
+
+def _get_peak_rss_mb() -> float:
+    # linux下ru_maxrss单位为KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _get_encoded_bytes(img: Union[Image.Image, EncodedImage, List[Image.Image]]) -> int:
+    if isinstance(img, EncodedImage):
+        return len(img.data)
+    if isinstance(img, list):
+        return sum(_get_encoded_bytes(i) for i in img)
+    return len(encode_image(img, low_quality=True))
+
+# 取各轮的中位数，第一轮包含字体、资源等缓存的加载，单独记录
+def _summarize_runs(runs: List[Dict[str, float]]) -> Dict[str, Any]:
+    ret = { key: round(stats_lib.median(r[key] for r in runs), 2) for key in runs[0] }
+    ret['first'] = { k: round(v, 2) for k, v in runs[0].items() }
+    return ret
+
+def _get_memory_stats(base_rss: float, base_peak: float) -> Dict[str, float]:
+    # 用例在同一进程中依次执行，峰值增长只在超过之前的峰值时计入
+    return {
+        'base_rss_mb': round(base_rss, 1),
+        'peak_rss_mb': round(_get_peak_rss_mb(), 1),
+        'rss_growth_mb': round(_get_rss_mb() - base_rss, 1),
+        'peak_growth_mb': round(_get_peak_rss_mb() - base_peak, 1),
+    }
+
+# 合成画布用例，测量布局以及 render_canvas 各绘制路径的光栅化和编码耗时，tiled路径的编码包含在光栅化中
+async def _run_canvas_case(name: str, repeat: int) -> Dict[str, Any]:
+    build = RENDER_BENCH_CASES[name]
+    base_rss, base_peak = _get_rss_mb(), _get_peak_rss_mb()
+    ret = { 'kind': 'canvas', 'paths': {} }
+    for path in RENDER_BENCH_PATHS:
+        runs = []
+        for _ in range(repeat):
+            # 每轮清空绘图缓存，第一轮之后的字体等缓存视为稳态
+            raster_cache.clear()
+            bg_cache.clear()
+            t0 = time.perf_counter()
+            canvas = build()
+            measure_count = get_layout_measure_count()
+            t1 = time.perf_counter()
+            size = canvas._get_self_size()
+            t2 = time.perf_counter()
+            measure_count = get_layout_measure_count() - measure_count
+            img = await render_canvas(canvas, path=path)
+            t3 = time.perf_counter()
+            encoded_bytes = _get_encoded_bytes(img)
+            t4 = time.perf_counter()
+            runs.append({
+                'build_ms': (t1 - t0) * 1000,
+                'layout_ms': (t2 - t1) * 1000,
+                'raster_ms': (t3 - t2) * 1000,
+                'encode_ms': (t4 - t3) * 1000,
+                'measure_count': measure_count,
+                'encoded_bytes': encoded_bytes,
+            })
+        ret['paths'][path] = _summarize_runs(runs)
+    ret['size'] = list(size)
+    ret.update(_get_memory_stats(base_rss, base_peak))
+    return ret
+
+# 加载真实绘图函数的测试数据，每项为 {"name", "func": "模块名.函数名", "region", "args": [...], "kwargs": {...}}
+# 参数为调用 compose_* 时ctx之后的参数，文件不存在时返回空列表
+def load_render_bench_fixtures(path: str = None) -> List[Dict[str, Any]]:
+    path = path or RENDER_BENCH_FIXTURE_PATH
+    if not osp.exists(path):
+        return []
+    return load_json(path)
+
+# 真实绘图函数用例，调用 compose_* 并测量合成和编码耗时，第一轮包含资源下载
+async def _run_compose_case(fixture: Dict[str, Any], repeat: int) -> Dict[str, Any]:
+    module_name, func_name = fixture['func'].rsplit('.', 1)
+    func = getattr(importlib.import_module(f"{__package__}.{module_name}"), func_name)
+    ctx = SekaiHandlerContext.from_region(fixture.get('region', 'jp'))
+    base_rss, base_peak = _get_rss_mb(), _get_peak_rss_mb()
+    runs = []
+    for _ in range(repeat):
+        raster_cache.clear()
+        bg_cache.clear()
+        # 绘图函数可能修改传入的参数，每轮使用新的副本
+        args, kwargs = deepcopy(fixture.get('args', [])), deepcopy(fixture.get('kwargs', {}))
+        t0 = time.perf_counter()
+        img = await func(ctx, *args, **kwargs)
+        t1 = time.perf_counter()
+        encoded_bytes = _get_encoded_bytes(img)
+        t2 = time.perf_counter()
+        runs.append({
+            'compose_ms': (t1 - t0) * 1000,
+            'encode_ms': (t2 - t1) * 1000,
+            'encoded_bytes': encoded_bytes,
+        })
+    ret = { 'kind': 'compose', 'func': fixture['func'], 'region': ctx.region }
+    ret.update(_summarize_runs(runs))
+    ret.update(_get_memory_stats(base_rss, base_peak))
+    return ret
+
+async def run_render_bench(case_names: List[str] = None, repeat: int = 3, fixture_path: str = None) -> Dict[str, Any]:
+    """
+    执行绘图基准测试，包括合成画布用例和测试数据中的真实绘图函数用例，返回可直接保存为json的结果
+    """
+    fixtures = { f['name']: f for f in load_render_bench_fixtures(fixture_path) }
+    all_names = list(RENDER_BENCH_CASES.keys()) + [name for name in fixtures if name not in RENDER_BENCH_CASES]
+    case_names = case_names or all_names
+    for name in case_names:
+        assert name in all_names, f"未知的测试用例 {name}，可用: {', '.join(all_names)}"
+    results = {}
+    for name in case_names:
+        if name in RENDER_BENCH_CASES:
+            results[name] = await _run_canvas_case(name, repeat)
+        else:
+            results[name] = await _run_compose_case(fixtures[name], repeat)
+    return {
+        'time': datetime.now().isoformat(),
+        'repeat': repeat,
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'numpy': np.__version__,
+        'cpu_workers': get_pool('cpu').max_workers,
+        'band_height': RENDER_BAND_HEIGHT,
+        'cases': results,
+    }
+
+# 保存测试结果，返回保存路径
+async def save_render_bench_result(result: Dict[str, Any], path: str = None) -> str:
+    path = path or f"{RENDER_BENCH_OUTPUT_DIR}/bench_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    await adump_json(result, path)
+    return path
+
+def format_render_bench_result(result: Dict[str, Any]) -> str:
+    msg = ""
+    for name, r in result['cases'].items():
+        if r['kind'] == 'canvas':
+            raster = '/'.join(f"{r['paths'][p]['raster_ms']:.0f}" for p in RENDER_BENCH_PATHS)
+            msg += f"{name} {r['size'][0]}x{r['size'][1]}: 布局 {r['paths']['direct']['layout_ms']:.0f}ms "
+            msg += f"绘制({'/'.join(RENDER_BENCH_PATHS)}) {raster}ms "
+        else:
+            msg += f"{name}({r['func']}): 合成 {r['compose_ms']:.0f}ms(首次 {r['first']['compose_ms']:.0f}ms) 编码 {r['encode_ms']:.0f}ms "
+        msg += f"峰值内存 {r['peak_rss_mb']:.0f}MB(+{r['peak_growth_mb']:.0f}MB)\n"
+    return msg.strip()
+
+
+# ======================= 指令处理 ======================= #
+
+render_bench = SekaiCmdHandler([
+    "/render_bench",
+])
+render_bench.check_cdrate(cd).check_wblist(gbl).check_superuser()
+@render_bench.handle()
+async def _(ctx: SekaiHandlerContext):
+    args = ctx.get_args().strip().split()
+    repeat = 3
+    if args and args[-1].isdigit():
+        repeat = int(args.pop())
+    result = await run_render_bench(args or None, repeat)
+    path = await save_render_bench_result(result)
+    return await ctx.asend_reply_msg(f"{format_render_bench_result(result)}\n结果已保存到 {osp.abspath(path)}")
@@ -149,7 +149,7 @@ async def compose_score_control_image(ctx: SekaiHandlerContext, target_point: in
     meta = find_by(await musicmetas_json.get(), "music_id", music_id)
     assert_and_reply(meta, f"找不到歌曲ID={music_id}的基础分数据")
     music_basic_score = int(meta['event_rate'])
-    valid_scores = await run_in_pool(get_valid_scores, target_point, music_basic_score)
+    valid_scores = await run_in_pool(get_valid_scores, target_point, music_basic_score, kind='cpu')
     valid_scores.sort(key=lambda x: (x.event_bonus, x.boost))
     valid_scores = valid_scores[:MAX_SHOW_NUM]
     if len(valid_scores) == 0:
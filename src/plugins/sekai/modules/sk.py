@@ -160,11 +160,10 @@ async def get_latest_ranking(ctx: SekaiHandlerContext, event_id: int, query_rank
     # 从API获取
     assert_and_reply(get_gameapi_config(ctx).ranking_api_url, f"暂不支持获取{ctx.region}榜线数据")
     url = get_gameapi_config(ctx).ranking_api_url.format(event_id=event_id % 1000)
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, verify_ssl=False) as resp:
-            if resp.status != 200:
-                raise Exception(f"{resp.status}: {await resp.text()}")
-            data = await resp.json()
+    async with http_session_mgr.get(url) as resp:
+        if resp.status != 200:
+            raise Exception(f"{resp.status}: {await resp.text()}")
+        data = await resp.json()
     assert_and_reply(data, "获取榜线数据失败")
     logger.info(f"从API获取 {ctx.region}_{event_id} 最新榜线数据")
     return [r for r in await parse_rankings(ctx, event_id, data, False) if r.rank in query_ranks]
@@ -898,6 +897,7 @@ pjsk_skp = SekaiCmdHandler([
     "/sk预测", "/榜线预测", "/skp",
 ], regions=['jp'], prefix_args=['', 'wl'])
 pjsk_skp.check_cdrate(cd).check_wblist(gbl)
+pjsk_skp.coalesce(ttl=10, user_dependent=False)
 @pjsk_skp.handle()
 async def _(ctx: SekaiHandlerContext):
     args = ctx.get_args().strip() + ctx.prefix_arg
@@ -916,6 +916,7 @@ pjsk_skl = SekaiCmdHandler([
     "/sk线", "/skl",
 ], prefix_args=['', 'wl'])
 pjsk_skl.check_cdrate(cd).check_wblist(gbl)
+pjsk_skl.coalesce(ttl=10, user_dependent=False)
 @pjsk_skl.handle()
 async def _(ctx: SekaiHandlerContext):
     args = ctx.get_args().strip() + ctx.prefix_arg
@@ -950,6 +951,7 @@ pjsk_sks = SekaiCmdHandler([
     "/时速", "/sks", "/skv", "/sk时速",
 ], prefix_args=['', 'wl'])
 pjsk_sks.check_cdrate(cd).check_wblist(gbl)
+pjsk_sks.coalesce(ttl=10, user_dependent=False)
 @pjsk_sks.handle()
 async def _(ctx: SekaiHandlerContext):
     args = ctx.get_args().strip() + ctx.prefix_arg
@@ -971,6 +973,7 @@ pjsk_sk = SekaiCmdHandler([
     "/sk", 
 ], prefix_args=['', 'wl'])
 pjsk_sk.check_cdrate(cd).check_wblist(gbl)
+pjsk_sk.coalesce(ttl=10)
 @pjsk_sk.handle()
 async def _(ctx: SekaiHandlerContext):
     args = ctx.get_args().strip() + ctx.prefix_arg
@@ -1086,11 +1089,10 @@ async def update_ranking():
         async def _get_ranking(ctx: SekaiHandlerContext, eid: int):
             try:
                 url = get_gameapi_config(ctx).ranking_api_url.format(event_id=eid)
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(url, verify_ssl=False) as resp:
-                        if resp.status != 200:
-                            raise Exception(f"{resp.status}: {await resp.text()}")
-                        return ctx.region, eid, await resp.json()
+                async with http_session_mgr.get(url) as resp:
+                    if resp.status != 200:
+                        raise Exception(f"{resp.status}: {await resp.text()}")
+                    return ctx.region, eid, await resp.json()
             except Exception as e:
                 logger.warning(f"获取 {ctx.region} 榜线数据失败: {get_exc_desc(e)}")
                 region_failed[ctx.region] = True
@@ -35,7 +35,7 @@ async def compose_character_all_stamp_image(ctx: SekaiHandlerContext, cid):
     for stamp in await ctx.md.stamps.get():
         if stamp.get('characterId1') == cid or stamp.get('characterId2') == cid:
             stamp_ids.append(stamp['id'])
-    stamp_imgs = await asyncio.gather(*[get_stamp_image(ctx, sid) for sid in stamp_ids])
+    stamp_imgs = await bounded_gather(*[get_stamp_image(ctx, sid) for sid in stamp_ids], adaptive=True)
     stamp_id_imgs = [(sid, img) for sid, img in zip(stamp_ids, stamp_imgs) if img]
 
     with Canvas(bg=DEFAULT_BLUE_GRADIENT_BG).set_padding(BG_PADDING) as canvas:
@@ -6,8 +6,8 @@ from datetime import datetime
 from PIL import Image
 import io
 from ..utils import *
-from .draw import draw_all, reset_jieba, draw_date_count_plot, draw_word_count_plot, draw_all_long
-from ..record.sql import query_msg_by_range, query_msg_count
+from .draw import draw_all, reset_jieba, draw_date_count_plot, draw_word_count_plot, draw_all_long, LongStatAggregator
+from ..record.sql import query_msg_by_range, iter_msg_by_range, query_daily_msg_count, query_user_msg_count, query_term_count
 
 
 config = get_config("statistics")
@@ -35,19 +35,20 @@ async def get_day_statistic(bot, group_id, date=None):
     if date is None: date = datetime.now().strftime("%Y-%m-%d")
     start_time = datetime.strptime(date, "%Y-%m-%d").strftime("%Y-%m-%d 00:00:00")
     end_time   = datetime.strptime(date, "%Y-%m-%d").strftime("%Y-%m-%d 23:59:59")
-    recs = await query_msg_by_range(group_id, 
-                     datetime.strptime(start_time, "%Y-%m-%d %H:%M:%S"), 
-                     datetime.strptime(end_time, "%Y-%m-%d %H:%M:%S"))
-    logger.info(f'获取{date}的统计图: 共获取到{len(recs)}条消息')
-    if len(recs) == 0: return f"{date} 的消息记录为空"
+    start_time = datetime.strptime(start_time, "%Y-%m-%d %H:%M:%S")
+    end_time   = datetime.strptime(end_time, "%Y-%m-%d %H:%M:%S")
     # 统计发言数
-    user_count = Counter()
-    for rec in recs: user_count.inc(rec['user_id'])
+    user_count = await query_user_msg_count(group_id, start_time, end_time)
+    if len(user_count) == 0: return f"{date} 的消息记录为空"
+    recs = await query_msg_by_range(group_id, start_time, end_time)
+    logger.info(f'获取{date}的统计图: 共获取到{len(recs)}条消息')
     sorted_user_count = sorted(user_count.items(), key=lambda x: x[1], reverse=True)
     # 计算出需要的topk
     need_k = len(sorted_user_count)
     topk_user = [user for user, _ in sorted_user_count[:need_k]]
-    # 获取topk的名字
+    # 获取topk的名字（批量加载群成员目录）
+    try: await group_directory.load_members(bot, group_id)
+    except: logger.print_exc(f'加载群 {group_id} 成员目录失败')
     topk_name = []
     for user in topk_user:
         try:
@@ -57,7 +58,10 @@ async def get_day_statistic(bot, group_id, date=None):
             topk_name.append(str(user))
     # 画图
     path = PLOT_PATH + f"plot_{group_id}.png"
-    await run_in_pool(draw_all, group_id, recs, PLOT_INTERVAL, PLOT_TOPK1, PLOT_TOPK2, topk_user, topk_name, path, date)
+    await run_in_pool(
+        draw_all, group_id, recs, PLOT_INTERVAL, PLOT_TOPK1, PLOT_TOPK2, topk_user, topk_name, path, date,
+        file_db.get("userwords", []), file_db.get("stopwords", []), kind='plt',
+    )
     # 发送图片
     return await get_image_cq(path)
 
@@ -67,19 +71,23 @@ async def get_long_statistic(bot, group_id, start_date: datetime, end_date: date
     end_time   = end_date.strftime("%Y-%m-%d 23:59:59")
     start_time = datetime.strptime(start_time, "%Y-%m-%d %H:%M:%S")
     end_time   = datetime.strptime(end_time, "%Y-%m-%d %H:%M:%S")
-    recs = await query_msg_by_range(group_id, start_time, end_time)
-    logger.info(f'绘制从{start_date}到{end_date}的长时间统计图: 共获取到{len(recs)}条消息')
-
-    if len(recs) == 0: return f"从{start_date}到{end_date}的消息记录为空"
 
     # 统计发言数
-    user_count = Counter()
-    for rec in recs: user_count.inc(rec['user_id'])
+    user_count = await query_user_msg_count(group_id, start_time, end_time)
+    if len(user_count) == 0: return f"从{start_date}到{end_date}的消息记录为空"
+    # 分块读取消息并增量聚合，不同时持有所有消息
+    agg = LongStatAggregator(PLOT_INTERVAL)
+    async for recs in iter_msg_by_range(group_id, start_time, end_time, columns=['time', 'user_id', 'content']):
+        await run_in_pool(agg.add, recs)
+    logger.info(f'绘制从{start_date}到{end_date}的长时间统计图: 共获取到{agg.total}条消息')
+
     sorted_user_count = sorted(user_count.items(), key=lambda x: x[1], reverse=True)
     # 计算出需要的topk
     need_k = len(sorted_user_count)
     topk_user = [user for user, _ in sorted_user_count[:need_k]]
-    # 获取topk的名字
+    # 获取topk的名字（批量加载群成员目录）
+    try: await group_directory.load_members(bot, group_id)
+    except: logger.print_exc(f'加载群 {group_id} 成员目录失败')
     topk_name = []
     for user in topk_user:
         try:
@@ -90,7 +98,10 @@ async def get_long_statistic(bot, group_id, start_date: datetime, end_date: date
     # 画图
     path = PLOT_PATH + f"plot_{group_id}.png"
     date = f"{start_date.strftime('%Y-%m-%d')}~{end_date.strftime('%Y-%m-%d')}"
-    await run_in_pool(draw_all_long, group_id, recs, PLOT_INTERVAL, PLOT_TOPK1, PLOT_TOPK2, topk_user, topk_name, path, date)
+    await run_in_pool(
+        draw_all_long, group_id, agg, PLOT_INTERVAL, PLOT_TOPK1, PLOT_TOPK2, topk_user, topk_name, path, date,
+        file_db.get("userwords", []), file_db.get("stopwords", []), kind='plt',
+    )
     # 发送图片
     return await get_image_cq(path)
 
@@ -99,23 +110,20 @@ async def get_date_count_statistic(bot, group_id, days, user_id=None):
     t = datetime.now()
     dates, counts = [], []
     user_counts = None if user_id is None else []
+    # 按天的消息数从聚合表一次性获取
+    start_time = datetime.strptime((t - timedelta(days=days - 1)).strftime("%Y-%m-%d"), "%Y-%m-%d")
+    end_time   = datetime.strptime(t.strftime("%Y-%m-%d 23:59:59"), "%Y-%m-%d %H:%M:%S")
+    date_counts = await query_daily_msg_count(group_id, start_time, end_time)
+    if user_id is not None:
+        user_date_counts = await query_daily_msg_count(group_id, start_time, end_time, int(user_id))
     for i in range(days):
         date = (t - timedelta(days=i)).strftime("%Y-%m-%d")
-        start_time = datetime.strptime(date, "%Y-%m-%d").strftime("%Y-%m-%d 00:00:00")
-        end_time   = datetime.strptime(date, "%Y-%m-%d").strftime("%Y-%m-%d 23:59:59")
-        cnt = await query_msg_count(group_id, 
-                         datetime.strptime(start_time, "%Y-%m-%d %H:%M:%S"), 
-                         datetime.strptime(end_time, "%Y-%m-%d %H:%M:%S"))
         if user_id is not None:
-            user_cnt = await query_msg_count(group_id,
-                                datetime.strptime(start_time, "%Y-%m-%d %H:%M:%S"), 
-                                datetime.strptime(end_time, "%Y-%m-%d %H:%M:%S"),
-                                user_id)
-            user_counts.append(user_cnt)
-        dates.append(datetime.strptime(start_time, "%Y-%m-%d %H:%M:%S"))
-        counts.append(cnt)
+            user_counts.append(user_date_counts.get(date, 0))
+        dates.append(datetime.strptime(date, "%Y-%m-%d"))
+        counts.append(date_counts.get(date, 0))
     save_path = PLOT_PATH + f"plot_{group_id}_date_count.jpg"
-    draw_date_count_plot(dates, counts, save_path, user_counts)
+    await run_in_pool(draw_date_count_plot, dates, counts, save_path, user_counts, kind='plt')
     return await get_image_cq(save_path)
 
 # 获取某个词的统计图
@@ -125,19 +133,19 @@ async def get_word_statistic(bot, group_id, days, word):
     dates = []
     user_counts = Counter()
     user_date_counts = [Counter() for _ in range(days)]
+    # 通过全文索引一次性获取每天每个用户包含关键词的消息数
+    start_time = datetime.strptime((t - timedelta(days=days - 1)).strftime("%Y-%m-%d"), "%Y-%m-%d")
+    end_time   = datetime.strptime(t.strftime("%Y-%m-%d 23:59:59"), "%Y-%m-%d %H:%M:%S")
+    term_counts = await query_term_count(group_id, words, start_time, end_time)
+    date_index = {}
     for i in range(days):
         date = (t - timedelta(days=i)).strftime("%Y-%m-%d")
-        start_time = datetime.strptime(date, "%Y-%m-%d").strftime("%Y-%m-%d 00:00:00")
-        end_time   = datetime.strptime(date, "%Y-%m-%d").strftime("%Y-%m-%d 23:59:59")
-        msgs = await query_msg_by_range(group_id,
-                         datetime.strptime(start_time, "%Y-%m-%d %H:%M:%S"), 
-                         datetime.strptime(end_time, "%Y-%m-%d %H:%M:%S"))
-        for msg in msgs:
-            text = extract_text(msg['msg'])
-            if any([word in text for word in words]):
-                user_counts.inc(str(msg['user_id']))
-                user_date_counts[i].inc(str(msg['user_id']))
-        dates.append(datetime.strptime(start_time, "%Y-%m-%d %H:%M:%S"))
+        date_index[date] = i
+        dates.append(datetime.strptime(date, "%Y-%m-%d"))
+    for (date, user_id), cnt in term_counts.items():
+        if date not in date_index: continue
+        user_counts.inc(str(user_id), cnt)
+        user_date_counts[date_index[date]].inc(str(user_id), cnt)
     sorted_user_counts = sorted(user_counts.items(), key=lambda x: x[1], reverse=True)
     topk_user = [str(user) for user, _ in sorted_user_counts[:STA_WORD_TOPK]]
     topk_name = []
@@ -148,7 +156,7 @@ async def get_word_statistic(bot, group_id, days, word):
         except:
             topk_name.append(str(user))
     save_path = PLOT_PATH + f"plot_{group_id}_word_count.jpg"
-    draw_word_count_plot(dates, topk_user, topk_name, user_counts, user_date_counts, word, save_path)
+    await run_in_pool(draw_word_count_plot, dates, topk_user, topk_name, user_counts, user_date_counts, word, save_path, kind='plt')
     return await get_image_cq(save_path)
 
 # ------------------------------------------------ 聊天逻辑 ------------------------------------------------
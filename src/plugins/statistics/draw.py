@@ -64,21 +64,21 @@ def get_cmap(gid, date, n=10, hue_range=0.2):
 
 # 绘制饼图
 def draw_pie(gid, date_str, recs, topk_user, topk_name):
+    user_count, user_image_count = Counter(), Counter()
+    for rec in recs:
+        user_count.inc(rec['user_id'])
+        if has_image(rec['msg']):
+            user_image_count.inc(rec['user_id'])
+    return draw_pie_by_counts(gid, date_str, user_count, user_image_count, topk_user, topk_name)
+
+# 由每个用户的消息数和图片消息数绘制饼图
+def draw_pie_by_counts(gid, date_str, user_count: Counter, user_image_count: Counter, topk_user, topk_name):
     logger.info(f"开始绘制饼图")
 
     # 统计数量
     topk_user_set = set(topk_user)
-    user_count, user_image_count = Counter(), Counter()
-    other_count, other_image_count = 0, 0
-    for rec in recs:
-        if rec['user_id'] not in topk_user_set:
-            other_count += 1
-            if has_image(rec['msg']):
-                other_image_count += 1
-        else:
-            user_count.inc(rec['user_id'])
-            if has_image(rec['msg']):
-                user_image_count.inc(rec['user_id'])
+    other_count = sum(cnt for user, cnt in user_count.items() if user not in topk_user_set)
+    other_image_count = sum(cnt for user, cnt in user_image_count.items() if user not in topk_user_set)
 
     topk_user_count = [user_count.get(user) for user in topk_user]
     topk_user_image_count = [user_image_count.get(user) for user in topk_user]
@@ -189,6 +189,10 @@ def draw_plot(gid, date_str, ax, recs, interval, topk_user, topk_name):
         if has_image(rec['msg']):
             img_all[index] += 1
 
+    draw_time_count_bars(ax, interval, all, img_all)
+
+# 由每个时间段的消息数和图片消息数绘制一天内的分布柱状图
+def draw_time_count_bars(ax, interval, all, img_all):
     x = [datetime.strptime("00:00", "%H:%M") + timedelta(minutes=interval*i) for i in range(int(24*60/interval))]
 
     ax.bar(x[1:-1], all[1:-1], width=timedelta(minutes=interval), align='edge', color='#bbbbbb', label='消息数')
@@ -207,49 +211,62 @@ def draw_plot(gid, date_str, ax, recs, interval, topk_user, topk_name):
     plt.legend(fontsize=8)
 
 last_userwords = []
+last_stopwords = []
 jieba_inited = False
 
-# jieba重置（用户词典）
-def reset_jieba():
-    global last_userwords, jieba_inited
+# 规范处理用户词和停用词
+def normalize_jieba_words(userwords: List[str], stopwords: List[str]) -> Tuple[List[str], List[str]]:
+    userwords = [word.strip() for word in userwords if word not in stopwords and word.strip() != ""]
+    stopwords = [word.strip() for word in stopwords if word.strip() != ""]
+    return list(set(userwords)), list(set(stopwords))
+
+# 将用户词设置给jieba，只修改内存中的词典
+def load_jieba_words(userwords: List[str], stopwords: List[str]):
+    global last_userwords, last_stopwords, jieba_inited
     jieba.initialize()
     # 清空上次添加的用户词
     for word in last_userwords: jieba.del_word(word)
-    # 读取用户词和停用词并且规范处理
-    userwords = file_db.get("userwords", [])
-    stopwords = file_db.get("stopwords", [])
-    userwords = [word.strip() for word in userwords if word not in stopwords and word.strip() != ""]
-    stopwords = [word.strip() for word in stopwords if word.strip() != ""]
-    userwords = list(set(userwords))
-    stopwords = list(set(stopwords))
     userwords_str = "\n".join([f'{word} n' for word in userwords])
-    file_db.set("stopwords", stopwords)
-    file_db.set("userwords", userwords)
-    # 用户词设置给jieba
-    userwords_file = io.StringIO(userwords_str)
-    jieba.load_userdict(userwords_file)
-    last_userwords = userwords
+    jieba.load_userdict(io.StringIO(userwords_str))
+    last_userwords, last_stopwords = userwords, stopwords
     jieba_inited = True
     logger.info(f'jieba已重置 用户词数:{len(userwords)} 停用词数:{len(stopwords)}')
 
+# jieba重置（用户词典），在主进程中读取并规范处理用户词和停用词
+def reset_jieba():
+    userwords, stopwords = normalize_jieba_words(file_db.get("userwords", []), file_db.get("stopwords", []))
+    file_db.set("stopwords", stopwords)
+    file_db.set("userwords", userwords)
+    load_jieba_words(userwords, stopwords)
+
 # jieba初始化
 def init_jieba():
     global jieba_inited
     if not jieba_inited: reset_jieba()
 
+# 在绘图进程中同步主进程的用户词和停用词，只更新内存中的词典，file_db只由主进程写入
+def sync_jieba_words(userwords: List[str], stopwords: List[str]):
+    userwords, stopwords = normalize_jieba_words(userwords, stopwords)
+    if not jieba_inited or set(userwords) != set(last_userwords) or set(stopwords) != set(last_stopwords):
+        load_jieba_words(userwords, stopwords)
+
 # 绘制词云图 返回图片和前WORD_TOPK个词的前WORD_USER_TOPK个用户以及他们的比例文本
 def draw_wordcloud(gid, date_str, recs, users, names) -> Tuple[Image.Image, str]:
+    texts = ((rec['user_id'], extract_text(rec['msg'])) for rec in recs)
+    return draw_wordcloud_by_texts(gid, date_str, texts, users, names)
+
+# 由 (用户, 文本) 绘制词云图
+def draw_wordcloud_by_texts(gid, date_str, texts, users, names) -> Tuple[Image.Image, str]:
     logger.info(f"开始绘制词云图")
     init_jieba()
 
-    userwords = set(file_db.get("userwords", []))
-    stopwords = set(file_db.get("stopwords", []))
+    userwords = set(last_userwords)
+    stopwords = set(last_stopwords)
 
     all_words = { " ": 1 }
     word_user_count = {} # word_user_count[word][user] = count
 
-    for rec in recs:
-        msg = extract_text(rec['msg'])
+    for user, msg in texts:
         words = pseg.cut(msg)
         nouns = []
         for word, flag in words:
@@ -262,7 +279,6 @@ def draw_wordcloud(gid, date_str, recs, users, names) -> Tuple[Image.Image, str]
                 all_words[noun] = 0
                 word_user_count[noun] = {}
             all_words[noun] += 1
-            user = rec['user_id']
             if user not in word_user_count[noun]:
                 word_user_count[noun][user] = 0
             word_user_count[noun][user] += 1
@@ -340,8 +356,10 @@ def draw_wordcloud(gid, date_str, recs, users, names) -> Tuple[Image.Image, str]
 
 
 # 绘制所有图
-def draw_all(gid, recs, interval, topk1, topk2, user, name, path, date_str):
+def draw_all(gid, recs, interval, topk1, topk2, user, name, path, date_str, userwords=None, stopwords=None):
     logger.info(f"开始绘制所有图到{path}")
+    if userwords is not None:
+        sync_jieba_words(userwords, stopwords or [])
     plt.subplots_adjust(wspace=0.0, hspace=0.0)
 
     pie_image = draw_pie(gid, date_str, recs, user[:topk1], name[:topk1])
@@ -433,59 +451,77 @@ def draw_word_count_plot(dates, topk_user, topk_name, user_counts, user_date_cou
 
 
 # 绘制长时间统计的群总聊天数关于时间的折线图
-def draw_long_sta_date_count_plot(gid, date_str, ax: plt.Axes, topk_user, topk_name, recs):
+def draw_long_sta_date_count_plot(gid, date_str, ax: plt.Axes, dates, counts):
     logger.info(f"开始绘制长时间统计的群总聊天数关于时间的折线图")
 
-    # 计算起止时间
-    start_date = recs[0]['time']
-    end_date = recs[-1]['time']
-    dates = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
-
-    # 计算每日消息数
-    counts = [0] * len(dates)
-    for rec in recs:
-        date = rec['time']
-        index = (date - start_date).days
-        counts[index] += 1
-
-    # 计算topk用户的每日消息数
-    user_counts = [[0] * len(dates) for _ in range(len(topk_user))]
-    for rec in recs:
-        user_id = rec['user_id']
-        if user_id not in topk_user: continue
-        date = rec['time']
-        index = (date - start_date).days
-        user_counts[topk_user.index(user_id)][index] += 1
-
     # 绘制图
-    # cmap = get_cmap(gid, date_str)
     ax.bar(dates, counts, label='日消息数', color='#bbbbbb', width=1)
-    # for i in range(len(topk_user)):
-    #     ax.plot(dates, user_counts[i], label=topk_name[i], color=cmap[i])
 
     ax.xaxis.set_major_locator(mdates.AutoDateLocator())
     ax.xaxis.set_major_formatter(mdates.DateFormatter('%m-%d'))
     ax.legend(fontsize=8)
 
 
+class LongStatAggregator:
+    """
+    长时间统计的增量聚合，按块消费消息记录后只保留计数和文本，传给绘图进程代替完整的消息记录
+    """
+    def __init__(self, interval: int):
+        self.interval = interval
+        self.total = 0
+        self.user_count = Counter()
+        self.user_image_count = Counter()
+        self.time_counts = [0] * int(24*60/interval)
+        self.time_image_counts = [0] * int(24*60/interval)
+        self.date_counts: Dict[datetime, int] = {}
+        self.texts: List[Tuple[int, str]] = []
+
+    def add(self, recs: List[dict]):
+        for rec in recs:
+            user, time, msg = rec['user_id'], rec['time'], rec['msg']
+            image = has_image(msg)
+            index = int((time.hour * 60 + time.minute) / self.interval)
+            date = datetime(time.year, time.month, time.day)
+            self.total += 1
+            self.user_count.inc(user)
+            self.time_counts[index] += 1
+            self.date_counts[date] = self.date_counts.get(date, 0) + 1
+            if image:
+                self.user_image_count.inc(user)
+                self.time_image_counts[index] += 1
+            text = extract_text(msg)
+            if text:
+                self.texts.append((user, text))
+
+    # 获取连续的每日消息数 (日期, 消息数)
+    def get_date_counts(self) -> Tuple[List[datetime], List[int]]:
+        if not self.date_counts:
+            return [], []
+        start_date, end_date = min(self.date_counts), max(self.date_counts)
+        dates = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+        return dates, [self.date_counts.get(date, 0) for date in dates]
+
+
 # 绘制所有图（长时间统计版本）
-def draw_all_long(gid, recs, interval, topk1, topk2, user, name, path, date_str):
+def draw_all_long(gid, agg: LongStatAggregator, interval, topk1, topk2, user, name, path, date_str, userwords=None, stopwords=None):
     logger.info(f"开始绘制所有图到{path}")
+    if userwords is not None:
+        sync_jieba_words(userwords, stopwords or [])
     plt.subplots_adjust(wspace=0.0, hspace=0.0)
 
-    pie_image = draw_pie(gid, date_str, recs, user[:topk1], name[:topk1])
+    pie_image = draw_pie_by_counts(gid, date_str, agg.user_count, agg.user_image_count, user[:topk1], name[:topk1])
 
     fig, ax = plt.subplots(figsize=(8, 4), nrows=1, ncols=1)
     fig.tight_layout()
-    draw_plot(gid, date_str, ax, recs, interval, user[:topk2], name[:topk2])
+    draw_time_count_bars(ax, agg.interval, agg.time_counts, agg.time_image_counts)
     plot_image = plt_fig_to_image(fig)
 
     fig, ax = plt.subplots(figsize=(8, 5), nrows=1, ncols=1)
     fig.tight_layout()
-    draw_long_sta_date_count_plot(gid, date_str, ax, user[:topk2], name[:topk2], recs)
+    draw_long_sta_date_count_plot(gid, date_str, ax, *agg.get_date_counts())
     date_count_image = plt_fig_to_image(fig)
 
-    wordcloud_image, word_rank_text = draw_wordcloud(gid, date_str, recs, user, name)
+    wordcloud_image, word_rank_text = draw_wordcloud_by_texts(gid, date_str, agg.texts, user, name)
 
     c1, c2 = get_theme_color_info(gid, date_str)["colors"]
     bg_color = LinearGradient(c1=c1, c2=c2, p1=(1, 1), p2=(0, 0))
@@ -493,7 +529,7 @@ def draw_all_long(gid, recs, interval, topk1, topk2, user, name, path, date_str)
         with VSplit().set_sep(10).set_padding(10):
             bg = RoundRectBg(fill=(255, 255, 255, 200), radius=10)
 
-            title = TextBox(f"{date_str} 群聊消息统计 总消息数: {len(recs)}条")
+            title = TextBox(f"{date_str} 群聊消息统计 总消息数: {agg.total}条")
             title.set_bg(bg).set_padding(10).set_w(850 + 850 + 10)
             title.set_style(TextStyle(size=24, color=(0, 0, 0, 255), font=DEFAULT_FONT))
 
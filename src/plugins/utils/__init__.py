@@ -2,10 +2,10 @@ import orjson
 import yaml
 from datetime import datetime, timedelta
 import traceback
-from nonebot import on_command, get_bot, on, get_driver
+from nonebot import on_command, get_bot, on, get_driver, on_notice
 from nonebot.matcher import Matcher
 from nonebot.rule import to_me as rule_to_me
-from nonebot.adapters.onebot.v11 import GroupMessageEvent, Bot, MessageSegment, MessageEvent, PrivateMessageEvent
+from nonebot.adapters.onebot.v11 import GroupMessageEvent, Bot, MessageSegment, MessageEvent, PrivateMessageEvent, NoticeEvent
 from nonebot.adapters.onebot.v11.message import Message as OutMessage
 import os
 import os.path as osp
@@ -26,6 +26,7 @@ from PIL import Image, ImageDraw, ImageFont, ImageSequence
 import re
 from .plot import *
 from .img_utils import *
+from .profile import *
 import math
 import requests
 require("nonebot_plugin_apscheduler")
@@ -39,6 +40,7 @@ from uuid import uuid4
 import decord
 import emoji
 from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import concurrent.futures
 from selenium import webdriver
 from selenium.webdriver.firefox.service import Service
 from selenium.webdriver.firefox.options import Options
@@ -48,6 +50,11 @@ import time
 import uvloop
 import signal
 import sys
+import threading
+import contextvars
+from contextlib import asynccontextmanager, contextmanager
+from urllib.parse import urlparse
+from collections import OrderedDict, deque
 
 asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
@@ -129,10 +136,9 @@ def get_image_b64(image: Image.Image):
     """
     转化PIL图片为带 "data:image/jpeg;base64," 前缀的base64
     """
-    with TempFilePath('jpg') as tmp_path:
-        image.convert('RGB').save(tmp_path, "JPEG")
-        with open(tmp_path, "rb") as f:
-            return f"data:image/jpeg;base64,{base64.b64encode(f.read()).decode('utf-8')}"
+    buf = io.BytesIO()
+    image.convert('RGB').save(buf, "JPEG")
+    return f"data:image/jpeg;base64,{base64.b64encode(buf.getvalue()).decode('utf-8')}"
 
 # 下载并编码图片为base64
 async def download_image_to_b64(image_path):
@@ -228,18 +234,149 @@ def plt_fig_to_image(fig, transparent=True) -> Image.Image:
     return img
 
 
+HTTP_CONFIG = get_config('http')
+
+# 每个host的请求统计
+@dataclass
+class HttpHostStats:
+    requests: int = 0
+    errors: int = 0
+    new_conns: int = 0
+    reused_conns: int = 0
+    total_latency: float = 0.
+    max_latency: float = 0.
+
+    def get_reuse_ratio(self) -> float:
+        total = self.new_conns + self.reused_conns
+        return self.reused_conns / total if total else 0.
+
+    def get_avg_latency(self) -> float:
+        return self.total_latency / self.requests if self.requests else 0.
+
+# 进程共享的HTTP会话管理，复用连接池、DNS缓存，并限制每个host的并发
+class HttpSessionManager:
+    def __init__(self, config: Dict[str, Any]):
+        self.limit = config.get('limit', 100)                       # 总连接数上限
+        self.limit_per_host = config.get('limit_per_host', 16)      # 每个host的连接数上限
+        self.dns_cache_ttl = config.get('dns_cache_ttl', 300)       # DNS缓存时间（秒）
+        self.keepalive_timeout = config.get('keepalive_timeout', 30)
+        self.timeout = config.get('timeout', 300)                   # 默认请求超时（秒）
+        self.host_configs: Dict[str, Dict[str, Any]] = config.get('hosts', {}) or {}
+        self.session: aiohttp.ClientSession = None
+        self.host_sems: Dict[str, asyncio.Semaphore] = {}
+        self.host_stats: Dict[str, HttpHostStats] = {}
+
+    def _get_host_stats(self, host: str) -> HttpHostStats:
+        if host not in self.host_stats:
+            self.host_stats[host] = HttpHostStats()
+        return self.host_stats[host]
+
+    def _get_host_sem(self, host: str) -> asyncio.Semaphore:
+        if host not in self.host_sems:
+            concurrency = self.host_configs.get(host, {}).get('concurrency', self.limit_per_host)
+            self.host_sems[host] = asyncio.Semaphore(concurrency)
+        return self.host_sems[host]
+
+    def _get_trace_config(self) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+        async def on_create(session, ctx, params):
+            self._get_host_stats((ctx.trace_request_ctx or {}).get('host', '')).new_conns += 1
+        async def on_reuse(session, ctx, params):
+            self._get_host_stats((ctx.trace_request_ctx or {}).get('host', '')).reused_conns += 1
+        trace_config.on_connection_create_end.append(on_create)
+        trace_config.on_connection_reuseconn.append(on_reuse)
+        return trace_config
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.dns_cache_ttl,
+                use_dns_cache=True,
+                keepalive_timeout=self.keepalive_timeout,
+                ssl=False,
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector, 
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                trace_configs=[self._get_trace_config()],
+            )
+            utils_logger.info(f'创建HTTP会话 limit={self.limit} limit_per_host={self.limit_per_host}')
+        return self.session
+
+    @asynccontextmanager
+    async def request(self, method: str, url: str, timeout: float = None, **kwargs):
+        """
+        发起请求，返回aiohttp响应的异步上下文，响应需要在上下文内读取
+        `timeout` 为None时使用host配置或默认超时，为0时不限制超时
+        """
+        host = urlparse(url).hostname or ''
+        if timeout is None:
+            timeout = self.host_configs.get(host, {}).get('timeout', self.timeout)
+        stats = self._get_host_stats(host)
+        session = self.get_session()
+        async with self._get_host_sem(host):
+            with profile_span('fetch'):
+                start = time.perf_counter()
+                try:
+                    async with session.request(
+                        method, url, 
+                        timeout=aiohttp.ClientTimeout(total=timeout or None), 
+                        trace_request_ctx={'host': host}, 
+                        **kwargs
+                    ) as resp:
+                        yield resp
+                except:
+                    stats.errors += 1
+                    raise
+                finally:
+                    latency = time.perf_counter() - start
+                    stats.requests += 1
+                    stats.total_latency += latency
+                    stats.max_latency = max(stats.max_latency, latency)
+
+    def get(self, url: str, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def get_open_conn_num(self) -> Tuple[int, int]:
+        """
+        获取(使用中, 空闲)的连接数量
+        """
+        if self.session is None or self.session.closed:
+            return 0, 0
+        connector = self.session.connector
+        acquired = len(getattr(connector, '_acquired', []))
+        idle = sum(len(conns) for conns in getattr(connector, '_conns', {}).values())
+        return acquired, idle
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+http_session_mgr = HttpSessionManager(HTTP_CONFIG)
+
+# 关闭时释放连接
+@get_driver().on_shutdown
+async def _():
+    await http_session_mgr.close()
+
+
 # 下载图片 返回PIL.Image对象
 @retry(stop=stop_after_attempt(3), wait=wait_fixed(1), reraise=True)
 async def download_image(image_url, force_http=True) -> Image.Image:
     if force_http and image_url.startswith("https"):
         image_url = image_url.replace("https", "http")
-    async with aiohttp.ClientSession() as session:
-        async with session.get(image_url, verify_ssl=False) as resp:
-            if resp.status != 200:
-                utils_logger.error(f"下载图片 {image_url} 失败: {resp.status} {resp.reason}")
-                raise HttpError(resp.status, f"下载图片 {image_url} 失败")
-            image = await resp.read()
-            return Image.open(io.BytesIO(image))
+    async with http_session_mgr.get(image_url) as resp:
+        if resp.status != 200:
+            utils_logger.error(f"下载图片 {image_url} 失败: {resp.status} {resp.reason}")
+            raise HttpError(resp.status, f"下载图片 {image_url} 失败")
+        image = await resp.read()
+        return Image.open(io.BytesIO(image))
 
 
 WEB_DRIVER_NUM = 2
@@ -335,12 +472,11 @@ async def markdown_to_image(markdown_text: str, width: int = 600) -> Image.Image
 # 下载文件到本地路径
 @retry(stop=stop_after_attempt(3), wait=wait_fixed(1), reraise=True)
 async def download_file(url, file_path):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, verify_ssl=False) as resp:
-            if resp.status != 200:
-                raise Exception(f"下载文件 {url} 失败: {resp.status} {resp.reason}")
-            with open(file_path, 'wb') as f:
-                f.write(await resp.read())
+    async with http_session_mgr.get(url) as resp:
+        if resp.status != 200:
+            raise Exception(f"下载文件 {url} 失败: {resp.status} {resp.reason}")
+        with open(file_path, 'wb') as f:
+            f.write(await resp.read())
 
 class TempDownloadFilePath:
     def __init__(self, url, ext: str = None):
@@ -514,6 +650,9 @@ class FileDB:
         dump_json(self.data, self.path)
         self.logger.debug(f'保存数据库 {self.path}')
 
+    def flush(self):
+        pass
+
     def get(self, key, default=None):
         return deepcopy(self.data.get(key, default))
 
@@ -528,13 +667,160 @@ class FileDB:
             del self.data[key]
             self.save()
 
-_file_dbs = {}
-def get_file_db(path, logger) -> FileDB:
+
+FILE_DB_CONFIG = get_config('file_db')
+FILE_DB_MODE = FILE_DB_CONFIG.get('mode', 'journal')                        # json: 每次写入全量保存 journal: 追加日志+批量刷新
+FILE_DB_FLUSH_INTERVAL = FILE_DB_CONFIG.get('flush_interval', 3)            # 日志刷新间隔（秒）
+FILE_DB_FLUSH_THRESHOLD = FILE_DB_CONFIG.get('flush_threshold', 256)        # 待写入数量超过多少立即刷新
+FILE_DB_COMPACT_THRESHOLD = FILE_DB_CONFIG.get('compact_threshold', 2000)   # 日志条数超过多少时合并到快照
+
+# 日志文件数据库：内存中保存数据，写入追加到日志文件并批量刷新，定期合并到json快照
+# 每条日志带有递增的序号，快照中记录合并时的序号，加载时跳过不大于该序号的日志，替换快照后删除日志前崩溃也不会重放旧值
+class JournaledFileDB(FileDB):
+    SEQ_KEY = '__journal_seq__'
+
+    def __init__(self, path, logger, flush_threshold=None, compact_threshold=None):
+        self.journal_path = path + '.journal'
+        self.flush_threshold = flush_threshold or FILE_DB_FLUSH_THRESHOLD
+        self.compact_threshold = compact_threshold or FILE_DB_COMPACT_THRESHOLD
+        self.pending: Dict[str, bool] = {}   # key -> 是否为删除操作
+        self.journal_count = 0
+        self.seq = 0                          # 已写入日志的最大序号
+        self.flush_scheduled = False
+        self.lock = threading.RLock()         # 保护内存数据和待写入队列
+        self.io_lock = threading.RLock()      # 保证日志追加和合并按顺序进行
+        super().__init__(path, logger)
+
+    def load(self):
+        super().load()
+        snapshot_seq = self.data.pop(self.SEQ_KEY, 0)
+        self.seq = snapshot_seq
+        # 重放日志，跳过崩溃时写入不完整的行和已经合并到快照中的记录
+        self.journal_count = 0
+        if not os.path.exists(self.journal_path):
+            return
+        corrupted = False
+        with open(self.journal_path, 'rb') as f:
+            for line in f:
+                try:
+                    op = orjson.loads(line)
+                except:
+                    self.logger.warning(f'数据库日志 {self.journal_path} 存在损坏的记录，已跳过')
+                    corrupted = True
+                    continue
+                seq = op.get('s', 0)
+                if seq and seq <= snapshot_seq:
+                    continue
+                if op.get('d'):
+                    self.data.pop(op['k'], None)
+                else:
+                    self.data[op['k']] = op['v']
+                self.seq = max(self.seq, seq)
+                self.journal_count += 1
+        self.logger.debug(f'重放数据库日志 {self.journal_path} 共 {self.journal_count} 条')
+        # 存在损坏记录时立即合并，避免后续追加写到不完整的行上
+        if corrupted or self.journal_count >= self.compact_threshold:
+            self.compact()
+
+    def save(self):
+        self.flush()
+
+    def flush(self):
+        with self.io_lock:
+            # 只在取出待写入记录时持有数据锁，写入和fsync期间不阻塞set
+            with self.lock:
+                self.flush_scheduled = False
+                if not self.pending:
+                    return
+                # 同一key的多次写入只记录最后一次
+                ops = []
+                for key, deleted in self.pending.items():
+                    self.seq += 1
+                    ops.append({'k': key, 's': self.seq, 'd': 1} if deleted else {'k': key, 's': self.seq, 'v': self.data[key]})
+                self.pending.clear()
+            try:
+                buffer = b''.join(orjson.dumps(op) + b'\n' for op in ops)
+                create_parent_folder(self.journal_path)
+                with open(self.journal_path, 'ab') as f:
+                    f.write(buffer)
+                    f.flush()
+                    os.fsync(f.fileno())
+            except:
+                # 写入失败时放回队列，之后再次写入的同一key保持较新的操作
+                with self.lock:
+                    for op in ops:
+                        self.pending.setdefault(op['k'], bool(op.get('d')))
+                raise
+            self.journal_count += len(ops)
+            self.logger.debug(f'刷新数据库日志 {self.journal_path}')
+            if self.journal_count >= self.compact_threshold:
+                self.compact()
+
+    def compact(self):
+        with self.io_lock:
+            # 值在写入时已经深拷贝且只会被整体替换，浅拷贝即可得到一致的快照
+            with self.lock:
+                data = dict(self.data)
+            data[self.SEQ_KEY] = self.seq
+            # 先写入临时文件再替换，保证快照完整
+            tmp_path = self.path + '.tmp'
+            dump_json(data, tmp_path)
+            os.replace(tmp_path, self.path)
+            remove_file(self.journal_path)
+            self.journal_count = 0
+            self.logger.debug(f'合并数据库日志到 {self.path}')
+
+    # 待写入数量达到阈值时刷新，在事件循环中时交给线程池执行，避免fsync和合并阻塞事件循环
+    # 调用时不能持有数据锁，刷新需要先获取io_lock
+    def _request_flush(self):
+        with self.lock:
+            if len(self.pending) < self.flush_threshold or self.flush_scheduled:
+                return
+            self.flush_scheduled = True
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return self.flush()
+        run_in_pool_nowait(self.flush)
+
+    def set(self, key, value):
+        self.logger.debug(f'设置数据库 {self.path} {key} = {truncate(str(value), 32)}')
+        with self.lock:
+            self.data[key] = deepcopy(value)
+            self.pending[key] = False
+        self._request_flush()
+
+    def delete(self, key):
+        self.logger.debug(f'删除数据库 {self.path} {key}')
+        with self.lock:
+            if key in self.data:
+                del self.data[key]
+                self.pending[key] = True
+        self._request_flush()
+
+_file_dbs: Dict[str, FileDB] = {}
+def get_file_db(path, logger, mode=None) -> FileDB:
     global _file_dbs
     if path not in _file_dbs:
-        _file_dbs[path] = FileDB(path, logger)
+        mode = mode or FILE_DB_MODE
+        if mode == 'journal':
+            _file_dbs[path] = JournaledFileDB(path, logger)
+        elif mode == 'json':
+            _file_dbs[path] = FileDB(path, logger)
+        else:
+            raise Exception(f'未知的文件数据库模式 {mode}')
     return _file_dbs[path]
 
+# 刷新所有文件数据库
+def flush_all_file_dbs():
+    for db in list(_file_dbs.values()):
+        try:
+            db.flush()
+        except:
+            utils_logger.print_exc(f'刷新数据库 {db.path} 失败')
+
+atexit.register(flush_all_file_dbs)
+
 utils_file_db = get_file_db('data/utils/db.json', utils_logger)
 
 # 计时器
@@ -647,6 +933,13 @@ async def get_msg_obj(bot, message_id):
     return msg_obj
 
 
+# 从消息事件获取消息段，格式与get_msg相同
+def get_msg_from_event(event: MessageEvent) -> List[dict]:
+    msg = [{ 'type': seg.type, 'data': dict(seg.data) } for seg in event.original_message]
+    add_file_unique_for_image(msg)
+    return msg
+
+
 # 获取消息段
 async def get_msg(bot, message_id):
     return (await get_msg_obj(bot, message_id))['message']
@@ -681,24 +974,117 @@ def download_avatar(user_id, circle=False) -> Image.Image:
     return img
 
 
+GROUP_DIRECTORY_CONFIG = get_config('group_directory')
+
+# 群成员名与群名的目录缓存，通过get_group_member_list批量加载，减少逐个查询的API调用
+class GroupDirectory:
+    def __init__(self, member_ttl: int, group_ttl: int):
+        self.member_ttl = member_ttl
+        self.group_ttl = group_ttl
+        self.members: Dict[int, Dict[int, str]] = {}
+        self.member_load_times: Dict[int, float] = {}
+        self.group_names: Dict[int, Tuple[float, str]] = {}
+        self.load_locks: Dict[int, asyncio.Lock] = {}
+        self.hits = 0
+        self.api_calls = 0
+
+    @staticmethod
+    def _get_info_name(info: dict) -> str:
+        return info['card'] if info.get('card') else info['nickname']
+
+    def set_members(self, group_id: int, members: List[dict]):
+        group_id = int(group_id)
+        self.members[group_id] = { int(info['user_id']): self._get_info_name(info) for info in members }
+        self.member_load_times[group_id] = time.time()
+
+    def set_member_name(self, group_id: int, user_id: int, name: str):
+        group_id = int(group_id)
+        if group_id in self.members:
+            self.members[group_id][int(user_id)] = name
+
+    def remove_member(self, group_id: int, user_id: int):
+        self.members.get(int(group_id), {}).pop(int(user_id), None)
+
+    def invalidate(self, group_id: int):
+        self.member_load_times.pop(int(group_id), None)
+        self.group_names.pop(int(group_id), None)
+
+    async def load_members(self, bot, group_id: int, force: bool = False):
+        """
+        批量加载群成员，已加载且未过期时跳过
+        """
+        group_id = int(group_id)
+        if group_id not in self.load_locks:
+            self.load_locks[group_id] = asyncio.Lock()
+        async with self.load_locks[group_id]:
+            if not force and time.time() - self.member_load_times.get(group_id, 0) < self.member_ttl:
+                return
+            self.api_calls += 1
+            members = await bot.call_api('get_group_member_list', **{'group_id': group_id})
+            self.set_members(group_id, members)
+            utils_logger.debug(f'群成员目录 {group_id} 加载完毕 共 {len(members)} 人')
+
+    async def get_member_name(self, bot, group_id: int, user_id: int) -> str:
+        group_id, user_id = int(group_id), int(user_id)
+        await self.load_members(bot, group_id)
+        name = self.members.get(group_id, {}).get(user_id)
+        if name is not None:
+            self.hits += 1
+            return name
+        # 列表中不存在的成员（如刚入群）单独查询
+        self.api_calls += 1
+        info = await bot.call_api('get_group_member_info', **{'group_id': group_id, 'user_id': user_id})
+        name = self._get_info_name(info)
+        self.set_member_name(group_id, user_id, name)
+        return name
+
+    async def get_group_name(self, bot, group_id: int) -> str:
+        group_id = int(group_id)
+        load_time, name = self.group_names.get(group_id, (0, None))
+        if name is not None and time.time() - load_time < self.group_ttl:
+            self.hits += 1
+            return name
+        self.api_calls += 1
+        group_info = await bot.call_api('get_group_info', **{'group_id': group_id})
+        self.group_names[group_id] = (time.time(), group_info['group_name'])
+        return group_info['group_name']
+
+group_directory = GroupDirectory(
+    member_ttl=GROUP_DIRECTORY_CONFIG.get('member_ttl', 60 * 60),
+    group_ttl=GROUP_DIRECTORY_CONFIG.get('group_ttl', 60 * 60),
+)
+
+# 群成员变动时更新目录
+group_directory_notice = on_notice(block=False, priority=-10000)
+@group_directory_notice.handle()
+async def _(bot: Bot, event: NoticeEvent):
+    if event.notice_type == 'group_increase':
+        group_directory.invalidate(event.group_id)
+    elif event.notice_type == 'group_decrease':
+        group_directory.remove_member(event.group_id, event.user_id)
+    elif event.notice_type == 'group_card':
+        card = getattr(event, 'card_new', '')
+        if card:
+            group_directory.set_member_name(event.group_id, event.user_id, card)
+        else:
+            group_directory.invalidate(event.group_id)
+
+
 # 获取群聊中的用户名 如果有群名片则返回群名片 否则返回昵称
 async def get_group_member_name(bot, group_id, user_id):
-    info = await bot.call_api('get_group_member_info', **{'group_id': int(group_id), 'user_id': int(user_id)})
-    if 'card' in info and info['card']:
-        return info['card']
-    else:
-        return info['nickname']
+    return await group_directory.get_member_name(bot, group_id, user_id)
 
 
 # 获取群聊中所有用户
 async def get_group_users(bot, group_id):
-    return await bot.call_api('get_group_member_list', **{'group_id': int(group_id)})
+    members = await bot.call_api('get_group_member_list', **{'group_id': int(group_id)})
+    group_directory.set_members(group_id, members)
+    return members
 
 
 # 获取群聊名
 async def get_group_name(bot, group_id):
-    group_info = await bot.call_api('get_group_info', **{'group_id': int(group_id)})
-    return group_info['group_name']
+    return await group_directory.get_group_name(bot, group_id)
 
 
 # 获取群聊信息
@@ -832,88 +1218,335 @@ def set_group_enable(group_id, enable):
 
 SEND_MSG_DAILY_LIMIT = 4000
 
+# 每日消息发送计数，在内存中计数并定时写回数据库
+class DailySendCounter:
+    def __init__(self, db: FileDB, key: str):
+        self.db = db
+        self.key = key
+        data = db.get(key, {})
+        self.date = data.get('date', '')
+        self.count = data.get('count', 0)
+        self.dirty = False
+
+    def _check_date(self):
+        date = datetime.now().strftime("%Y-%m-%d")
+        if self.date != date:
+            self.date = date
+            self.count = 0
+            self.dirty = True
+
+    def get(self) -> int:
+        self._check_date()
+        return self.count
+
+    def incr(self) -> int:
+        self._check_date()
+        self.count += 1
+        self.dirty = True
+        return self.count
+
+    def flush(self):
+        if self.dirty:
+            self.db.set(self.key, { 'date': self.date, 'count': self.count })
+            self.dirty = False
+
+daily_send_counter = DailySendCounter(utils_file_db, 'send_msg_count')
+atexit.register(daily_send_counter.flush)
+
 # 检查是否超过全局发送消息上限
 def check_send_msg_daily_limit() -> bool:
-    date = datetime.now().strftime("%Y-%m-%d")
-    send_msg_count = utils_file_db.get('send_msg_count', {})
-    count = send_msg_count.get('count', 0)
-    if send_msg_count.get('date', '') != date:
-        send_msg_count = {'date': date, 'count': 0}
-        utils_file_db.set('send_msg_count', send_msg_count)
-        count = 0
-    return count < SEND_MSG_DAILY_LIMIT
+    return daily_send_counter.get() < SEND_MSG_DAILY_LIMIT
 
 # 记录消息发送
 def record_daily_msg_send():
-    date = datetime.now().strftime("%Y-%m-%d")
-    send_msg_count = utils_file_db.get('send_msg_count', {})
-    count = send_msg_count.get('count', 0)
-    if send_msg_count.get('date', '') != date:
-        send_msg_count = {'date': date, 'count': 0}
-        utils_file_db.set('send_msg_count', send_msg_count)
-        count = 0
-    count += 1
-    send_msg_count['count'] = count
-    utils_file_db.set('send_msg_count', send_msg_count)
-    if count == SEND_MSG_DAILY_LIMIT:
+    if daily_send_counter.incr() == SEND_MSG_DAILY_LIMIT:
         utils_logger.warning(f'达到每日发送消息上限 {SEND_MSG_DAILY_LIMIT}')
 
 # 获取当日发送消息数量
 def get_send_msg_daily_count() -> int:
-    date = datetime.now().strftime("%Y-%m-%d")
-    send_msg_count = utils_file_db.get('send_msg_count', {})
-    count = send_msg_count.get('count', 0)
-    if send_msg_count.get('date', '') != date:
-        send_msg_count = {'date': date, 'count': 0}
-        utils_file_db.set('send_msg_count', send_msg_count)
-        count = 0
-    return count
+    return daily_send_counter.get()
 
 
 self_reply_msg_ids = set()
 MSG_RATE_LIMIT_PER_SECOND = get_config()['msg_rate_limit_per_second']
-current_msg_count = 0
-current_msg_second = -1
+SEND_QUEUE_CONFIG = get_config('send_queue')
+SEND_QUEUE_BURST = SEND_QUEUE_CONFIG.get('burst', MSG_RATE_LIMIT_PER_SECOND)
+SEND_QUEUE_MAX_PENDING = SEND_QUEUE_CONFIG.get('max_pending', 500)
+SEND_QUEUE_COALESCE_MAX_LEN = SEND_QUEUE_CONFIG.get('coalesce_max_len', 1500)
+SEND_COUNT_FLUSH_INTERVAL = SEND_QUEUE_CONFIG.get('count_flush_interval', 30)
 send_msg_failed_last_mail_time = datetime.fromtimestamp(0)
 send_msg_failed_mail_interval = timedelta(minutes=10)
 
-# 发送消息装饰器
-def send_msg_func(func):
-    async def wrapper(*args, **kwargs):
-        # 检查消息发送次数限制
-        cur_ts = int(datetime.now().timestamp())
-        global current_msg_count, current_msg_second
-        if cur_ts != current_msg_second:
-            current_msg_count = 0
-            current_msg_second = cur_ts
-        if current_msg_count >= MSG_RATE_LIMIT_PER_SECOND:
-            utils_logger.warning(f'消息达到发送频率，取消消息发送')
-            return
-        current_msg_count += 1
-        
+# 发送优先级，数字越小越优先。指令处理中发送的消息为回复优先级，其他(定时任务、订阅通知、转发等)为通知优先级
+SEND_PRIORITY_REPLY = 0
+SEND_PRIORITY_NOTIFY = 1
+_send_priority = contextvars.ContextVar('send_priority', default=SEND_PRIORITY_NOTIFY)
+# 正在发送的目标，发送函数内对同一目标的嵌套发送不等待外层发送完成
+_sending_target = contextvars.ContextVar('sending_target', default=None)
+
+# 在上下文中指定发送优先级
+@contextmanager
+def send_priority(priority: int):
+    token = _send_priority.set(priority)
+    try:
+        yield
+    finally:
+        _send_priority.reset(token)
+
+# 令牌桶
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.last_time = time.monotonic()
+
+    def try_acquire(self) -> float:
+        """
+        尝试获取一个令牌，成功返回0，否则返回需要等待的秒数
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.
+        return (1 - self.tokens) / self.rate
+
+    def refund(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+# 待发送的消息
+@dataclass
+class OutboundMessage:
+    func: Callable
+    args: tuple
+    kwargs: dict
+    target: str
+    priority: int
+    futures: List[asyncio.Future]
+    enqueue_time: float
+    context: contextvars.Context
+    texts: List[str] = None
+    nested: bool = False
+    start_time: float = None
+    end_time: float = None
+
+    def get_args(self) -> tuple:
+        # 合并后的纯文本消息替换原消息参数
+        if self.texts is not None and len(self.texts) > 1:
+            return (*self.args[:-1], '\n'.join(self.texts))
+        return self.args
+
+# 消息发送调度器的统计
+@dataclass
+class OutboundStats:
+    submitted: int = 0
+    sent: int = 0
+    failed: int = 0
+    coalesced: int = 0
+    rejected: int = 0
+    max_pending: int = 0
+    total_wait: float = 0.
+    max_wait: float = 0.
+
+class OutboundScheduler:
+    """
+    消息发送调度器，超过发送频率的消息排队等待而不是丢弃
+    - 令牌桶控制整体发送频率，允许 `burst` 条的突发
+    - 按优先级发送，同优先级内按发送目标(群/私聊)轮流发送，避免单个群的大量消息阻塞其他群
+    - 同一目标同时只有一条消息在发送，保证同一目标的消息按提交顺序到达
+    - 同一目标排队中的连续纯文本消息合并为一条发送
+    """
+    def __init__(self, rate: float, burst: float, max_pending: int, coalesce_max_len: int):
+        self.bucket = TokenBucket(rate, burst)
+        self.max_pending = max_pending
+        self.coalesce_max_len = coalesce_max_len
+        self.queues: Dict[int, OrderedDict[str, deque]] = {}
+        self.pending = 0
+        self.wakeup: asyncio.Event = None
+        self.task: asyncio.Task = None
+        self.sending: Set[asyncio.Task] = set()
+        self.inflight: Dict[str, int] = {}
+        self.stats = OutboundStats()
+
+    def _ensure_task(self):
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        if self.task is None or self.task.done():
+            # 调度循环不继承提交者的上下文
+            self.task = contextvars.Context().run(asyncio.get_event_loop().create_task, self._dispatch_loop())
+        self.wakeup.set()
+
+    def _pop_next(self) -> Optional[OutboundMessage]:
+        for priority in sorted(self.queues):
+            targets = self.queues[priority]
+            for target, queue in targets.items():
+                # 正在发送的目标只允许发送其中的嵌套消息
+                if target in self.inflight and not queue[0].nested:
+                    continue
+                msg = queue.popleft()
+                if queue:
+                    targets.move_to_end(target)
+                else:
+                    del targets[target]
+                self.pending -= 1
+                return msg
+        return None
+
+    async def _dispatch_loop(self):
+        while True:
+            try:
+                if self.pending == 0:
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                    continue
+                wait = self.bucket.try_acquire()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+                msg = self._pop_next()
+                # 排队的目标都在发送中，等待发送完成
+                if msg is None:
+                    self.bucket.refund()
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                    continue
+                # 等待方都已取消的消息不再发送
+                if all(f.done() for f in msg.futures):
+                    self.bucket.refund()
+                    continue
+                self.inflight[msg.target] = self.inflight.get(msg.target, 0) + 1
+                # 在提交者的上下文中发送，使发送函数内的嵌套发送保持相同的优先级
+                task = msg.context.run(asyncio.create_task, self._send(msg))
+                self.sending.add(task)
+                task.add_done_callback(self.sending.discard)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                utils_logger.print_exc(f'消息发送调度失败')
+
+    async def _send(self, msg: OutboundMessage):
+        try:
+            _sending_target.set(msg.target)
+            await self._do_send(msg)
+        finally:
+            if self.inflight[msg.target] <= 1:
+                del self.inflight[msg.target]
+            else:
+                self.inflight[msg.target] -= 1
+            self.wakeup.set()
+
+    async def _do_send(self, msg: OutboundMessage):
+        msg.start_time = time.perf_counter()
+        wait = msg.start_time - msg.enqueue_time
+        self.stats.total_wait += wait
+        self.stats.max_wait = max(self.stats.max_wait, wait)
         try:
-            ret = await func(*args, **kwargs)
+            ret = await msg.func(*msg.get_args(), **msg.kwargs)
         except Exception as e:
+            self.stats.failed += 1
             # 失败发送邮件通知
             global send_msg_failed_last_mail_time
             if datetime.now() - send_msg_failed_last_mail_time > send_msg_failed_mail_interval:
                 send_msg_failed_last_mail_time = datetime.now()
                 asyncio.create_task(asend_exception_mail("消息发送失败", traceback.format_exc(), utils_logger))
-            raise
+            for f in msg.futures:
+                if not f.done():
+                    f.set_exception(e)
+                    f.exception()
+            return
+        finally:
+            msg.end_time = time.perf_counter()
+        self.stats.sent += 1
 
         # 记录自身对指令的回复消息id集合
         try:
             if ret:
-                global self_reply_msg_ids
                 self_reply_msg_ids.add(int(ret["message_id"]))
         except Exception as e:
             utils_logger.print_exc(f'记录发送消息的id失败')
 
         # 记录消息发送次数
         record_daily_msg_send()
-            
+
+        for f in msg.futures:
+            if not f.done():
+                f.set_result(ret)
+
+    async def _wait(self, msg: OutboundMessage, future: asyncio.Future):
+        ret = await future
+        if (profile := get_current_profile()) and msg.start_time is not None:
+            profile.add_span('send_wait', msg.enqueue_time, msg.start_time)
+            profile.add_span('send', msg.start_time, msg.end_time)
         return ret
-        
+
+    async def submit(self, func: Callable, args: tuple, kwargs: dict, target: str, text: str = None):
+        """
+        提交消息并等待发送完成，返回发送函数的返回值。`text` 不为None时允许与同目标排队中的连续纯文本消息合并
+        """
+        future = asyncio.get_event_loop().create_future()
+        priority = _send_priority.get()
+        self.stats.submitted += 1
+        queue = self.queues.setdefault(priority, OrderedDict()).get(target)
+        nested = _sending_target.get() == target
+        if text is not None and not nested and queue and queue[-1].texts is not None and not queue[-1].nested:
+            last = queue[-1]
+            if sum(len(t) for t in last.texts) + len(text) <= self.coalesce_max_len:
+                last.texts.append(text)
+                last.futures.append(future)
+                self.stats.coalesced += 1
+                return await self._wait(last, future)
+        if self.pending >= self.max_pending:
+            self.stats.rejected += 1
+            utils_logger.warning(f'待发送消息达到上限 {self.max_pending}，取消消息发送')
+            return None
+        msg = OutboundMessage(
+            func=func, args=args, kwargs=kwargs, target=target, priority=priority,
+            futures=[future], enqueue_time=time.perf_counter(), context=contextvars.copy_context(),
+            texts=[text] if text is not None else None, nested=nested,
+        )
+        if queue is None:
+            queue = self.queues[priority][target] = deque()
+        # 嵌套消息属于正在发送的消息，排在同一目标的其他消息之前
+        if nested:
+            queue.appendleft(msg)
+        else:
+            queue.append(msg)
+        self.pending += 1
+        self.stats.max_pending = max(self.stats.max_pending, self.pending)
+        self._ensure_task()
+        return await self._wait(msg, future)
+
+outbound_scheduler = OutboundScheduler(
+    rate=MSG_RATE_LIMIT_PER_SECOND, 
+    burst=SEND_QUEUE_BURST, 
+    max_pending=SEND_QUEUE_MAX_PENDING, 
+    coalesce_max_len=SEND_QUEUE_COALESCE_MAX_LEN,
+)
+
+# 获取发送目标，用于同优先级内按目标轮流发送
+def _get_send_target(target: str, args: tuple, kwargs: dict) -> str:
+    if target == 'event':
+        event = args[1] if len(args) > 1 else kwargs['event']
+        if is_group_msg(event):
+            return f'group_{event.group_id}'
+        return f'private_{event.user_id}'
+    if target == 'group':
+        return f'group_{args[1] if len(args) > 1 else kwargs["group_id"]}'
+    return f'private_{args[1] if len(args) > 1 else kwargs["user_id"]}'
+
+# 发送消息装饰器，消息经过调度器排队发送
+# target: 发送目标的来源 'event' 第二个参数为event 'group' 第二个参数为群号 'private' 第二个参数为用户id
+# coalesce: 是否允许合并排队中的连续纯文本消息，要求最后一个参数为消息
+def send_msg_func(func=None, target: str = 'event', coalesce: bool = False):
+    if func is None:
+        return lambda f: send_msg_func(f, target, coalesce)
+    async def wrapper(*args, **kwargs):
+        text = None
+        if coalesce and not kwargs and isinstance(args[-1], str) and '[CQ:' not in args[-1]:
+            text = args[-1]
+        return await outbound_scheduler.submit(func, args, kwargs, _get_send_target(target, args, kwargs), text)
     return wrapper
     
 # 发送消息
@@ -957,7 +1590,7 @@ async def fold_msg_fallback(bot, group_id, contents, e, method):
     return ret
 
 # 发送群聊折叠消息 其中contents是text的列表
-@send_msg_func
+@send_msg_func(target='group')
 async def send_group_fold_msg(bot, group_id, contents, fallback_method='none'):
     if check_group_disabled(group_id):
         utils_logger.warning(f'取消发送消息到被全局禁用的群 {group_id}')
@@ -997,7 +1630,7 @@ async def send_multiple_fold_msg(bot, event, contents, fallback_method='none'):
     
 
 # 在event外发送群聊消息
-@send_msg_func
+@send_msg_func(target='group', coalesce=True)
 async def send_group_msg_by_bot(bot, group_id, message):
     if check_group_disabled(group_id):
         utils_logger.warning(f'取消发送消息到被全局禁用的群 {group_id}')
@@ -1008,12 +1641,12 @@ async def send_group_msg_by_bot(bot, group_id, message):
     return await bot.send_group_msg(group_id=int(group_id), message=message)
 
 # 在event外发送私聊消息
-@send_msg_func
+@send_msg_func(target='private')
 async def send_private_msg_by_bot(bot, user_id, message):
     return await bot.send_private_msg(user_id=int(user_id), message=message)
 
 # 在event外发送多条消息折叠消息
-@send_msg_func
+@send_msg_func(target='group')
 async def send_multiple_fold_msg_by_bot(bot, group_id, contents, fallback_method='none'):
     if check_group_disabled(group_id):
         utils_logger.warning(f'取消发送消息到被全局禁用的群 {group_id}')
@@ -1052,44 +1685,218 @@ def is_gif(image):
     return False
 
 
+IMAGE_ENCODE_CONFIG = get_config('image_encode')
+IMAGE_ENCODE_MAX_BYTES = IMAGE_ENCODE_CONFIG.get('max_bytes', 0)                           # 发送图片的大小上限，0为不限制
+IMAGE_ENCODE_FORMATS = IMAGE_ENCODE_CONFIG.get('formats', ['png', 'jpg'])                   # 超出大小上限时依次尝试的格式
+IMAGE_ENCODE_CACHE_SIZE = IMAGE_ENCODE_CONFIG.get('cache_size_mb', 64) * 1024 * 1024       # 编码结果缓存大小
+IMAGE_ENCODE_ANIMATED_FORMATS = IMAGE_ENCODE_CONFIG.get('animated_formats', ['gif'])       # 动图依次尝试的格式
+IMAGE_ENCODE_ANIMATED_MAX_BYTES = IMAGE_ENCODE_CONFIG.get('animated_max_bytes', 0)         # 动图的大小上限，0为使用max_bytes
+
+# 编码结果的LRU缓存，按字节数限制大小
+class EncodedImageCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.cur_bytes = 0
+        self.items: OrderedDict[str, str] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[str]:
+        if key in self.items:
+            self.items.move_to_end(key)
+            self.hits += 1
+            return self.items[key]
+        self.misses += 1
+        return None
+
+    def set(self, key: str, value: str):
+        if len(value) > self.max_bytes:
+            return
+        if key in self.items:
+            self.cur_bytes -= len(self.items.pop(key))
+        self.items[key] = value
+        self.cur_bytes += len(value)
+        while self.cur_bytes > self.max_bytes:
+            _, v = self.items.popitem(last=False)
+            self.cur_bytes -= len(v)
+
+encoded_image_cache = EncodedImageCache(IMAGE_ENCODE_CACHE_SIZE)
+
+# 获取二进制数据的hash
+def get_bytes_hash(data: bytes) -> str:
+    import hashlib
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+# 编码单张静态图片为二进制
+def _encode_static_image(image: Image.Image, fmt: str, quality: int) -> bytes:
+    buf = io.BytesIO()
+    if fmt == 'jpg':
+        image.convert('RGB').save(buf, format='JPEG', quality=quality, optimize=True, subsampling=1, progressive=True)
+    elif fmt == 'webp':
+        image.save(buf, format='WEBP', quality=quality, method=4)
+    else:
+        image.save(buf, format='PNG')
+    return buf.getvalue()
+
+# 动图编码的统计
+@dataclass
+class AnimatedEncodeStats:
+    count: int = 0
+    attempts: int = 0
+    over_budget: int = 0
+    total_time: float = 0.
+    raw_bytes: int = 0
+    encoded_bytes: int = 0
+    last: str = ''
+
+animated_encode_stats = AnimatedEncodeStats()
+
+# 动图编码的参数梯度 (抽帧间隔, 缩放比例, 调色板大小)，依次尝试直到满足大小上限
+ANIMATED_ENCODE_LADDER = [
+    (1, 1.0, 256),
+    (1, 1.0, 128),
+    (2, 1.0, 128),
+    (2, 0.75, 128),
+    (2, 0.5, 64),
+    (3, 0.5, 64),
+    (4, 0.35, 32),
+]
+
+# 编码动图，超出大小上限时按梯度抽帧、缩小尺寸和减少颜色，根据上次结果跳过明显无法满足上限的参数
+# max_bytes为None时使用动图的大小上限配置，都无法满足上限时返回最小的结果
+def encode_animated(image: Image.Image, quality: int = 75, max_bytes: int = None) -> bytes:
+    if max_bytes is None:
+        max_bytes = IMAGE_ENCODE_ANIMATED_MAX_BYTES or IMAGE_ENCODE_MAX_BYTES
+    start = time.perf_counter()
+    stats = animated_encode_stats
+    data, params, last_cost = None, None, None
+    best, best_params = None, None
+    for fmt in IMAGE_ENCODE_ANIMATED_FORMATS:
+        for i, (step, scale, colors) in enumerate(ANIMATED_ENCODE_LADDER):
+            # 大小估计与帧数和像素数成正比
+            cost = scale * scale / step
+            is_last = i == len(ANIMATED_ENCODE_LADDER) - 1
+            if last_cost and not is_last and len(data) * cost / last_cost > max_bytes * 1.3:
+                continue
+            stats.attempts += 1
+            data = encode_animated_image(image, fmt, step, scale, colors, quality)
+            params, last_cost = (fmt, step, scale, colors), cost
+            if best is None or len(data) < len(best):
+                best, best_params = data, params
+            if not max_bytes or len(data) <= max_bytes:
+                break
+        else:
+            last_cost = None
+            continue
+        break
+    else:
+        data, params = best, best_params
+    elapsed = time.perf_counter() - start
+    raw = image.width * image.height * 4 * getattr(image, 'n_frames', 1)
+    stats.count += 1
+    stats.total_time += elapsed
+    stats.raw_bytes += raw
+    stats.encoded_bytes += len(data)
+    if max_bytes and len(data) > max_bytes:
+        stats.over_budget += 1
+        utils_logger.warning(f'动图编码后大小 {get_readable_file_size(len(data))} 仍超过上限 {get_readable_file_size(max_bytes)}')
+    fmt, step, scale, colors = params
+    stats.last = f'{fmt} 抽帧{step} 缩放{scale} {colors}色 {get_readable_file_size(len(data))} 耗时{elapsed:.2f}s 压缩比{len(data) / max(raw, 1):.1%}'
+    utils_logger.debug(f'动图编码: {stats.last}')
+    return data
+
+# 编码图片为二进制，超出大小上限时依次尝试其他格式、降低质量以及缩小尺寸，max_bytes为None时使用配置的上限
+def encode_image(image: Image.Image, low_quality: bool = False, quality: int = 75, max_bytes: int = None) -> bytes:
+    if is_gif(image):
+        return encode_animated(image, quality, max_bytes)
+    if max_bytes is None:
+        max_bytes = IMAGE_ENCODE_MAX_BYTES
+    if image.mode == 'P':
+        buf = io.BytesIO()
+        save_transparent_gif(get_frames_from_gif(image), get_gif_duration(image), buf)
+        return buf.getvalue()
+    data = _encode_static_image(image, 'jpg' if low_quality else 'png', quality)
+    if not max_bytes or len(data) <= max_bytes:
+        return data
+    fmts = [f for f in IMAGE_ENCODE_FORMATS if f != 'png'] or ['jpg']
+    for scale in (1.0, 0.75, 0.5, 0.35, 0.25):
+        img = image if scale == 1.0 else image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))), Image.Resampling.BILINEAR)
+        for fmt in fmts:
+            for q in sorted({quality, 60, 45}, reverse=True):
+                if q > quality: continue
+                data = _encode_static_image(img, fmt, q)
+                if len(data) <= max_bytes:
+                    return data
+    utils_logger.warning(f'图片编码后大小 {get_readable_file_size(len(data))} 仍超过上限 {get_readable_file_size(max_bytes)}')
+    return data
+
+# 已编码的图片，发送时不再重新编码，例如分块渲染输出的超大图片
+@dataclass
+class EncodedImage:
+    data: bytes
+    format: str
+    size: Tuple[int, int]
+
 # 获取图片的cq码用于发送
+# 编码结果按调用方提供的身份缓存：本地路径+修改时间、bytes内容或显式指定的 `cache_key`，
+# 内存中的图片(例如每次新绘制的图片)没有指定 `cache_key` 时不缓存
 async def get_image_cq(
-    image: Union[str, Image.Image, bytes],
+    image: Union[str, Image.Image, bytes, EncodedImage],
     allow_error: bool = False, 
     logger: Logger = None, 
     low_quality: bool = False, 
     quality: int = 75,
+    max_bytes: int = None,
+    use_cache: bool = True,
+    cache_key: str = None,
 ):
-    args = (allow_error, logger, low_quality, quality)
+    # 未指定大小上限时由encode_image按图片类型使用对应的配置
+    static_max_bytes = IMAGE_ENCODE_MAX_BYTES if max_bytes is None else max_bytes
     try:
+        params = f'{low_quality}_{quality}_{max_bytes}'
+        key = None
+        if use_cache and cache_key is not None:
+            key = f'key_{cache_key}_{params}'
+            if cq := encoded_image_cache.get(key):
+                return cq
+        # 如果是已编码的图片，需要低质量或超过大小上限时解码后按常规流程重新编码
+        # 分块渲染的超大图片已经按默认上限渲染，不再完整解码，直接发送
+        if isinstance(image, EncodedImage):
+            need_reencode = low_quality or (static_max_bytes and len(image.data) > static_max_bytes)
+            if need_reencode and image.size[0] * image.size[1] >= RENDER_TILED_MIN_PIXELS:
+                (logger or utils_logger).warning(f'已编码的图片 {image.size[0]}x{image.size[1]} 过大，跳过重新编码')
+                need_reencode = False
+            if not need_reencode:
+                return f'[CQ:image,file=base64://{base64.b64encode(image.data).decode()}]'
+            image = Image.open(io.BytesIO(image.data))
+            use_cache, key = False, None
         # 如果是远程图片
         if isinstance(image, str) and image.startswith("http"):
             image = await download_image(image)
-            return await get_image_cq(image, *args)
         # 如果是bytes
-        if isinstance(image, bytes):
+        elif isinstance(image, bytes):
+            if use_cache and key is None:
+                key = f'bytes_{get_bytes_hash(image)}_{params}'
+                if cq := encoded_image_cache.get(key):
+                    return cq
             image = Image.open(io.BytesIO(image))
-            return await get_image_cq(image, *args)
-        # 如果是本地路径
-        if isinstance(image, str):
+        # 如果是本地路径，用路径和修改时间作为缓存key
+        elif isinstance(image, str):
             if not os.path.exists(image):
                 raise Exception(f'图片文件不存在: {image}')
+            if use_cache and key is None:
+                stat = os.stat(image)
+                key = f'path_{osp.abspath(image)}_{stat.st_mtime_ns}_{stat.st_size}_{params}'
+                if cq := encoded_image_cache.get(key):
+                    return cq
             image = open_image(image)
-            return await get_image_cq(image, *args)
-
-        is_gif_img = is_gif(image) or image.mode == 'P'
-        ext = 'gif' if is_gif_img else ('jpg' if low_quality else 'png')
-        with TempFilePath(ext) as tmp_path:
-            if ext == 'gif':
-                save_transparent_gif(get_frames_from_gif(image), get_gif_duration(image), tmp_path)
-            elif ext == 'jpg':
-                image = image.convert('RGB')
-                image.save(tmp_path, format='JPEG', quality=quality, optimize=True, subsampling=1, progressive=True)
-            else:
-                image.save(tmp_path)
-            
-            with open(tmp_path, 'rb') as f:
-                return f'[CQ:image,file=base64://{base64.b64encode(f.read()).decode()}]'
+
+        with profile_span('encode'):
+            data = await run_in_pool(encode_image, image, low_quality, quality, max_bytes)
+        cq = f'[CQ:image,file=base64://{base64.b64encode(data).decode()}]'
+        if key:
+            encoded_image_cache.set(key, cq)
+        return cq
 
     except Exception as e:
         if allow_error: 
@@ -1200,6 +2007,17 @@ def async_task(name: str, logger: Logger, start_offset=None):
     return wrapper  
 
 
+# 定时刷新日志文件数据库
+@repeat_with_interval(FILE_DB_FLUSH_INTERVAL, '文件数据库刷新', utils_logger)
+async def _():
+    await run_in_pool(flush_all_file_dbs)
+
+# 定时写回每日消息发送计数
+@repeat_with_interval(SEND_COUNT_FLUSH_INTERVAL, '发送计数刷新', utils_logger)
+async def _():
+    daily_send_counter.flush()
+
+
 # 转换视频到gif
 def convert_video_to_gif(video_path, save_path, max_fps=10, max_size=256, max_frame_num=200):
     utils_logger.info(f'转换视频为GIF: {video_path}')
@@ -1216,12 +2034,93 @@ def convert_video_to_gif(video_path, save_path, max_fps=10, max_size=256, max_fr
         resized_frames.append(img)
     resized_frames[0].save(save_path, save_all=True, append_images=resized_frames[1:], duration=1000 / max_fps, loop=0)
 
-# 批量gather
+GATHER_CONFIG = get_config('gather')
+GATHER_DEFAULT_LIMIT = GATHER_CONFIG.get('limit', 32)
+GATHER_ADAPTIVE_MAX_LIMIT = GATHER_CONFIG.get('adaptive_max_limit', 64)
+GATHER_ADAPTIVE_MIN_LATENCY = 0.001         # 低于该耗时的任务（如缓存命中）不参与延迟统计
+
+# 执行单个gather任务，返回 (序号, 是否成功, 结果或异常, 耗时)
+async def _run_gather_item(index: int, fut_or_coro, timeout: float):
+    start = time.perf_counter()
+    try:
+        if timeout is not None:
+            ret = await asyncio.wait_for(fut_or_coro, timeout)
+        else:
+            ret = await fut_or_coro
+        return index, True, ret, time.perf_counter() - start
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        return index, False, e, time.perf_counter() - start
+
+# 关闭未开始的协程或取消future
+def _discard_gather_item(fut_or_coro):
+    if asyncio.iscoroutine(fut_or_coro):
+        fut_or_coro.close()
+    elif asyncio.isfuture(fut_or_coro):
+        fut_or_coro.cancel()
+
+# 有界并发gather
+async def bounded_gather(
+    *futs_or_coros, 
+    limit: int = None, 
+    timeout: float = None, 
+    return_exceptions: bool = False,
+    adaptive: bool = False,
+    max_limit: int = None,
+) -> list:
+    """
+    以有限的并发数流式执行协程，一个任务完成后立即开始下一个，结果按提交顺序返回
+    - `limit`: 最大并发数，adaptive时为初始并发数
+    - `timeout`: 单个任务的超时时间，超时视为该任务失败
+    - `return_exceptions`: 为True时失败任务的异常作为结果返回，否则取消剩余任务并抛出第一个异常
+    - `adaptive`: 根据观测延迟在 `limit` 和 `max_limit` 之间调整并发数，延迟接近基线时逐步增加，超过基线的两倍时减少
+       基线为延迟的滑动平均中较低的值，并向当前延迟缓慢回升，避免个别极快的任务使基线过低
+    """
+    items = list(futs_or_coros)
+    results = [None] * len(items)
+    limit = max(1, limit or GATHER_DEFAULT_LIMIT)
+    max_limit = max(limit, max_limit or GATHER_ADAPTIVE_MAX_LIMIT)
+    min_limit = limit
+    ewma_latency, base_latency, done_since_adjust = None, None, 0
+
+    pending, next_index = set(), 0
+    try:
+        while next_index < len(items) or pending:
+            while next_index < len(items) and len(pending) < limit:
+                pending.add(asyncio.ensure_future(_run_gather_item(next_index, items[next_index], timeout)))
+                next_index += 1
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                index, ok, ret, latency = task.result()
+                if not ok and not return_exceptions:
+                    raise ret
+                results[index] = ret
+                if not adaptive or latency < GATHER_ADAPTIVE_MIN_LATENCY:
+                    continue
+                ewma_latency = latency if ewma_latency is None else ewma_latency * 0.8 + latency * 0.2
+                # 每完成当前并发数个任务调整一次并发数
+                done_since_adjust += 1
+                if done_since_adjust >= limit:
+                    done_since_adjust = 0
+                    if base_latency is None or ewma_latency < base_latency:
+                        base_latency = ewma_latency
+                    else:
+                        base_latency += (ewma_latency - base_latency) * 0.2
+                    if ewma_latency > base_latency * 2:
+                        limit = max(min_limit, limit * 3 // 4)
+                    elif ewma_latency <= base_latency * 1.5:
+                        limit = min(max_limit, limit + max(1, limit // 8))
+        return results
+    finally:
+        for task in pending:
+            task.cancel()
+        for item in items[next_index:]:
+            _discard_gather_item(item)
+
+# 批量gather，兼容旧接口
 async def batch_gather(*futs_or_coros, batch_size=32):
-    results = []
-    for i in range(0, len(futs_or_coros), batch_size):
-        results.extend(await asyncio.gather(*futs_or_coros[i:i + batch_size]))
-    return results
+    return await bounded_gather(*futs_or_coros, limit=batch_size)
 
 
 
@@ -1241,6 +2140,108 @@ def check_self_reply(event):
     return int(event.message_id) in self_reply_msg_ids
 
 
+LIMITER_SNAPSHOT_INTERVAL = get_config('limiter', {}).get('snapshot_interval', 30)  # 限流状态快照间隔（秒）
+
+# 冷却/频率限制的内存状态表，key对应的值为时间戳或计数
+class LimiterTable:
+    def __init__(self, name: str, db: FileDB, db_key: str):
+        self.name = name
+        self.db = db
+        self.db_key = db_key
+        self.values: Dict[str, float] = db.get(db_key, {})
+        self.extras: Dict[str, Any] = {}    # 需要一起快照的其他数据库字段
+        self.ttl = 0                        # 值为时间戳时，超过ttl未更新的key会被清除
+        self.dirty = False
+        self.checks = 0
+        self.rejections = 0
+
+    def get(self, key: str, default=None):
+        return self.values.get(key, default)
+
+    def set(self, key: str, value: float):
+        self.values[key] = value
+        self.dirty = True
+
+    def clear(self):
+        self.values = {}
+        self.dirty = True
+
+    def set_extra(self, db_key: str, value: Any):
+        self.extras[db_key] = value
+        self.dirty = True
+
+    def record(self, ok: bool):
+        self.checks += 1
+        if not ok:
+            self.rejections += 1
+
+    def evict(self, now: float):
+        if self.ttl <= 0:
+            return
+        expired = [k for k, v in self.values.items() if now - v > self.ttl]
+        for k in expired:
+            del self.values[k]
+        if expired:
+            self.dirty = True
+
+    def snapshot(self):
+        if not self.dirty:
+            return
+        self.db.set(self.db_key, self.values)
+        for db_key, value in self.extras.items():
+            self.db.set(db_key, value)
+        self.dirty = False
+
+
+# 限流引擎：统一管理所有冷却/频率限制的内存状态，定期清理闲置key并快照到数据库
+class LimiterEngine:
+    def __init__(self):
+        self.tables: Dict[Tuple[str, str], LimiterTable] = {}
+        self.last_stat_time = time.time()
+        self.last_stat_checks = 0
+        self.last_stat_rejections = 0
+        self.checks_per_sec = 0.
+        self.rejections_per_sec = 0.
+
+    def get_table(self, name: str, db: FileDB, db_key: str) -> LimiterTable:
+        key = (db.path, db_key)
+        if key not in self.tables:
+            self.tables[key] = LimiterTable(name, db, db_key)
+        return self.tables[key]
+
+    def snapshot(self):
+        now = time.time()
+        for table in list(self.tables.values()):
+            try:
+                table.evict(now)
+                table.snapshot()
+            except:
+                utils_logger.print_exc(f'限流状态 {table.name} 快照失败')
+        checks = sum(t.checks for t in self.tables.values())
+        rejections = sum(t.rejections for t in self.tables.values())
+        elapsed = max(now - self.last_stat_time, 1e-6)
+        self.checks_per_sec = (checks - self.last_stat_checks) / elapsed
+        self.rejections_per_sec = (rejections - self.last_stat_rejections) / elapsed
+        self.last_stat_time, self.last_stat_checks, self.last_stat_rejections = now, checks, rejections
+
+    def get_stats(self) -> Dict[str, Any]:
+        # 不同数据库中的表可能重名，以 (数据库路径, 字段) 区分
+        return {
+            'checks_per_sec': self.checks_per_sec,
+            'rejections_per_sec': self.rejections_per_sec,
+            'tables': {
+                key: {
+                    'name': table.name,
+                    'keys': len(table.values),
+                    'checks': table.checks,
+                    'rejections': table.rejections,
+                } for key, table in self.tables.items()
+            },
+        }
+
+limiter_engine = LimiterEngine()
+
+
 # 冷却时间
 class ColdDown:
     def __init__(self, db, logger, default_interval, superuser=SUPERUSER, cold_down_name=None, group_seperate=False):
@@ -1250,33 +2251,34 @@ class ColdDown:
         self.logger = logger
         self.group_seperate = group_seperate
         self.cold_down_name = f'cold_down' if cold_down_name is None else f'cold_down_{cold_down_name}'
+        self.table = limiter_engine.get_table(self.cold_down_name, db, self.cold_down_name)
+        self.table.ttl = max(self.table.ttl, default_interval, CD_VERBOSE_INTERVAL)
     
     async def check(self, event, interval=None, allow_super=True, verbose=True):
         if allow_super and check_superuser(event, self.superuser):
             self.logger.debug(f'{self.cold_down_name}检查: 超级用户{event.user_id}')
             return True
         if interval is None: interval = self.default_interval
+        self.table.ttl = max(self.table.ttl, interval)
         key = str(event.user_id)
         if isinstance(event, GroupMessageEvent) and self.group_seperate:
             key = f'{event.group_id}-{key}'
-        last_use = self.db.get(self.cold_down_name, {})
         now = datetime.now().timestamp()
-        if key not in last_use:
-            last_use[key] = now
-            self.db.set(self.cold_down_name, last_use)
+        last_use = self.table.get(key)
+        if last_use is None:
+            self.table.set(key, now)
+            self.table.record(True)
             self.logger.debug(f'{self.cold_down_name}检查: {key} 未使用过')
             return True
-        if now - last_use[key] < interval:
+        if now - last_use < interval:
+            self.table.record(False)
             self.logger.debug(f'{self.cold_down_name}检查: {key} CD中')
             if verbose:
                 try:
                     verbose_key = f'verbose_{key}'
-                    if verbose_key not in last_use:
-                        last_use[verbose_key] = 0
-                    if now - last_use[verbose_key] > CD_VERBOSE_INTERVAL:
-                        last_use[verbose_key] = now
-                        self.db.set(self.cold_down_name, last_use)
-                        rest_time = timedelta(seconds=interval - (now - last_use[key]))
+                    if now - self.table.get(verbose_key, 0) > CD_VERBOSE_INTERVAL:
+                        self.table.set(verbose_key, now)
+                        rest_time = timedelta(seconds=interval - (now - last_use))
                         verbose_msg = f'冷却中, 剩余时间: {get_readable_timedelta(rest_time)}'
                         if hasattr(event, 'message_id'):
                             if hasattr(event, 'group_id'):
@@ -1286,17 +2288,17 @@ class ColdDown:
                 except Exception as e:
                     self.logger.print_exc(f'{self.cold_down_name}检查: {key} CD中, 发送冷却中消息失败')
             return False
-        last_use[key] = now
-        self.db.set(self.cold_down_name, last_use)
+        self.table.set(key, now)
+        self.table.record(True)
         self.logger.debug(f'{self.cold_down_name}检查: {key} 通过')
         return True
 
     def get_last_use(self, user_id, group_id=None):
         key = f'{group_id}-{user_id}' if group_id else str(user_id)
-        last_use = self.db.get(self.cold_down_name, {})
-        if key not in last_use:
+        last_use = self.table.get(key)
+        if last_use is None:
             return None
-        return datetime.fromtimestamp(last_use[key])
+        return datetime.fromtimestamp(last_use)
 
 
 # 频率限制
@@ -1314,6 +2316,10 @@ class RateLimit:
         self.logger = logger
         self.group_seperate = group_seperate
         self.rate_limit_name = f'default' if rate_limit_name is None else f'{rate_limit_name}'
+        self.last_check_time_key = f'last_check_time_{self.rate_limit_name}'
+        self.count_key = f"rate_limit_count_{self.rate_limit_name}"
+        self.table = limiter_engine.get_table(self.rate_limit_name, db, self.count_key)
+        self.period_time = self.get_period_time(datetime.fromtimestamp(db.get(self.last_check_time_key, 0)))
 
     def get_period_time(self, t):
         if self.period_type == "m":
@@ -1331,14 +2337,16 @@ class RateLimit:
         key = str(event.user_id)
         if isinstance(event, GroupMessageEvent) and self.group_seperate:
             key = f'{event.group_id}-{key}'
-        last_check_time_key = f'last_check_time_{self.rate_limit_name}'
-        count_key = f"rate_limit_count_{self.rate_limit_name}"
-        last_check_time = datetime.fromtimestamp(self.db.get(last_check_time_key, 0))
-        count = self.db.get(count_key, {})
-        if self.get_period_time(datetime.now()) > self.get_period_time(last_check_time):
-            count = {}
+        now = datetime.now()
+        period_time = self.get_period_time(now)
+        if period_time > self.period_time:
+            self.period_time = period_time
+            self.table.clear()
             self.logger.debug(f'{self.rate_limit_name}检查: 额度已重置')
-        if count.get(key, 0) >= self.limit:
+        self.table.set_extra(self.last_check_time_key, now.timestamp())
+        count = self.table.get(key, 0)
+        if count >= self.limit:
+            self.table.record(False)
             self.logger.debug(f'{self.rate_limit_name}检查: {key} 频率超限')
             if verbose:
                 reply_msg = "达到{period}使用次数限制({limit})"
@@ -1356,15 +2364,20 @@ class RateLimit:
                             await send_private_msg_by_bot(get_bot(), event.user_id, f'[CQ:reply,id={event.message_id}] {reply_msg}')
                 except Exception as e:
                     self.logger.print_exc(f'{self.rate_limit_name}检查: {key} 频率超限, 发送频率超限消息失败')
-            ok = False
-        else:
-            count[key] = count.get(key, 0) + 1
-            self.logger.debug(f'{self.rate_limit_name}检查: {key} 通过 当前次数 {count[key]}/{self.limit}')
-            ok = True
-        self.db.set(count_key, count)
-        self.db.set(last_check_time_key, datetime.now().timestamp())
-        return ok
-        
+            return False
+        self.table.set(key, count + 1)
+        self.table.record(True)
+        self.logger.debug(f'{self.rate_limit_name}检查: {key} 通过 当前次数 {count + 1}/{self.limit}')
+        return True
+
+
+# 定时快照限流状态
+@repeat_with_interval(LIMITER_SNAPSHOT_INTERVAL, '限流状态快照', utils_logger)
+async def _():
+    limiter_engine.snapshot()
+
+atexit.register(limiter_engine.snapshot)
+
 
 # 群白名单：默认关闭
 class GroupWhiteList:
@@ -1713,16 +2726,284 @@ class MessageArgumentParser(ArgumentParser):
                 raise NoReplyException()
 
 
-pool_executor = ThreadPoolExecutor()
+POOL_CONFIG = get_config('pool')
+
+# 可以在进程间传输的PIL图片，只包含原始像素数据
+@dataclass
+class ImageTransport:
+    mode: str
+    size: Tuple[int, int]
+    data: bytes
+    palette: Optional[bytes] = None
+    info: Dict[str, Any] = field(default_factory=dict)
+
+    @classmethod
+    def from_image(cls, img: Image.Image) -> "ImageTransport":
+        palette = img.palette.tobytes() if img.mode == 'P' and img.palette else None
+        info = { k: v for k, v in img.info.items() if isinstance(v, (int, float, str, tuple)) }
+        return cls(img.mode, img.size, img.tobytes(), palette, info)
+
+    def to_image(self) -> Image.Image:
+        img = Image.frombytes(self.mode, self.size, self.data)
+        if self.palette is not None:
+            img.putpalette(self.palette)
+        img.info.update(self.info)
+        return img
+
+def _pack_transport(obj):
+    if isinstance(obj, Image.Image):
+        return ImageTransport.from_image(obj)
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_pack_transport(x) for x in obj)
+    if isinstance(obj, dict):
+        return { k: _pack_transport(v) for k, v in obj.items() }
+    return obj
+
+def _unpack_transport(obj):
+    if isinstance(obj, ImageTransport):
+        return obj.to_image()
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_unpack_transport(x) for x in obj)
+    if isinstance(obj, dict):
+        return { k: _unpack_transport(v) for k, v in obj.items() }
+    return obj
+
+# 在工作线程/进程中执行函数，并记录开始与结束时间
+def _timed_call(func, args, packed: bool):
+    start = time.time()
+    if packed:
+        ret = _pack_transport(func(*_unpack_transport(args)))
+    else:
+        ret = func(*args)
+    return ret, start, time.time()
+
+# 执行池的统计
+@dataclass
+class PoolStats:
+    submitted: int = 0
+    completed: int = 0
+    failed: int = 0
+    pending: int = 0
+    max_pending: int = 0
+    total_wait: float = 0.
+    total_run: float = 0.
+    max_latency: float = 0.
+
+# 命名执行池，process类型的池需要函数和参数都可以被pickle
+class NamedPool:
+    def __init__(self, name: str, kind: str, max_workers: int = None):
+        assert kind in ('thread', 'process'), f'未知的执行池类型 {kind}'
+        self.name = name
+        self.kind = kind
+        self.max_workers = max_workers
+        self.executor = None
+        self.stats = PoolStats()
+        self.stats_lock = threading.Lock()
+
+    def get_executor(self):
+        if self.executor is None:
+            if self.kind == 'thread':
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=f'pool_{self.name}')
+            else:
+                # 使用fork保证子进程中可以直接找到已加载插件的函数，fork方式下所有工作进程在第一次提交时一次性创建
+                import multiprocessing
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('fork'))
+            utils_logger.info(f'创建执行池 {self.name}({self.kind}) max_workers={self.max_workers}')
+        return self.executor
 
-async def run_in_pool(func, *args, pool=None):
-    if pool is None:
-        global pool_executor
-        pool = pool_executor
-    return await asyncio.get_event_loop().run_in_executor(pool, func, *args)
+    # 立即创建所有工作进程，避免之后在已有多个线程的进程中fork导致子进程继承被持有的锁
+    def start(self):
+        executor = self.get_executor()
+        if self.kind == 'process':
+            futures = [executor.submit(os.getpid) for _ in range(self.max_workers or 1)]
+            concurrent.futures.wait(futures)
+
+    async def run(self, func, *args):
+        stats = self.stats
+        stats.submitted += 1
+        stats.pending += 1
+        stats.max_pending = max(stats.max_pending, stats.pending)
+        submit_time = time.time()
+        try:
+            with profile_span(f'pool_{self.name}'):
+                if self.kind == 'thread':
+                    # 线程池中继承当前上下文，使函数内的耗时记录归属到当前指令
+                    ret, start, end = await asyncio.get_event_loop().run_in_executor(
+                        self.get_executor(), contextvars.copy_context().run, _timed_call, func, args, False
+                    )
+                else:
+                    # PIL图片以原始像素数据传输，避免pickle时的编码开销
+                    ret, start, end = await asyncio.get_event_loop().run_in_executor(
+                        self.get_executor(), _timed_call, func, _pack_transport(args), True
+                    )
+        except:
+            stats.failed += 1
+            raise
+        finally:
+            stats.pending -= 1
+        stats.completed += 1
+        stats.total_wait += max(0., start - submit_time)
+        stats.total_run += end - start
+        stats.max_latency = max(stats.max_latency, end - submit_time)
+        return _unpack_transport(ret) if self.kind == 'process' else ret
+
+    # 在同步代码(例如其他池的工作线程)中并行执行 func(item)，按输入顺序返回结果，只用于thread类型的池
+    def map(self, func, items) -> list:
+        assert self.kind == 'thread', f'执行池 {self.name} 不是线程池'
+        items = list(items)
+        stats = self.stats
+        with self.stats_lock:
+            stats.submitted += len(items)
+            stats.pending += len(items)
+            stats.max_pending = max(stats.max_pending, stats.pending)
+        submit_time = time.time()
+        # 统计在工作线程中完成时更新，调用方中途抛出异常时也能正确计数
+        def on_done(future: concurrent.futures.Future):
+            with self.stats_lock:
+                stats.pending -= 1
+                if future.exception() is not None:
+                    stats.failed += 1
+                    return
+                _, start, end = future.result()
+                stats.completed += 1
+                stats.total_wait += max(0., start - submit_time)
+                stats.total_run += end - start
+                stats.max_latency = max(stats.max_latency, end - submit_time)
+        futures = []
+        for item in items:
+            future = self.get_executor().submit(_timed_call, func, (item,), False)
+            future.add_done_callback(on_done)
+            futures.append(future)
+        return [future.result()[0] for future in futures]
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+# io: 通用线程池 cpu: 计算密集任务的进程池 plt: matplotlib绘图专用进程 gif: 透明GIF逐帧转换的线程池
+_pools: Dict[str, NamedPool] = {
+    'io':  NamedPool('io',  'thread',  POOL_CONFIG.get('io_workers', None)),
+    'cpu': NamedPool('cpu', 'process', POOL_CONFIG.get('cpu_workers', max(1, min(4, (os.cpu_count() or 2) - 1)))),
+    'plt': NamedPool('plt', 'process', POOL_CONFIG.get('plt_workers', 1)),
+    'gif': NamedPool('gif', 'thread',  GIF_CONVERT_WORKERS),
+}
+pool_executor = _pools['io'].get_executor()
+
+def get_pool(kind: str) -> NamedPool:
+    if kind not in _pools:
+        raise Exception(f'未知的执行池 {kind}')
+    return _pools[kind]
+
+async def run_in_pool(func, *args, pool=None, kind='io'):
+    if pool is not None:
+        return await asyncio.get_event_loop().run_in_executor(pool, func, *args)
+    return await get_pool(kind).run(func, *args)
+
+def run_in_pool_nowait(func, *args, kind='io'):
+    return asyncio.ensure_future(get_pool(kind).run(func, *args))
+
+# 所有插件加载完成后立即创建进程池的工作进程，此时其他插件的后台线程尚未启动
+@get_driver().on_startup
+async def _():
+    for pool in _pools.values():
+        if pool.kind == 'process':
+            pool.start()
+
+@get_driver().on_shutdown
+async def _():
+    for pool in _pools.values():
+        pool.shutdown()
+
+
+RENDER_CONFIG = get_config('render')
+RENDER_PARALLEL_MIN_PIXELS = RENDER_CONFIG.get('parallel_min_pixels', 2000 * 2000)
+RENDER_BAND_HEIGHT = RENDER_CONFIG.get('band_height', 512)
+RENDER_TILED_MIN_PIXELS = RENDER_CONFIG.get('tiled_min_pixels', 4096 * 4096)
+RENDER_TILED_MAX_PIXELS = RENDER_CONFIG.get('tiled_max_pixels', 16384 * 16384)
+
+RENDER_TILED_MAX_ATTEMPTS = 3
+
+# 光栅化一个条带并缩放到输出尺寸
+def _rasterize_band(band: DisplayList, size: Tuple[int, int]) -> Image.Image:
+    img = rasterize_display_list(band)
+    if img.size != size:
+        img = img.resize(size, Image.Resampling.BILINEAR)
+    return img
 
-def run_in_pool_nowait(func, *args):
-    return asyncio.get_event_loop().run_in_executor(pool_executor, func, *args)
+# 按条带依次光栅化、缩放并流式编码为PNG，同时只有不超过cpu进程数的条带在内存中
+async def _render_display_list_tiled(dl: DisplayList, scale: float) -> EncodedImage:
+    cpu_pool = get_pool('cpu')
+    workers = max(1, cpu_pool.max_workers or 1)
+    bands = dl.iter_bands(max(1, math.ceil(dl.size[1] / RENDER_BAND_HEIGHT)))
+    size = (max(1, int(dl.size[0] * scale)), max(1, int(dl.size[1] * scale)))
+    buf = io.BytesIO()
+    encoder = StreamingPngEncoder(buf, size)
+    pending = deque()
+    try:
+        for band in bands:
+            # 条带边界按比例取整，保证缩放后的条带首尾相接
+            y0, y1 = band.band
+            h = min(size[1], round(y1 * scale)) - min(size[1], round(y0 * scale))
+            if h <= 0:
+                continue
+            pending.append(asyncio.ensure_future(cpu_pool.run(_rasterize_band, band, (size[0], h))))
+            if len(pending) >= workers:
+                await run_in_pool(encoder.write, await pending.popleft())
+        while pending:
+            await run_in_pool(encoder.write, await pending.popleft())
+    finally:
+        for fut in pending:
+            fut.cancel()
+    encoder.close()
+    return EncodedImage(buf.getvalue(), 'png', size)
+
+# 分块渲染并满足大小上限，超出时按比例缩小后重新渲染，不需要完整解码图片，max_bytes为None时使用配置的上限
+async def render_display_list_tiled(dl: DisplayList, max_bytes: int = None) -> EncodedImage:
+    if max_bytes is None:
+        max_bytes = IMAGE_ENCODE_MAX_BYTES
+    scale, best = 1.0, None
+    for _ in range(RENDER_TILED_MAX_ATTEMPTS):
+        img = await _render_display_list_tiled(dl, scale)
+        if best is None or len(img.data) < len(best.data):
+            best = img
+        if not max_bytes or len(img.data) <= max_bytes:
+            return img
+        # PNG的大小大致与像素数成正比
+        scale *= math.sqrt(max_bytes / len(img.data)) * 0.9
+    utils_logger.warning(f'分块渲染后大小 {get_readable_file_size(len(best.data))} 仍超过上限 {get_readable_file_size(max_bytes)}')
+    return best
+
+# 绘制画布，大画布先录制绘制指令，再按水平条带在cpu进程池中并行光栅化后拼接
+# allow_tiled为True时超过 RENDER_TILED_MIN_PIXELS 的画布按条带流式编码，返回EncodedImage，此时忽略scale
+# path指定绘制路径 'direct'/'banded'/'tiled'，为None时按画布大小选择，用于基准测试
+async def render_canvas(canvas: Canvas, scale: float = None, allow_tiled: bool = False, path: str = None) -> Union[Image.Image, EncodedImage]:
+    assert path in (None, 'direct', 'banded', 'tiled'), f'未知的绘制路径 {path}'
+    cpu_pool = get_pool('cpu')
+    workers = cpu_pool.max_workers or 1
+    if path == 'direct' or (path is None and workers <= 1 and not allow_tiled):
+        return await run_in_pool(canvas.get_img, scale)
+    allow_tiled = allow_tiled or path == 'tiled'
+    dl = await run_in_pool(canvas.get_display_list, RENDER_TILED_MAX_PIXELS if allow_tiled else None)
+    w, h = dl.size
+    if path == 'tiled' or (path is None and allow_tiled and w * h >= RENDER_TILED_MIN_PIXELS):
+        with profile_span('raster'):
+            return await render_display_list_tiled(dl)
+    if path is None and (w * h < RENDER_PARALLEL_MIN_PIXELS or workers <= 1):
+        # 小画布直接光栅化，避免进程间传输的开销
+        with profile_span('raster'):
+            img = await run_in_pool(rasterize_display_list, dl)
+    else:
+        band_num = max(1, min(workers, math.ceil(h / RENDER_BAND_HEIGHT)))
+        bands = dl.split_bands(band_num)
+        with profile_span('raster'):
+            band_imgs = await bounded_gather(*[cpu_pool.run(rasterize_display_list, band) for band in bands], limit=workers)
+        img = Image.new('RGBA', (w, h), TRANSPARENT)
+        for band, band_img in zip(bands, band_imgs):
+            img.paste(band_img, (0, band.band[0]))
+    if scale:
+        img = await run_in_pool(img.resize, (int(w * scale), int(h * scale)), Image.Resampling.BILINEAR)
+    return img
 
 
 # 异步加载json
@@ -1736,25 +3017,24 @@ async def adump_json(data: dict, path: str):
 
 # 下载json文件，返回json
 async def download_json(url: str):
-    async with aiohttp.ClientSession() as session:
-        headers = {
-            'Accept-Language': 'en',
-        }
-        async with session.get(url, headers=headers, verify_ssl=False) as resp:
-            if resp.status != 200:
-                try:
-                    detail = await resp.text()
-                    detail = loads_json(detail)['detail']
-                except:
-                    pass
-                utils_logger.error(f"下载 {url} 失败: {resp.status} {detail}")
-                raise HttpError(resp.status, detail)
-            if "text/plain" in resp.content_type:
-                return loads_json(await resp.text())
-            if "application/octet-stream" in resp.content_type:
-                import io
-                return loads_json(io.BytesIO(await resp.read()).read())
-            return await resp.json()
+    headers = {
+        'Accept-Language': 'en',
+    }
+    async with http_session_mgr.get(url, headers=headers) as resp:
+        if resp.status != 200:
+            try:
+                detail = await resp.text()
+                detail = loads_json(detail)['detail']
+            except:
+                pass
+            utils_logger.error(f"下载 {url} 失败: {resp.status} {detail}")
+            raise HttpError(resp.status, detail)
+        if "text/plain" in resp.content_type:
+            return loads_json(await resp.text())
+        if "application/octet-stream" in resp.content_type:
+            import io
+            return loads_json(io.BytesIO(await resp.read()).read())
+        return await resp.json()
 
 
 # 用某个key查找某个dict列表中的元素 mode=first/last/all
@@ -1839,6 +3119,7 @@ class HandlerContext:
     group_id: int = None
     logger: Logger = None
     block_ids: List[str] = field(default_factory=list)
+    sent_records: List[Tuple[str, tuple, dict]] = None
 
     # --------------------------  数据获取 -------------------------- #
 
@@ -1862,19 +3143,33 @@ class HandlerContext:
     
     # -------------------------- 消息发送 -------------------------- # 
 
+    def _record_sent(self, method: str, *args, **kwargs):
+        # 合并执行时记录发送的消息，用于给等待同一结果的其他请求重放
+        if self.sent_records is not None:
+            self.sent_records.append((method, args, kwargs))
+
+    async def areplay_sent(self, records: List[Tuple[str, tuple, dict]]):
+        for method, args, kwargs in records:
+            await getattr(self, method)(*args, **kwargs)
+
     def asend_msg(self, msg: str):
+        self._record_sent('asend_msg', msg)
         return send_msg(self.nonebot_handler, self.event, msg)
 
     def asend_reply_msg(self, msg: str):
+        self._record_sent('asend_reply_msg', msg)
         return send_reply_msg(self.nonebot_handler, self.event, msg)
 
     def asend_at_msg(self, msg: str):
+        self._record_sent('asend_at_msg', msg)
         return send_at_msg(self.nonebot_handler, self.event, msg)
 
     def asend_fold_msg_adaptive(self, msg: str, threshold=200, need_reply=True, text_len=None, fallback_method='none'):
+        self._record_sent('asend_fold_msg_adaptive', msg, threshold, need_reply, text_len, fallback_method)
         return send_fold_msg_adaptive(self.bot, self.nonebot_handler, self.event, msg, threshold, need_reply, text_len, fallback_method)
 
     async def asend_multiple_fold_msg(self, msgs: List[str], show_cmd=True, fallback_method='none'):
+        self._record_sent('asend_multiple_fold_msg', msgs, show_cmd, fallback_method)
         if show_cmd:
             cmd_msg = self.trigger_cmd + self.arg_text
             if self.group_id:
@@ -1887,22 +3182,30 @@ class HandlerContext:
 
     async def block(self, block_id: str = "", timeout: int = 3 * 60, err_msg: str = None):
         block_id = str(block_id)
-        block_start_time = datetime.now()
-        while True:
-            if block_id not in self.handler.block_set:
-                break
-            if (datetime.now() - block_start_time).seconds > timeout:
+        deadline = time.time() + timeout
+        # 等待占用者释放，释放时会set对应的Event
+        while block_id in self.handler.block_events:
+            try:
+                with profile_span('block_wait'):
+                    await asyncio.wait_for(self.handler.block_events[block_id].wait(), max(0, deadline - time.time()))
+            except asyncio.TimeoutError:
                 if err_msg is None:
                     err_msg = f'指令执行繁忙(block_id={block_id})，请稍后再试'
                 raise ReplyException(err_msg)
-            await asyncio.sleep(1)
-        self.handler.block_set.add(block_id)
+        self.handler.block_events[block_id] = asyncio.Event()
         self.block_ids.append(block_id)
 
 
 cmd_history: List[HandlerContext] = []
 MAX_CMD_HISTORY = 100
 
+PROFILE_CONFIG = get_config('profile')
+PROFILE_ENABLED = PROFILE_CONFIG.get('enabled', True)
+cmd_profiler = CmdProfiler(
+    sample_num=PROFILE_CONFIG.get('sample_num', 512),
+    trace_num=PROFILE_CONFIG.get('trace_num', 256),
+)
+
 class CmdHandler:
     def __init__(
             self, 
@@ -1933,7 +3236,12 @@ class CmdHandler:
         self.banned_cmds = banned_cmds or []
         if isinstance(self.banned_cmds, str):
             self.banned_cmds = [self.banned_cmds]
-        self.block_set = set()
+        self.block_events: Dict[str, asyncio.Event] = {}
+        self.coalesce_ttl = None
+        self.coalesce_user_dependent = True
+        self.coalesce_key_fn = None
+        self.inflight_futures: Dict[str, asyncio.Future] = {}
+        self.coalesce_cache: Dict[str, Tuple[float, List[Tuple[str, tuple, dict]]]] = {}
         # utils_logger.info(f'注册指令 {commands[0]}')
 
     def check_group(self):
@@ -1956,6 +3264,67 @@ class CmdHandler:
         self.superuser_check = { "superuser": superuser }
         return self
 
+    def coalesce(self, ttl: float = 10, user_dependent=True, key_fn: Callable[[HandlerContext], str] = None):
+        """
+        合并相同的并发请求：相同key的请求只执行一次，其他请求等待并重放其发送的消息，结果在ttl秒内复用
+        - `user_dependent`: 结果是否依赖发送者，为True时key包含用户id
+        - `key_fn`: 自定义key，返回None时不合并
+        """
+        self.coalesce_ttl = ttl
+        self.coalesce_user_dependent = user_dependent
+        self.coalesce_key_fn = key_fn
+        return self
+
+    def get_coalesce_key(self, context: HandlerContext) -> Optional[str]:
+        if self.coalesce_key_fn:
+            return self.coalesce_key_fn(context)
+        parts = [
+            context.trigger_cmd,
+            ' '.join(context.arg_text.split()),
+            str(getattr(context, 'region', None) or ''),
+            str(getattr(context, 'prefix_arg', None) or ''),
+            ','.join(str(seg.data.get('qq')) for seg in context.event.message if seg.type == 'at'),
+        ]
+        if self.coalesce_user_dependent:
+            parts.append(str(context.user_id))
+        return '|'.join(parts)
+
+    async def run_coalesced(self, context: HandlerContext, handler_func):
+        key = self.get_coalesce_key(context)
+        if key is None:
+            return await handler_func(context)
+        now = time.time()
+        # 清理过期结果
+        for k in [k for k, (t, _) in self.coalesce_cache.items() if now - t > self.coalesce_ttl]:
+            del self.coalesce_cache[k]
+        if key in self.coalesce_cache:
+            self.logger.info(f'指令\"{context.trigger_cmd}\"复用 {self.coalesce_ttl}s 内的结果')
+            return await context.areplay_sent(self.coalesce_cache[key][1])
+        if key in self.inflight_futures:
+            self.logger.info(f'指令\"{context.trigger_cmd}\"等待相同请求的结果')
+            with profile_span('coalesce_wait'):
+                records = await asyncio.shield(self.inflight_futures[key])
+            return await context.areplay_sent(records)
+
+        future = asyncio.get_event_loop().create_future()
+        self.inflight_futures[key] = future
+        context.sent_records = []
+        try:
+            ret = await handler_func(context)
+            future.set_result(context.sent_records)
+            self.coalesce_cache[key] = (time.time(), context.sent_records)
+            return ret
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            # 等待中的请求收到相同的异常，按各自的上下文处理
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            self.inflight_futures.pop(key, None)
+
     async def additional_context_process(self, context: HandlerContext):
         return context
 
@@ -1964,6 +3333,7 @@ class CmdHandler:
             @self.handler.handle()
             async def func(bot: Bot, event: MessageEvent):
                 # utils_logger.info(f'Handler {self.commands[0]} 收到指令: {event.message.extract_plain_text()}')
+                recv_time = time.perf_counter()
 
                 if self.disabled:
                     return
@@ -2034,10 +3404,19 @@ class CmdHandler:
                     if len(cmd_history) > MAX_CMD_HISTORY:
                         cmd_history = cmd_history[-MAX_CMD_HISTORY:]
 
+                # 耗时记录，check为收到指令到开始处理的时间
+                profile, profile_token, profile_error = None, None, False
+                if PROFILE_ENABLED:
+                    profile, profile_token = cmd_profiler.begin(self.commands[0], recv_time)
+                    profile.add_span('check', recv_time, time.perf_counter())
+                send_priority_token = _send_priority.set(SEND_PRIORITY_REPLY)
+
                 try:
                     # 额外处理，用于子类自定义
                     context = await self.additional_context_process(context)
                     assert context, "额外处理返回值不能为空"
+                    if self.coalesce_ttl is not None:
+                        return await self.run_coalesced(context, handler_func)
                     return await handler_func(context)
                 
                 except NoReplyException:
@@ -2045,12 +3424,17 @@ class CmdHandler:
                 except ReplyException as e:
                     return await context.asend_reply_msg(str(e))
                 except Exception as e:
+                    profile_error = True
                     self.logger.print_exc(f'指令\"{context.trigger_cmd}\"处理失败')
                     if self.error_reply:
                         await context.asend_reply_msg(truncate(f"指令处理失败: {get_exc_desc(e)}", 256))
                 finally:
+                    _send_priority.reset(send_priority_token)
+                    if profile:
+                        cmd_profiler.end(profile, profile_token, profile_error)
                     for block_id in context.block_ids:
-                        self.block_set.discard(block_id)
+                        if block_event := self.block_events.pop(block_id, None):
+                            block_event.set()
                         
             return func
         return decorator
@@ -2243,4 +3627,160 @@ daily_send_count.check_superuser()
 @daily_send_count.handle()
 async def _(ctx: HandlerContext):
     count = get_send_msg_daily_count()
-    return await ctx.asend_reply_msg(f'今日已发送消息数量: {count}')
\ No newline at end of file
+    st = outbound_scheduler.stats
+    msg = f'今日已发送消息数量: {count}\n'
+    msg += f'发送队列 排队 {outbound_scheduler.pending}(峰值{st.max_pending}) 发送 {st.sent} 失败 {st.failed} 合并 {st.coalesced} 拒绝 {st.rejected} '
+    msg += f'等待 avg={st.total_wait/max(st.sent, 1)*1000:.0f}ms max={st.max_wait*1000:.0f}ms'
+    return await ctx.asend_reply_msg(msg)
+
+# 文件数据库写入性能测试
+def benchmark_file_db(n: int = 2000, user_num: int = 500) -> Dict[str, Dict[str, float]]:
+    """
+    模拟冷却检查的写入模式，对比不同模式的set吞吐量与单次set的最大阻塞时间
+    """
+    ret = {}
+    value = { str(10000 + i): time.time() for i in range(user_num) }
+    for mode, cls in [('json', FileDB), ('journal', JournaledFileDB)]:
+        path = pjoin('data/utils/tmp', rand_filename('json'))
+        db = cls(path, get_logger('FileDBBench'))
+        try:
+            stalls = []
+            start = time.perf_counter()
+            for i in range(n):
+                value[str(10000 + i % user_num)] = time.time()
+                t = time.perf_counter()
+                db.set('cold_down', value)
+                stalls.append(time.perf_counter() - t)
+            db.flush()
+            total = time.perf_counter() - start
+            stalls.sort()
+            ret[mode] = {
+                'ops_per_sec': n / total,
+                'stall_avg_ms': sum(stalls) / n * 1000,
+                'stall_p99_ms': stalls[int(n * 0.99) - 1] * 1000,
+                'stall_max_ms': stalls[-1] * 1000,
+            }
+        finally:
+            remove_file(path)
+            remove_file(path + '.journal')
+    return ret
+
+file_db_bench = CmdHandler(['/filedb_bench'], utils_logger)
+file_db_bench.check_superuser()
+@file_db_bench.handle()
+async def _(ctx: HandlerContext):
+    args = ctx.get_args().strip()
+    n = int(args) if args else 2000
+    result = await run_in_pool(benchmark_file_db, n)
+    msg = f"FileDB写入测试 (n={n})\n"
+    for mode, r in result.items():
+        msg += f"[{mode}] {r['ops_per_sec']:.0f} ops/s 阻塞 avg={r['stall_avg_ms']:.3f}ms p99={r['stall_p99_ms']:.3f}ms max={r['stall_max_ms']:.3f}ms\n"
+    return await ctx.asend_reply_msg(msg.strip())
+
+# 查看限流引擎统计
+limiter_stats = CmdHandler(['/limiter_stats'], utils_logger)
+limiter_stats.check_superuser()
+@limiter_stats.handle()
+async def _(ctx: HandlerContext):
+    stats = limiter_engine.get_stats()
+    msg = f"检查 {stats['checks_per_sec']:.2f}次/秒 拒绝 {stats['rejections_per_sec']:.2f}次/秒\n"
+    for (path, _), t in sorted(stats['tables'].items(), key=lambda x: -x[1]['checks']):
+        msg += f"{t['name']}({path}): key数 {t['keys']} 检查 {t['checks']} 拒绝 {t['rejections']}\n"
+    return await ctx.asend_reply_msg(msg.strip())
+
+# 查看HTTP连接统计
+http_stats = CmdHandler(['/http_stats'], utils_logger)
+http_stats.check_superuser()
+@http_stats.handle()
+async def _(ctx: HandlerContext):
+    acquired, idle = http_session_mgr.get_open_conn_num()
+    msg = f"HTTP连接 使用中 {acquired} 空闲 {idle}\n"
+    for host, st in sorted(http_session_mgr.host_stats.items(), key=lambda x: -x[1].requests):
+        msg += f"{host}: 请求 {st.requests} 失败 {st.errors} 复用率 {st.get_reuse_ratio():.0%} "
+        msg += f"延迟 avg={st.get_avg_latency()*1000:.0f}ms max={st.max_latency*1000:.0f}ms\n"
+    return await ctx.asend_reply_msg(msg.strip())
+
+# 查看执行池统计
+pool_stats = CmdHandler(['/pool_stats'], utils_logger)
+pool_stats.check_superuser()
+@pool_stats.handle()
+async def _(ctx: HandlerContext):
+    msg = ""
+    for name, pool in _pools.items():
+        st = pool.stats
+        n = max(st.completed, 1)
+        msg += f"[{name}] 提交 {st.submitted} 失败 {st.failed} 排队 {st.pending}(峰值{st.max_pending}) "
+        msg += f"等待 avg={st.total_wait/n*1000:.0f}ms 执行 avg={st.total_run/n*1000:.0f}ms max={st.max_latency*1000:.0f}ms\n"
+    return await ctx.asend_reply_msg(msg.strip())
+
+# 查看指令耗时统计
+cmd_profile = CmdHandler(['/cmd_profile'], utils_logger)
+cmd_profile.check_superuser()
+@cmd_profile.handle()
+async def _(ctx: HandlerContext):
+    args = ctx.get_args().strip()
+    limit = int(args) if args else 10
+    hottest = cmd_profiler.get_hottest(limit)
+    if not hottest:
+        return await ctx.asend_reply_msg('暂无指令耗时记录')
+    ms = lambda t: f'{t*1000:.0f}'
+    msg = "指令耗时(ms) p50/p95/p99\n"
+    for cmd, stages in hottest:
+        total = stages['total']
+        msg += f"{cmd} x{cmd_profiler.counts.get(cmd, 0)} 失败{cmd_profiler.errors.get(cmd, 0)} "
+        msg += f"总计 {ms(total['p50'])}/{ms(total['p95'])}/{ms(total['p99'])}\n"
+        for stage, st in sorted(stages.items(), key=lambda x: -x[1]['sum']):
+            if stage == 'total': continue
+            msg += f"  {stage}: {ms(st['p50'])}/{ms(st['p95'])}/{ms(st['p99'])} (n={st['n']})\n"
+    return await ctx.asend_reply_msg(msg.strip())
+
+# 导出指令耗时记录为Chrome trace
+cmd_trace = CmdHandler(['/cmd_trace'], utils_logger)
+cmd_trace.check_superuser()
+@cmd_trace.handle()
+async def _(ctx: HandlerContext):
+    path = pjoin('data/utils/profile', f'trace_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json')
+    num = await run_in_pool(cmd_profiler.export_chrome_trace, path)
+    return await ctx.asend_reply_msg(f'已导出 {num} 条指令记录到 {osp.abspath(path)}')
+
+# 查看绘图缓存统计
+plot_cache_stats = CmdHandler(['/plot_cache_stats'], utils_logger)
+plot_cache_stats.check_superuser()
+@plot_cache_stats.handle()
+async def _(ctx: HandlerContext):
+    msg = f"控件渲染缓存 {len(raster_cache.tiles)} 项 {raster_cache.total_bytes / 1024 / 1024:.1f}/{raster_cache.max_bytes / 1024 / 1024:.0f}MB\n"
+    for prefix, st in sorted(raster_cache.stats.items(), key=lambda x: -(x[1].hits + x[1].misses)):
+        msg += f"{prefix}: 命中 {st.hits} 未命中 {st.misses} 命中率 {st.hits / max(st.hits + st.misses, 1):.0%}\n"
+    msg += f"背景缓存 {len(bg_cache.tiles)} 项 {bg_cache.total_bytes / 1024 / 1024:.1f}/{bg_cache.max_bytes / 1024 / 1024:.0f}MB\n"
+    for prefix, st in sorted(bg_cache.stats.items(), key=lambda x: -(x[1].hits + x[1].misses)):
+        msg += f"{prefix}: 命中 {st.hits} 未命中 {st.misses} 命中率 {st.hits / max(st.hits + st.misses, 1):.0%}\n"
+    return await ctx.asend_reply_msg(msg.strip())
+
+# 透明GIF转换基准测试
+gif_bench = CmdHandler(['/gif_bench'], utils_logger)
+gif_bench.check_superuser()
+@gif_bench.handle()
+async def _(ctx: HandlerContext):
+    args = ctx.get_args().strip()
+    frame_num = int(args) if args.isdigit() else 100
+    from .gif_bench import benchmark_gif_conversion
+    r = await run_in_pool(benchmark_gif_conversion, frame_num)
+    return await ctx.asend_reply_msg(
+        f"{r['frame_num']}帧 {r['size'][0]}x{r['size'][1]} 并行数 {r['workers']}\n"
+        f"原实现 {r['legacy_ms']:.0f}ms 向量化 {r['vectorized_ms']:.0f}ms 并行 {r['parallel_ms']:.0f}ms 加速 {r['speedup']:.1f}x\n"
+        f"透明区域一致: {r['same_transparency']} 平均误差 {r['legacy_error']:.2f} -> {r['vectorized_error']:.2f}"
+    )
+
+# 查看图片编码统计
+img_encode_stats = CmdHandler(['/img_encode_stats'], utils_logger)
+img_encode_stats.check_superuser()
+@img_encode_stats.handle()
+async def _(ctx: HandlerContext):
+    st = animated_encode_stats
+    cache = encoded_image_cache
+    msg = f"编码缓存 {len(cache.items)} 项 {cache.cur_bytes / 1024 / 1024:.1f}MB 命中 {cache.hits} 未命中 {cache.misses}\n"
+    msg += f"动图编码 {st.count} 次 尝试 {st.attempts} 次 超出上限 {st.over_budget} 次\n"
+    if st.count:
+        msg += f"平均耗时 {st.total_time / st.count:.2f}s 平均压缩比 {st.encoded_bytes / max(st.raw_bytes, 1):.1%}\n"
+        msg += f"最近: {st.last}"
+    return await ctx.asend_reply_msg(msg.strip())
@@ -0,0 +1,154 @@
+# 透明GIF转换的基准测试，对比 img_utils 中的向量化实现和原始的逐像素实现
+# 通过 /gif_bench 指令运行
+from typing import Tuple, List
+from collections import defaultdict
+from random import randrange
+from itertools import chain
+from PIL import Image
+import numpy as np
+import time
+from . import get_pool
+from .img_utils import QUANTIZE_METHOD, DITHER, GIF_CONVERT_WORKERS, _convert_gif_frame
+
+
+class LegacyTransparentAnimatedGifConverter(object):
+    """逐像素处理的原始实现，仅用于基准测试对比"""
+    _PALETTE_SLOTSET = set(range(256))
+
+    def __init__(self, img_rgba: Image, alpha_threshold: int = 0):
+        self._img_rgba = img_rgba
+        self._alpha_threshold = alpha_threshold
+
+    def _process_pixels(self):
+        """Set the transparent pixels to the color 0."""
+        self._transparent_pixels = set(
+            idx for idx, alpha in enumerate(
+                self._img_rgba.getchannel(channel='A').getdata())
+            if alpha <= self._alpha_threshold)
+
+    def _set_parsed_palette(self):
+        """Parse the RGB palette color `tuple`s from the palette."""
+        palette = self._img_p.getpalette()
+        self._img_p_used_palette_idxs = set(
+            idx for pal_idx, idx in enumerate(self._img_p_data)
+            if pal_idx not in self._transparent_pixels)
+        self._img_p_parsedpalette = dict(
+            (idx, tuple(palette[idx * 3:idx * 3 + 3]))
+            for idx in self._img_p_used_palette_idxs)
+
+    def _get_similar_color_idx(self):
+        """Return a palette index with the closest similar color."""
+        old_color = self._img_p_parsedpalette[0]
+        dict_distance = defaultdict(list)
+        for idx in range(1, 256):
+            color_item = self._img_p_parsedpalette[idx]
+            if color_item == old_color:
+                return idx
+            distance = sum((
+                abs(old_color[0] - color_item[0]),  # Red
+                abs(old_color[1] - color_item[1]),  # Green
+                abs(old_color[2] - color_item[2])))  # Blue
+            dict_distance[distance].append(idx)
+        return dict_distance[sorted(dict_distance)[0]][0]
+
+    def _remap_palette_idx_zero(self):
+        """Since the first color is used in the palette, remap it."""
+        free_slots = self._PALETTE_SLOTSET - self._img_p_used_palette_idxs
+        new_idx = free_slots.pop() if free_slots else \
+            self._get_similar_color_idx()
+        self._img_p_used_palette_idxs.add(new_idx)
+        self._palette_replaces['idx_from'].append(0)
+        self._palette_replaces['idx_to'].append(new_idx)
+        self._img_p_parsedpalette[new_idx] = self._img_p_parsedpalette[0]
+        del(self._img_p_parsedpalette[0])
+
+    def _get_unused_color(self) -> tuple:
+        """ Return a color for the palette that does not collide with any other already in the palette."""
+        used_colors = set(self._img_p_parsedpalette.values())
+        while True:
+            new_color = (randrange(256), randrange(256), randrange(256))
+            if new_color not in used_colors:
+                return new_color
+
+    def _process_palette(self):
+        """Adjust palette to have the zeroth color set as transparent. Basically, get another palette
+        index for the zeroth color."""
+        self._set_parsed_palette()
+        if 0 in self._img_p_used_palette_idxs:
+            self._remap_palette_idx_zero()
+        self._img_p_parsedpalette[0] = self._get_unused_color()
+
+    def _adjust_pixels(self):
+        """Convert the pixels into their new values."""
+        if self._palette_replaces['idx_from']:
+            trans_table = bytearray.maketrans(
+                bytes(self._palette_replaces['idx_from']),
+                bytes(self._palette_replaces['idx_to']))
+            self._img_p_data = self._img_p_data.translate(trans_table)
+        for idx_pixel in self._transparent_pixels:
+            self._img_p_data[idx_pixel] = 0
+        self._img_p.frombytes(data=bytes(self._img_p_data))
+
+    def _adjust_palette(self):
+        """Modify the palette in the new `Image`."""
+        unused_color = self._get_unused_color()
+        final_palette = chain.from_iterable(
+            self._img_p_parsedpalette.get(x, unused_color) for x in range(256))
+        self._img_p.putpalette(data=final_palette)
+
+    def process(self) -> Image:
+        """Return the processed mode `P` `Image`."""
+        rgb_img = self._img_rgba.convert(mode='RGB')
+        pal_img = rgb_img.quantize(256)
+        self._img_p = rgb_img.quantize(palette=pal_img, method=QUANTIZE_METHOD, dither=DITHER)
+        self._img_p_data = bytearray(self._img_p.tobytes())
+        self._palette_replaces = dict(idx_from=list(), idx_to=list())
+        self._process_pixels()
+        self._process_palette()
+        self._adjust_pixels()
+        self._adjust_palette()
+        self._img_p.info['transparency'] = 0
+        self._img_p.info['background'] = 0
+        return self._img_p
+
+
+# 对比逐像素实现和向量化实现转换透明GIF的耗时，使用随机生成的带透明区域的帧
+def benchmark_gif_conversion(frame_num: int = 100, size: Tuple[int, int] = (240, 240), alpha_threshold: int = 127, seed: int = 42) -> dict:
+    rng = np.random.default_rng(seed)
+    w, h = size
+    ys, xs = np.mgrid[0:h, 0:w]
+    frames = []
+    for i in range(frame_num):
+        t = i / max(1, frame_num - 1)
+        rgb = np.stack([
+            (xs * 255 / w + t * 255) % 256,
+            (ys * 255 / h) % 256,
+            np.full((h, w), t * 255),
+        ], axis=-1) + rng.normal(0, 8, (h, w, 3))
+        alpha = np.where((xs - w * t) ** 2 + (ys - h / 2) ** 2 < (min(w, h) / 3) ** 2, 0, 255)
+        arr = np.concatenate([np.clip(rgb, 0, 255), alpha[..., np.newaxis]], axis=-1).astype(np.uint8)
+        frames.append(Image.fromarray(arr, 'RGBA'))
+
+    ret = { 'frame_num': frame_num, 'size': list(size), 'workers': GIF_CONVERT_WORKERS }
+    start = time.perf_counter()
+    legacy = [_convert_gif_frame(f, alpha_threshold, LegacyTransparentAnimatedGifConverter) for f in frames]
+    ret['legacy_ms'] = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    vectorized = [_convert_gif_frame(f, alpha_threshold) for f in frames]
+    ret['vectorized_ms'] = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    get_pool('gif').map(lambda f: _convert_gif_frame(f, alpha_threshold), frames)
+    ret['parallel_ms'] = (time.perf_counter() - start) * 1000
+    ret['speedup'] = ret['legacy_ms'] / max(ret['parallel_ms'], 1e-6)
+    # 透明区域应与原实现一致，颜色质量用非透明像素与原图的平均误差衡量
+    def get_error(converted: List[Image.Image]) -> float:
+        errs = []
+        for src, dst in zip(frames, converted):
+            opaque = np.asarray(dst) != 0
+            diff = np.asarray(dst.convert('RGB')).astype(np.float32) - np.asarray(src.convert('RGB'))
+            errs.append(np.abs(diff[opaque]).mean() if opaque.any() else 0.)
+        return float(np.mean(errs))
+    ret['same_transparency'] = all(np.array_equal(np.asarray(a) == 0, np.asarray(b) == 0) for a, b in zip(legacy, vectorized))
+    ret['legacy_error'] = get_error(legacy)
+    ret['vectorized_error'] = get_error(vectorized)
+    return ret
@@ -5,126 +5,119 @@
 # transparent pixels with black pixels (among other issues) when the GIF is saved using PIL.Image.save().
 # This code works around the issue and allows us to properly generate transparent GIFs.
 
-from typing import Tuple, List, Union
+from typing import Tuple, List, Union, Iterator
 from collections import defaultdict
 from random import randrange
-from itertools import chain
+from itertools import chain, islice
 from PIL import Image, ImageSequence
+import numpy as np
+import os
+import math
+import io
+import struct
+import zlib
 
 QUANTIZE_METHOD = Image.Quantize.MAXCOVERAGE
 DITHER = 0
 
-class TransparentAnimatedGifConverter(object):
-    _PALETTE_SLOTSET = set(range(256))
+# 帧数不少于该值时在线程池中并行转换帧，quantize和numpy运算大部分时间会释放GIL
+GIF_PARALLEL_MIN_FRAMES = 8
+# 生成调色板时采样的最大像素数
+GIF_PALETTE_SAMPLE_PIXELS = 128 * 128
+GIF_CONVERT_WORKERS = max(1, min(4, os.cpu_count() or 1))
+
+# 并行转换帧使用的执行池，utils模块加载完成后才能获取
+def _get_gif_pool():
+    from . import get_pool
+    return get_pool('gif')
 
-    def __init__(self, img_rgba: Image, alpha_threshold: int = 0):
+class TransparentAnimatedGifConverter(object):
+    """
+    将RGBA帧转换为第0号调色板颜色透明的P模式图像，像素和调色板的处理都使用numpy向量化
+    """
+    def __init__(self, img_rgba: Image, alpha_threshold: int = 0, colors: int = 256):
         self._img_rgba = img_rgba
         self._alpha_threshold = alpha_threshold
+        self._colors = colors
 
-    def _process_pixels(self):
-        """Set the transparent pixels to the color 0."""
-        self._transparent_pixels = set(
-            idx for idx, alpha in enumerate(
-                self._img_rgba.getchannel(channel='A').getdata())
-            if alpha <= self._alpha_threshold)
-
-    def _set_parsed_palette(self):
-        """Parse the RGB palette color `tuple`s from the palette."""
-        palette = self._img_p.getpalette()
-        self._img_p_used_palette_idxs = set(
-            idx for pal_idx, idx in enumerate(self._img_p_data)
-            if pal_idx not in self._transparent_pixels)
-        self._img_p_parsedpalette = dict(
-            (idx, tuple(palette[idx * 3:idx * 3 + 3]))
-            for idx in self._img_p_used_palette_idxs)
-
-    def _get_similar_color_idx(self):
-        """Return a palette index with the closest similar color."""
-        old_color = self._img_p_parsedpalette[0]
-        dict_distance = defaultdict(list)
-        for idx in range(1, 256):
-            color_item = self._img_p_parsedpalette[idx]
-            if color_item == old_color:
-                return idx
-            distance = sum((
-                abs(old_color[0] - color_item[0]),  # Red
-                abs(old_color[1] - color_item[1]),  # Green
-                abs(old_color[2] - color_item[2])))  # Blue
-            dict_distance[distance].append(idx)
-        return dict_distance[sorted(dict_distance)[0]][0]
-
-    def _remap_palette_idx_zero(self):
-        """Since the first color is used in the palette, remap it."""
-        free_slots = self._PALETTE_SLOTSET - self._img_p_used_palette_idxs
-        new_idx = free_slots.pop() if free_slots else \
-            self._get_similar_color_idx()
-        self._img_p_used_palette_idxs.add(new_idx)
-        self._palette_replaces['idx_from'].append(0)
-        self._palette_replaces['idx_to'].append(new_idx)
-        self._img_p_parsedpalette[new_idx] = self._img_p_parsedpalette[0]
-        del(self._img_p_parsedpalette[0])
-
-    def _get_unused_color(self) -> tuple:
-        """ Return a color for the palette that does not collide with any other already in the palette."""
-        used_colors = set(self._img_p_parsedpalette.values())
+    @staticmethod
+    def _get_unused_color(palette: np.ndarray, used: np.ndarray) -> np.ndarray:
+        """Return a color for the palette that does not collide with any other already in the palette."""
+        used_colors = set(map(tuple, palette[used].tolist()))
         while True:
             new_color = (randrange(256), randrange(256), randrange(256))
             if new_color not in used_colors:
-                return new_color
-
-    def _process_palette(self):
-        """Adjust palette to have the zeroth color set as transparent. Basically, get another palette
-        index for the zeroth color."""
-        self._set_parsed_palette()
-        if 0 in self._img_p_used_palette_idxs:
-            self._remap_palette_idx_zero()
-        self._img_p_parsedpalette[0] = self._get_unused_color()
-
-    def _adjust_pixels(self):
-        """Convert the pixels into their new values."""
-        if self._palette_replaces['idx_from']:
-            trans_table = bytearray.maketrans(
-                bytes(self._palette_replaces['idx_from']),
-                bytes(self._palette_replaces['idx_to']))
-            self._img_p_data = self._img_p_data.translate(trans_table)
-        for idx_pixel in self._transparent_pixels:
-            self._img_p_data[idx_pixel] = 0
-        self._img_p.frombytes(data=bytes(self._img_p_data))
-
-    def _adjust_palette(self):
-        """Modify the palette in the new `Image`."""
-        unused_color = self._get_unused_color()
-        final_palette = chain.from_iterable(
-            self._img_p_parsedpalette.get(x, unused_color) for x in range(256))
-        self._img_p.putpalette(data=final_palette)
+                return np.array(new_color, dtype=np.uint8)
 
     def process(self) -> Image:
         """Return the processed mode `P` `Image`."""
         rgb_img = self._img_rgba.convert(mode='RGB')
-        pal_img = rgb_img.quantize(256)
-        self._img_p = rgb_img.quantize(palette=pal_img, method=QUANTIZE_METHOD, dither=DITHER)
-        self._img_p_data = bytearray(self._img_p.tobytes())
-        self._palette_replaces = dict(idx_from=list(), idx_to=list())
-        self._process_pixels()
-        self._process_palette()
-        self._adjust_pixels()
-        self._adjust_palette()
-        self._img_p.info['transparency'] = 0
-        self._img_p.info['background'] = 0
-        return self._img_p
+        # 中位切分生成调色板的耗时随像素数增长，大图在降采样的图像上生成调色板，再映射全部像素
+        sample_img = rgb_img
+        factor = math.ceil(math.sqrt(rgb_img.size[0] * rgb_img.size[1] / GIF_PALETTE_SAMPLE_PIXELS))
+        if factor > 1:
+            sample_img = rgb_img.reduce(factor)
+        pal_img = sample_img.quantize(self._colors)
+        img_p = rgb_img.quantize(palette=pal_img, method=QUANTIZE_METHOD, dither=DITHER)
+
+        idxs = np.frombuffer(img_p.tobytes(), dtype=np.uint8).copy()
+        transparent = np.frombuffer(self._img_rgba.getchannel('A').tobytes(), dtype=np.uint8) <= self._alpha_threshold
+        palette = np.zeros((256, 3), dtype=np.uint8)
+        src_palette = np.frombuffer(bytes(img_p.getpalette()[:768]), dtype=np.uint8).reshape(-1, 3)
+        palette[:len(src_palette)] = src_palette
+
+        used = np.bincount(idxs[~transparent], minlength=256) > 0
+        # 第0号颜色被使用时，将其移动到空闲的位置，没有空闲位置时合并到最接近的颜色
+        if used[0]:
+            free = np.flatnonzero(~used)
+            if len(free):
+                new_idx = int(free[0])
+            else:
+                dist = np.abs(palette[1:].astype(np.int32) - palette[0].astype(np.int32)).sum(axis=1)
+                new_idx = int(np.argmin(dist)) + 1
+            lut = np.arange(256, dtype=np.uint8)
+            lut[0] = new_idx
+            idxs = lut[idxs]
+            palette[new_idx] = palette[0]
+            used[new_idx] = True
+            used[0] = False
+        idxs[transparent] = 0
+
+        palette[0] = self._get_unused_color(palette, used)
+        used[0] = True
+        palette[~used] = self._get_unused_color(palette, used)
+
+        img_p.frombytes(idxs.tobytes())
+        img_p.putpalette(palette.tobytes())
+        img_p.info['transparency'] = 0
+        img_p.info['background'] = 0
+        return img_p
+
+def _convert_gif_frame(frame: Image.Image, alpha_threshold: int, converter_cls=TransparentAnimatedGifConverter, **kwargs) -> Image.Image:
+    thumbnail = frame.copy()  # type: Image
+    thumbnail_rgba = thumbnail.convert(mode='RGBA')
+    thumbnail_rgba.thumbnail(size=frame.size, reducing_gap=3.0)
+    converter = converter_cls(img_rgba=thumbnail_rgba, alpha_threshold=alpha_threshold, **kwargs)
+    return converter.process()
+
+# 分批并行转换帧序列，只有一批帧同时在内存中
+def _iter_converted_gif_frames(frames: Iterator[Image.Image], alpha_threshold: int, colors: int = 256) -> Iterator[Image.Image]:
+    convert = lambda frame: _convert_gif_frame(frame, alpha_threshold, colors=colors)
+    batch_size = GIF_CONVERT_WORKERS * 2
+    while batch := list(islice(frames, batch_size)):
+        if GIF_CONVERT_WORKERS > 1:
+            yield from _get_gif_pool().map(convert, batch)
+        else:
+            yield from map(convert, batch)
 
 def _create_animated_gif(images: List[Image.Image], durations: Union[int, List[int]], alpha_threshold: int = 0) -> Tuple[Image.Image, dict]:
     """If the image is a GIF, create an its thumbnail here."""
     save_kwargs = dict()
-    new_images: List[Image.Image] = []
-
-    for frame in images:
-        thumbnail = frame.copy()  # type: Image
-        thumbnail_rgba = thumbnail.convert(mode='RGBA')
-        thumbnail_rgba.thumbnail(size=frame.size, reducing_gap=3.0)
-        converter = TransparentAnimatedGifConverter(img_rgba=thumbnail_rgba, alpha_threshold=alpha_threshold)
-        thumbnail_p = converter.process()  # type: Image
-        new_images.append(thumbnail_p)
+    convert = lambda frame: _convert_gif_frame(frame, alpha_threshold)
+    if len(images) >= GIF_PARALLEL_MIN_FRAMES and GIF_CONVERT_WORKERS > 1:
+        new_images: List[Image.Image] = list(_get_gif_pool().map(convert, images))
+    else:
+        new_images: List[Image.Image] = [convert(frame) for frame in images]
 
     output_image = new_images[0]
     save_kwargs.update(
@@ -172,49 +165,78 @@ def save_transparent_gif(frames: Union[Image.Image, List[Image.Image]], duration
 # 保存高质量静态GIF
 def save_high_quality_static_gif(img: Image, save_path: str, alpha_threshold: float=0.5):
     import random
-    import os
-    from PIL.Image import Palette
     alpha_threshold = int(alpha_threshold * 255)
-    def color_distance(c1, c2):
-        return sum((a - b) ** 2 for a, b in zip(c1, c2))
     img = img.convert("RGBA")
-    original_img = img
+    arr = np.asarray(img)
+    rgb = arr[..., :3].reshape(-1, 3).astype(np.int32)
+    transparent = arr[..., 3].reshape(-1) < alpha_threshold
+    # 只需要检查出现过的颜色
+    colors = np.unique(rgb, axis=0)
     retry_num = 0
     while True:    
         if retry_num > 20:
             raise Exception("生成透明GIF失败")
-        img = original_img.copy()
-        transparent_color = (
+        transparent_color = np.array((
             random.randint(0, 255), 
             random.randint(0, 255), 
             random.randint(0, 255)
-        )
-        def check_color_exists(pixel):
-            return color_distance(pixel[:3], transparent_color) < 300
-        if any(map(check_color_exists, img.getdata())):
+        ), dtype=np.int32)
+        if (((colors - transparent_color) ** 2).sum(axis=1) < 300).any():
             retry_num += 1
             continue
-        def replace_alpha(pixel):
-            return (*transparent_color, 255) if pixel[3] < alpha_threshold else pixel
-        trans_data = list(map(replace_alpha, img.getdata()))
-        img.putdata(trans_data)
-        img: Image = img.convert("RGB")
-        pal_img = img.quantize(256)
-        img = img.quantize(palette=pal_img, method=QUANTIZE_METHOD, dither=DITHER)
-        palette = img.getpalette()[:768]
-        transparent_color_index, min_dist = None, float("inf")
-        for i in range(256):
-            color = palette[i*3:i*3+3]
-            dist = color_distance(color, transparent_color)
-            if dist < min_dist:
-                transparent_color_index, min_dist = i, dist
-        if transparent_color_index is None:
+        trans_rgb = np.where(transparent[:, np.newaxis], transparent_color, rgb).astype(np.uint8)
+        rgb_img = Image.fromarray(trans_rgb.reshape(arr.shape[0], arr.shape[1], 3), "RGB")
+        pal_img = rgb_img.quantize(256)
+        p_img = rgb_img.quantize(palette=pal_img, method=QUANTIZE_METHOD, dither=DITHER)
+        palette = np.array(p_img.getpalette()[:768], dtype=np.int32).reshape(-1, 3)
+        if len(palette) == 0:
             raise Exception("The specific color was not found in the palette.")
+        transparent_color_index = int(np.argmin(((palette - transparent_color) ** 2).sum(axis=1)))
         save_path = os.path.abspath(save_path)
         os.makedirs(os.path.dirname(save_path), exist_ok=True)
-        img.save(save_path, save_all=True, append_images=[img], duration=100, loop=0, transparency=transparent_color_index)
+        p_img.save(save_path, save_all=True, append_images=[p_img], duration=100, loop=0, transparency=transparent_color_index)
         break
 
+# 逐帧读取动图，每step帧取一帧并缩放，不一次性展开所有帧
+def iter_animated_frames(img: Image.Image, step: int = 1, scale: float = 1.0) -> Iterator[Image.Image]:
+    for i, frame in enumerate(ImageSequence.Iterator(img)):
+        if i % step:
+            continue
+        frame = frame.convert('RGBA')
+        if scale != 1.0:
+            frame = frame.resize((max(1, int(frame.width * scale)), max(1, int(frame.height * scale))), Image.Resampling.BILINEAR)
+        yield frame
+
+# 按指定格式编码动图，step为抽帧间隔，scale为缩放比例，colors为GIF调色板大小
+def encode_animated_image(
+    img: Image.Image, 
+    fmt: str = 'gif', 
+    step: int = 1, 
+    scale: float = 1.0, 
+    colors: int = 256, 
+    quality: int = 75,
+    alpha_threshold: float = 0.5,
+) -> bytes:
+    """
+    gif逐帧生成并交给编码器，调色板化后的帧只占1字节/像素；webp和apng编码器需要完整的帧列表，只保存抽帧缩放后的帧
+    """
+    duration = get_gif_duration(img) * step
+    frames = iter_animated_frames(img, step, scale)
+    buf = io.BytesIO()
+    if fmt == 'gif':
+        frames = _iter_converted_gif_frames(frames, int(max(0.0, min(1.0, alpha_threshold)) * 255), colors)
+        first = next(frames)
+        first.save(buf, format='GIF', save_all=True, append_images=frames, optimize=False, duration=duration, disposal=2, loop=0)
+    elif fmt == 'webp':
+        first = next(frames)
+        first.save(buf, format='WEBP', save_all=True, append_images=list(frames), duration=duration, loop=0, quality=quality, method=4)
+    elif fmt == 'apng':
+        first = next(frames)
+        first.save(buf, format='PNG', save_all=True, append_images=list(frames), duration=duration, loop=0)
+    else:
+        raise ValueError(f'不支持的动图格式 {fmt}')
+    return buf.getvalue()
+
 # 从帧序列保存APNG
 def save_apng(images: List[Image.Image], save_path: str, duration=50, loop=0):
     """
@@ -240,3 +262,44 @@ def save_apng(images: List[Image.Image], save_path: str, duration=50, loop=0):
         loop=loop
     )
 
+
+# 流式PNG编码器，按行分块写入，只保留上一行像素和压缩器状态，用于分块渲染超大图片
+class StreamingPngEncoder:
+    PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+    def __init__(self, f, size: Tuple[int, int], mode: str = 'RGBA', compress_level: int = 6):
+        assert mode in ('RGB', 'RGBA'), f'不支持的PNG模式 {mode}'
+        self.f = f
+        self.size = size
+        self.mode = mode
+        self.compressor = zlib.compressobj(compress_level)
+        self.prev_row = np.zeros((1, size[0] * len(mode)), dtype=np.uint8)
+        self.rows = 0
+        color_type = 6 if mode == 'RGBA' else 2
+        f.write(self.PNG_SIGNATURE)
+        self._write_chunk(b'IHDR', struct.pack('>IIBBBBB', size[0], size[1], 8, color_type, 0, 0, 0))
+
+    def _write_chunk(self, tag: bytes, data: bytes):
+        self.f.write(struct.pack('>I', len(data)))
+        self.f.write(tag)
+        self.f.write(data)
+        self.f.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(tag)) & 0xffffffff))
+
+    def write(self, img: Image.Image):
+        # 写入接下来的若干行，每行使用Up滤波(与上一行做差)
+        assert img.size[0] == self.size[0], f'写入的宽度 {img.size[0]} 与图片宽度 {self.size[0]} 不一致'
+        assert self.rows + img.size[1] <= self.size[1], '写入的行数超过图片高度'
+        arr = np.asarray(img.convert(self.mode) if img.mode != self.mode else img, dtype=np.uint8)
+        arr = arr.reshape(img.size[1], -1)
+        filtered = arr - np.concatenate([self.prev_row, arr[:-1]])
+        filter_type = np.full((arr.shape[0], 1), 2, dtype=np.uint8)
+        data = self.compressor.compress(np.hstack([filter_type, filtered]).tobytes())
+        if data:
+            self._write_chunk(b'IDAT', data)
+        self.prev_row = arr[-1:].copy()
+        self.rows += img.size[1]
+
+    def close(self):
+        assert self.rows == self.size[1], f'只写入了 {self.rows}/{self.size[1]} 行'
+        self._write_chunk(b'IDAT', self.compressor.flush())
+        self._write_chunk(b'IEND', b'')
@@ -1,19 +1,25 @@
 from __future__ import annotations
 from enum import Enum
-from typing import Union, Tuple, List, Optional
+from typing import Union, Tuple, List, Optional, Dict, Iterator
+from collections import OrderedDict
+from bisect import bisect_right
 from PIL import Image, ImageFont, ImageDraw, ImageFilter, ImageEnhance
 from PIL.ImageFont import ImageFont as Font
 import threading
+import time
+import weakref
 import contextvars
 from dataclasses import dataclass
 import os
 import numpy as np
 from copy import deepcopy
 import math
-from pilmoji import Pilmoji
-from pilmoji import getsize as getsize_emoji
+from pilmoji.helpers import to_nodes, NodeType
 from pilmoji.source import GoogleEmojiSource
+from io import BytesIO
+from functools import lru_cache
 import emoji
+from .profile import profile_span
 
 DEBUG_MODE = False
 
@@ -91,23 +97,158 @@ def adjust_color(c, r=None, g=None, b=None, a=None):
     if a is not None: c[3] = a
     return tuple(c)
 
-def get_font(path: str, size: int) -> Font:
+FONT_CACHE_SIZE = 128
+
+_font_path_cache: Dict[str, str] = {}
+_font_cache: OrderedDict[Tuple[str, int], Font] = OrderedDict()
+_font_cache_lock = threading.Lock()
+
+# 解析字体文件路径，结果缓存
+def resolve_font_path(path: str) -> str:
+    if path in _font_path_cache:
+        return _font_path_cache[path]
     paths = [path]
     paths.append(os.path.join(FONT_DIR, path))
     paths.append(os.path.join(FONT_DIR, path + ".ttf"))
     paths.append(os.path.join(FONT_DIR, path + ".otf"))
-    for path in paths:
-        if os.path.exists(path):
-            return ImageFont.truetype(path, size)
+    for p in paths:
+        if os.path.exists(p):
+            _font_path_cache[path] = os.path.abspath(p)
+            return _font_path_cache[path]
     raise FileNotFoundError(f"Font file not found: {path}")
 
+# 获取字体，按 (路径, 大小) LRU缓存
+def get_font(path: str, size: int) -> Font:
+    key = (resolve_font_path(path), size)
+    with _font_cache_lock:
+        font = _font_cache.get(key)
+        if font is not None:
+            _font_cache.move_to_end(key)
+            return font
+    font = ImageFont.truetype(key[0], size)
+    with _font_cache_lock:
+        _font_cache[key] = font
+        while len(_font_cache) > FONT_CACHE_SIZE:
+            _font_cache.popitem(last=False)
+    return font
+
+# =========================== emoji =========================== #
+
+EMOJI_GLYPH_CACHE_SIZE = 2048
+EMOJI_FAILED_RETRY_INTERVAL = 600           # 获取失败的emoji在该时间（秒）内不再重新获取
+# 多行混合文本的行间距，与pilmoji的测量方式一致
+EMOJI_LINE_SPACING = 4
+
+TextRun = Tuple[bool, str]
+
+_emoji_source = GoogleEmojiSource()
+_emoji_data_cache: Dict[str, bytes] = {}
+_emoji_failed: Dict[str, float] = {}         # emoji -> 上次获取失败的时间
+_emoji_glyph_cache: OrderedDict[Tuple[str, int], Image.Image] = OrderedDict()
+_emoji_lock = threading.Lock()
+
+# 将文本按行切分为 (是否为emoji, 内容) 的片段，测量和绘制共用同一个切分结果
+@lru_cache(maxsize=4096)
+def get_text_runs(text: str) -> Tuple[Tuple[TextRun, ...], ...]:
+    return tuple(
+        tuple((node.type is NodeType.emoji, node.content) for node in line)
+        for line in to_nodes(text)
+    )
+
+def has_emoji_run(runs: Tuple[Tuple[TextRun, ...], ...]) -> bool:
+    return any(is_emoji for line in runs for is_emoji, _ in line)
+
+# 获取缩放到指定大小的emoji图像，原始图像和缩放结果都会缓存，获取失败返回None，失败结果也会缓存一段时间
+def get_emoji_glyph(emj: str, size: int) -> Optional[Image.Image]:
+    key = (emj, size)
+    with _emoji_lock:
+        glyph = _emoji_glyph_cache.get(key)
+        if glyph is not None:
+            _emoji_glyph_cache.move_to_end(key)
+            return glyph
+    data = _emoji_data_cache.get(emj)
+    if data is None:
+        failed_time = _emoji_failed.get(emj)
+        if failed_time is not None and time.time() - failed_time < EMOJI_FAILED_RETRY_INTERVAL:
+            return None
+        try:
+            stream = _emoji_source.get_emoji(emj)
+        except Exception:
+            stream = None
+        if not stream:
+            _emoji_failed[emj] = time.time()
+            return None
+        data = _emoji_data_cache[emj] = stream.read()
+        _emoji_failed.pop(emj, None)
+    with Image.open(BytesIO(data)) as asset:
+        asset = asset.convert('RGBA')
+        glyph = asset.resize((size, math.ceil(asset.height / asset.width * size)), Image.Resampling.LANCZOS)
+    with _emoji_lock:
+        _emoji_glyph_cache[key] = glyph
+        while len(_emoji_glyph_cache) > EMOJI_GLYPH_CACHE_SIZE:
+            _emoji_glyph_cache.popitem(last=False)
+    return glyph
+
+# 测量含emoji的文本，emoji宽度为字体大小，行间距只计入行与行之间
+def get_mixed_text_size(font: Font, runs: Tuple[Tuple[TextRun, ...], ...]) -> Size:
+    w = 0
+    for line in runs:
+        w = max(w, sum(int(font.size) if is_emoji else int(font.getlength(content)) for is_emoji, content in line))
+    return w, max(0, len(runs) * (EMOJI_LINE_SPACING + font.size) - EMOJI_LINE_SPACING)
+
+# 绘制含emoji的文本，pos为第一行的基线位置，emoji顶部与文本顶部(基线上方std_h)对齐
+def draw_mixed_text(
+    img: Image.Image, 
+    runs: Tuple[Tuple[TextRun, ...], ...], 
+    pos: Position, 
+    font: Font, 
+    fill: Color, 
+    std_h: int,
+):
+    draw = ImageDraw.Draw(img)
+    x0, y = pos
+    for line in runs:
+        x = x0
+        for is_emoji, content in line:
+            if is_emoji and (glyph := get_emoji_glyph(content, int(font.size))):
+                img.paste(glyph, (round(x), round(y - std_h)), glyph)
+                x += int(font.size)
+            else:
+                draw.text((x, y), content, font=font, fill=fill, anchor='ls')
+                x += int(font.getlength(content))
+        y += EMOJI_LINE_SPACING + font.size
+
+
 def get_text_size(font: Font, text: str) -> Size:
-    if emoji.emoji_count(text) > 0:
-        return getsize_emoji(text, font=font)
+    runs = get_text_runs(text)
+    if has_emoji_run(runs):
+        return get_mixed_text_size(font, runs)
     else:
         bbox = font.getbbox(text)
         return bbox[2] - bbox[0], bbox[3] - bbox[1]
 
+# 每个字体的字符前进宽度缓存 (字体路径, 大小) -> { 字符: 宽度 }
+_glyph_advance_cache: Dict[Tuple[str, int], Dict[str, float]] = {}
+
+# 获取字符的前进宽度，emoji使用其实际绘制宽度
+def get_char_advance(font: Font, ch: str) -> float:
+    advances = _glyph_advance_cache.setdefault((font.path, font.size), {})
+    adv = advances.get(ch)
+    if adv is None:
+        if emoji.is_emoji(ch):
+            adv = int(font.size)
+        else:
+            adv = font.getlength(ch)
+        advances[ch] = adv
+    return adv
+
+# 获取文本前缀宽度的估计值，ret[i]为text[:i]的宽度(不考虑字距调整)
+def get_text_advance_prefix_sums(font: Font, text: str) -> List[float]:
+    ret = [0.]
+    for ch in text:
+        ret.append(ret[-1] + get_char_advance(font, ch))
+    return ret
+
 def get_text_offset(font: Font, text: str) -> Position:
     bbox = font.getbbox(text)
     return bbox[0], bbox[1]
@@ -141,14 +282,57 @@ def resize_keep_ratio(img: Image.Image, max_size: int, mode='long', scale=None)
 
 
 class Gradient:
-    def get_colors(self, size: Size) -> np.ndarray: 
-        # [W, H, 4]
+    def get_cache_key(self) -> str:
+        # 渐变参数唯一确定的key，用于缓存生成的渐变图像
+        raise NotImplementedError()
+
+    def _calc_colors(self, size: Size, scale: float) -> np.ndarray:
+        # size为生成的分辨率，scale为生成分辨率与目标分辨率的比例，[H, W, 4]
         raise NotImplementedError()
 
-    def get_img(self, size: Size, mask: Image.Image=None) -> Image.Image:
-        img = Image.fromarray(self.get_colors(size), 'RGBA')
+    def get_colors(self, size: Size) -> np.ndarray: 
+        # [H, W, 4]
+        return self._calc_colors(size, 1.0)
+
+    def _get_base_img(self, size: Size) -> Image.Image:
+        key = f"gradient:{self.get_cache_key()}_{size[0]}x{size[1]}"
+        img = bg_cache.get(key)
+        if img is None:
+            # 渐变是平滑的，超过最大生成分辨率时降采样生成后再放大
+            scale = min(1.0, BG_GEN_MAX_SIDE / max(size))
+            gen_size = (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+            img = Image.fromarray(self._calc_colors(gen_size, scale), 'RGBA')
+            if gen_size != size:
+                img = img.resize(size, Image.Resampling.BILINEAR)
+            bg_cache.set(key, img)
+        return img
+
+    def _get_region_img(self, size: Size, region: Tuple[int, int, int, int]) -> Image.Image:
+        # 只生成 (x0, y0, x1, y1) 范围内的部分，缓存低分辨率的生成结果，按需放大其中的区域
+        scale = min(1.0, BG_GEN_MAX_SIDE / max(size))
+        gen_size = (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+        key = f"gradient_gen:{self.get_cache_key()}_{size[0]}x{size[1]}"
+        gen_img = bg_cache.get(key)
+        if gen_img is None:
+            gen_img = Image.fromarray(self._calc_colors(gen_size, scale), 'RGBA')
+            bg_cache.set(key, gen_img)
+        if gen_size == size:
+            return gen_img.crop(region)
+        sx, sy = gen_size[0] / size[0], gen_size[1] / size[1]
+        box = (region[0] * sx, region[1] * sy, region[2] * sx, region[3] * sy)
+        return gen_img.resize((region[2] - region[0], region[3] - region[1]), Image.Resampling.BILINEAR, box=box)
+
+    def get_img(self, size: Size, mask: Image.Image=None, region: Tuple[int, int, int, int]=None) -> Image.Image:
+        """
+        获取size大小的渐变图像，region不为None时只获取其中 (x0, y0, x1, y1) 的部分，mask的大小需要与结果一致
+        """
+        if region is None or region == (0, 0, size[0], size[1]):
+            img = self._get_base_img(size)
+        else:
+            img = self._get_region_img(size, region)
         if mask:
-            assert mask.size == size, "Mask size must match image size"
+            img = img.copy()
+            assert mask.size == img.size, "Mask size must match image size"
             if mask.mode == 'RGBA':
                 mask = mask.split()[3]
             else:
@@ -164,16 +348,18 @@ class LinearGradient(Gradient):
         self.p2 = p2
         assert p1 != p2, "p1 and p2 cannot be the same point"
 
-    def get_colors(self, size: Size) -> np.ndarray:
+    def get_cache_key(self) -> str:
+        return f"linear_{self.c1}_{self.c2}_{self.p1}_{self.p2}"
+
+    def _calc_colors(self, size: Size, scale: float) -> np.ndarray:
         w, h = size
-        p1 = np.array(self.p1) * np.array((w, h))
-        p2 = np.array(self.p2) * np.array((w, h))
-        y_indices, x_indices = np.meshgrid(np.arange(h), np.arange(w), indexing='ij')
-        coords = np.stack((x_indices, y_indices), axis=-1)
-        dist = np.linalg.norm(coords - p1, axis=-1) / np.linalg.norm(p2 - p1)
-        dist = np.clip(dist, 0, 1)
-        colors = dist[:, :, np.newaxis] * np.array(self.c1) + (1 - dist)[:, :, np.newaxis] * np.array(self.c2)
-        return colors.astype(np.uint8)
+        p1 = np.array(self.p1, dtype=np.float32) * np.array((w, h))
+        p2 = np.array(self.p2, dtype=np.float32) * np.array((w, h))
+        # 利用广播计算距离，避免生成完整的坐标网格
+        xs = np.arange(w, dtype=np.float32)[np.newaxis, :] - p1[0]
+        ys = np.arange(h, dtype=np.float32)[:, np.newaxis] - p1[1]
+        dist = np.hypot(xs, ys) / np.linalg.norm(p2 - p1)
+        return _lerp_colors(dist, self.c1, self.c2)
 
 class RadialGradient(Gradient):
     def __init__(self, c1: Color, c2: Color, center: Position, radius: float):
@@ -182,27 +368,129 @@ class RadialGradient(Gradient):
         self.center = center
         self.radius = radius
 
-    def get_colors(self, size: Size) -> np.ndarray:
+    def get_cache_key(self) -> str:
+        return f"radial_{self.c1}_{self.c2}_{self.center}_{self.radius}"
+
+    def _calc_colors(self, size: Size, scale: float) -> np.ndarray:
         w, h = size
-        center = np.array(self.center) * np.array((w, h))
-        y_indices, x_indices = np.meshgrid(np.arange(h), np.arange(w), indexing='ij')
-        coords = np.stack((x_indices, y_indices), axis=-1)
-        dist = np.linalg.norm(coords - center, axis=-1) / self.radius
-        dist = np.clip(dist, 0, 1)
-        colors = dist[:, :, np.newaxis] * np.array(self.c1) + (1 - dist)[:, :, np.newaxis] * np.array(self.c2)
-        return colors.astype(np.uint8)
+        center = np.array(self.center, dtype=np.float32) * np.array((w, h))
+        xs = np.arange(w, dtype=np.float32)[np.newaxis, :] - center[0]
+        ys = np.arange(h, dtype=np.float32)[:, np.newaxis] - center[1]
+        # 半径为目标分辨率下的像素数，降采样生成时按比例缩小
+        dist = np.hypot(xs, ys) / (self.radius * scale)
+        return _lerp_colors(dist, self.c1, self.c2)
+
+# 按距离在两个颜色间插值，dist为[H, W]，返回[H, W, 4]
+def _lerp_colors(dist: np.ndarray, c1: Color, c2: Color) -> np.ndarray:
+    dist = np.clip(dist, 0, 1)[:, :, np.newaxis]
+    c1 = np.array(c1, dtype=np.float32)
+    c2 = np.array(c2, dtype=np.float32)
+    return (c2 + dist * (c1 - c2)).astype(np.uint8)
     
         
 
+# 绘制指令列表，所有坐标为画布上的绝对坐标，图像按key引用，可以被pickle后在其他进程中光栅化
+@dataclass
+class DisplayList:
+    size: Size
+    # (指令名, 参数, 影响范围的上边界y, 下边界y)
+    ops: List[Tuple[str, tuple, int, int]]
+    images: Dict[str, Image.Image]
+    # 光栅化的纵向范围 [y0, y1)，None为整个画布
+    band: Optional[Tuple[int, int]] = None
+
+    def add_image(self, img: Image.Image) -> str:
+        key = str(id(img))
+        self.images[key] = img
+        return key
+
+    def _clip_image_op(self, op: Tuple[str, tuple, int, int], y0: int, y1: int) -> Optional[Tuple[tuple, str, Image.Image]]:
+        # 将图像指令裁剪到画布宽度和 [y0, y1) 内，图像只保留(缩放后)可见的部分，返回 (新指令, 新key, 新图像)
+        name, args, _, _ = op
+        key, pos = args[0], args[1]
+        img = self.images[key]
+        size = (args[2] if name != 'composite' else None) or img.size
+        cx0, cx1 = max(pos[0], 0), min(pos[0] + size[0], self.size[0])
+        cy0, cy1 = max(pos[1], y0), min(pos[1] + size[1], y1)
+        if cx1 <= cx0 or cy1 <= cy0:
+            return None
+        if (cx0, cy0, cx1, cy1) == (pos[0], pos[1], pos[0] + size[0], pos[1] + size[1]):
+            return op, key, img
+        sx, sy = img.size[0] / size[0], img.size[1] / size[1]
+        box = ((cx0 - pos[0]) * sx, (cy0 - pos[1]) * sy, (cx1 - pos[0]) * sx, (cy1 - pos[1]) * sy)
+        if size == img.size:
+            part = img.crop(tuple(int(v) for v in box))
+        else:
+            part = img.resize((cx1 - cx0, cy1 - cy0), box=box)
+        new_key = f"{key}_{cx0}_{cy0}"
+        new_args = (new_key, (cx0, cy0)) + ((None,) if name != 'composite' else ()) + args[3:]
+        return (name, new_args, cy0, cy1), new_key, part
+
+    def iter_bands(self, band_num: int) -> Iterator[DisplayList]:
+        """
+        按水平条带切分，每个条带只包含影响该条带的指令，图像裁剪到条带内可见的部分，逐个生成以限制同时存在的图像
+        """
+        w, h = self.size
+        band_h = max(1, math.ceil(h / band_num))
+        for y0 in range(0, h, band_h):
+            y1 = min(h, y0 + band_h)
+            ops, images = [], {}
+            for op in self.ops:
+                if op[3] <= y0 or op[2] >= y1:
+                    continue
+                if op[0] in _IMAGE_OPS:
+                    clipped = self._clip_image_op(op, y0, y1)
+                    if clipped is None:
+                        continue
+                    op, key, img = clipped
+                    images[key] = img
+                ops.append(op)
+            yield DisplayList(self.size, ops, images, (y0, y1))
+
+    def split_bands(self, band_num: int) -> List[DisplayList]:
+        return list(self.iter_bands(band_num))
+
+_IMAGE_OPS = ('paste', 'paste_with_alphablend', 'composite')
+
+# 光栅化绘制指令列表，返回band范围内的图像
+def rasterize_display_list(dl: DisplayList) -> Image.Image:
+    y0, y1 = dl.band or (0, dl.size[1])
+    p = Painter(Image.new('RGBA', (dl.size[0], y1 - y0), TRANSPARENT))
+    p.offset = (0, -y0)
+    for name, args, _, _ in dl.ops:
+        if name == 'text':
+            text, pos, font_path, font_size, fill, align = args
+            p.text(text, pos, get_font(font_path, font_size), fill, align)
+        elif name in _IMAGE_OPS:
+            getattr(p, name)(dl.images[args[0]], *args[1:])
+        else:
+            getattr(p, name)(*args)
+    return p.get()
+
+
 class Painter:
-    def __init__(self, img: Image.Image):
+    def __init__(self, img: Image.Image = None, size: Size = None):
+        """
+        img为None时为录制模式，绘制操作不执行，而是以绝对坐标记录到 `display_list` 中
+        """
         self.img = img
+        self.display_list = None
+        if img is None:
+            self.display_list = DisplayList(size, [], {})
+        self.full_size = img.size if img is not None else size
         self.offset = (0, 0)
-        self.size = img.size
-        self.w = img.size[0]
-        self.h = img.size[1]
+        self.size = self.full_size
+        self.w = self.full_size[0]
+        self.h = self.full_size[1]
         self.region_stack = []
 
+    def _record(self, name: str, args: tuple, y0: int, y1: int):
+        self.display_list.ops.append((name, args, int(y0), int(math.ceil(y1))))
+        return self
+
+    def _abs_pos(self, pos: Position) -> Position:
+        return (pos[0] + self.offset[0], pos[1] + self.offset[1])
+
     def set_region(self, pos: Position, size: Size):
         assert isinstance(pos[0], int) and isinstance(pos[1], int), "Position must be integer"
         assert isinstance(size[0], int) and isinstance(size[1], int), "Size must be integer"
@@ -233,9 +521,9 @@ class Painter:
     def restore_region(self, depth=1):
         if not self.region_stack:
             self.offset = (0, 0)
-            self.size = self.img.size
-            self.w = self.img.size[0]
-            self.h = self.img.size[1]
+            self.size = self.full_size
+            self.w = self.full_size[0]
+            self.h = self.full_size[1]
         else:
             self.offset, self.size = self.region_stack.pop()
             self.w = self.size[0]
@@ -247,6 +535,17 @@ class Painter:
     def get(self) -> Image.Image:
         return self.img
 
+    def _paste_gradient(self, overlay: Image.Image, gradient: Gradient, box: Tuple[int, int, int, int], size: Size):
+        # 只生成与图像相交部分的渐变，box为绝对坐标的 (x0, y0, x1, y1)，包含右下边界
+        x0, y0 = max(box[0], 0), max(box[1], 0)
+        x1, y1 = min(box[2] + 1, overlay.size[0]), min(box[3] + 1, overlay.size[1])
+        if x1 <= x0 or y1 <= y0:
+            return
+        mask = overlay.crop((x0, y0, x1, y1))
+        region = (x0 - box[0], y0 - box[1], x1 - box[0], y1 - box[1])
+        gradient_img = gradient.get_img((size[0] + 1, size[1] + 1), mask, region)
+        overlay.paste(gradient_img, (x0, y0), gradient_img)
+
     def text(
         self, 
         text: str, 
@@ -255,26 +554,41 @@ class Painter:
         fill: Color = BLACK,
         align: str = "left"
     ):
+        if self.display_list is not None:
+            pos = self._abs_pos(pos)
+            return self._record('text', (text, pos, font.path, font.size, fill, align), pos[1] - font.size, pos[1] + font.size * (text.count('\n') + 3))
         std_size = get_text_size(font, "哇")
-        has_emoji = emoji.emoji_count(text) > 0
-        if not has_emoji:
+        text_offset = (0, -std_size[1])
+        pos = (pos[0] - text_offset[0] + self.offset[0], pos[1] - text_offset[1] + self.offset[1])
+        runs = get_text_runs(text)
+        if not has_emoji_run(runs):
             draw = ImageDraw.Draw(self.img)
-            text_offset = (0, -std_size[1])
-            pos = (pos[0] - text_offset[0] + self.offset[0], pos[1] - text_offset[1] + self.offset[1])
             draw.text(pos, text, font=font, fill=fill, align=align, anchor='ls')
         else:
-            with Pilmoji(self.img, source=GoogleEmojiSource) as pilmoji:
-                text_offset = (0, -std_size[1])
-                pos = (pos[0] - text_offset[0] + self.offset[0], pos[1] - text_offset[1] + self.offset[1])
-                pilmoji.text(pos, text, font=font, fill=fill, align=align, emoji_position_offset=(0, -std_size[1]), anchor='ls')
+            draw_mixed_text(self.img, runs, pos, font, fill, std_size[1])
         return self
         
+    def composite(self, sub_img: Image.Image, pos: Position):
+        # 按alpha混合合成RGBA图像，只处理覆盖的区域
+        if self.display_list is not None:
+            pos = self._abs_pos(pos)
+            return self._record('composite', (self.display_list.add_image(sub_img), pos), pos[1], pos[1] + sub_img.size[1])
+        pos = (pos[0] + self.offset[0], pos[1] + self.offset[1])
+        box = (pos[0], pos[1], pos[0] + sub_img.size[0], pos[1] + sub_img.size[1])
+        region = Image.alpha_composite(self.img.crop(box), sub_img)
+        self.img.paste(region, box)
+        return self
+
     def paste(
         self, 
         sub_img: Image.Image,
         pos: Position, 
         size: Size = None
     ) -> Image.Image:
+        if self.display_list is not None:
+            pos = self._abs_pos(pos)
+            h = size[1] if size else sub_img.size[1]
+            return self._record('paste', (self.display_list.add_image(sub_img), pos, size), pos[1], pos[1] + h)
         if size and size != sub_img.size:
             sub_img = sub_img.resize(size)
         if sub_img.mode == 'RGBA':
@@ -290,6 +604,10 @@ class Painter:
         size: Size = None,
         alpha: float = None
     ) -> Image.Image:
+        if self.display_list is not None:
+            pos = self._abs_pos(pos)
+            h = size[1] if size else sub_img.size[1]
+            return self._record('paste_with_alphablend', (self.display_list.add_image(sub_img), pos, size, alpha), pos[1], pos[1] + h)
         if size and size != sub_img.size:
             sub_img = sub_img.resize(size)
         pos = (pos[0] + self.offset[0], pos[1] + self.offset[1])
@@ -310,6 +628,9 @@ class Painter:
         stroke: Color=None, 
         stroke_width: int=1,
     ):
+        if self.display_list is not None:
+            pos = self._abs_pos(pos)
+            return self._record('rect', (pos, size, fill, stroke, stroke_width), pos[1] - stroke_width, pos[1] + size[1] + stroke_width + 1)
         if isinstance(fill, Gradient):
             gradient = fill
             fill = BLACK
@@ -333,9 +654,7 @@ class Painter:
                 draw.rectangle(pos, fill=fill)
 
             if gradient:
-                mask = overlay.crop((pos[0], pos[1], pos[2] + 1, pos[3] + 1))
-                gradient_img = gradient.get_img((size[0] + 1, size[1] + 1), mask)
-                overlay.paste(gradient_img, pos[:2], gradient_img)
+                self._paste_gradient(overlay, gradient, pos, size)
 
             self.img = Image.alpha_composite(self.img, overlay)
 
@@ -351,6 +670,9 @@ class Painter:
         stroke_width: int=1,
         corners = (True, True, True, True),
     ):
+        if self.display_list is not None:
+            pos = self._abs_pos(pos)
+            return self._record('roundrect', (pos, size, fill, radius, stroke, stroke_width, corners), pos[1] - stroke_width, pos[1] + size[1] + stroke_width + 1)
         if isinstance(fill, Gradient):
             gradient = fill
             fill = BLACK
@@ -375,9 +697,7 @@ class Painter:
                 draw.rounded_rectangle(pos, fill=fill, radius=radius, corners=corners)
 
             if gradient:
-                mask = overlay.crop((pos[0], pos[1], pos[2] + 1, pos[3] + 1))
-                gradient_img = gradient.get_img((size[0] + 1, size[1] + 1), mask)
-                overlay.paste(gradient_img, pos[:2], gradient_img)
+                self._paste_gradient(overlay, gradient, pos, size)
 
             self.img = Image.alpha_composite(self.img, overlay)
         
@@ -393,6 +713,9 @@ class Painter:
         stroke: Color=None,
         stroke_width: int=1,
     ):
+        if self.display_list is not None:
+            pos = self._abs_pos(pos)
+            return self._record('pieslice', (pos, size, start_angle, end_angle, fill, stroke, stroke_width), pos[1] - stroke_width, pos[1] + size[1] + stroke_width + 1)
         if isinstance(fill, Gradient):
             gradient = fill
             fill = BLACK
@@ -418,14 +741,102 @@ class Painter:
                 draw.pieslice(pos, start_angle, end_angle, fill=fill)
 
             if gradient:
-                mask = overlay.crop((pos[0], pos[1], pos[2] + 1, pos[3] + 1))
-                gradient_img = gradient.get_img((size[0] + 1, size[1] + 1), mask)
-                overlay.paste(gradient_img, pos[:2], gradient_img)
+                self._paste_gradient(overlay, gradient, pos, size)
 
             self.img = Image.alpha_composite(self.img, overlay)
         
         return self
 
+# =========================== 光栅缓存 =========================== #
+
+RASTER_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+@dataclass
+class RasterCacheStats:
+    hits: int = 0
+    misses: int = 0
+
+class RasterCache:
+    """
+    控件子树渲染结果(RGBA图像)的LRU缓存，按图像占用的字节数限制总大小
+    key的格式为 "前缀:内容"，按前缀统计命中情况
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.tiles: OrderedDict[str, Image.Image] = OrderedDict()
+        self.total_bytes = 0
+        self.stats: Dict[str, RasterCacheStats] = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _get_tile_bytes(tile: Image.Image) -> int:
+        return tile.size[0] * tile.size[1] * len(tile.getbands())
+
+    def peek(self, key: str) -> Optional[Image.Image]:
+        # 不计入统计和LRU顺序，用于测量阶段获取尺寸
+        return self.tiles.get(key)
+
+    def get(self, key: str) -> Optional[Image.Image]:
+        with self.lock:
+            stats = self.stats.setdefault(key.split(':', 1)[0], RasterCacheStats())
+            tile = self.tiles.get(key)
+            if tile is None:
+                stats.misses += 1
+                return None
+            stats.hits += 1
+            self.tiles.move_to_end(key)
+            return tile
+
+    def set(self, key: str, tile: Image.Image):
+        size = self._get_tile_bytes(tile)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.tiles:
+                self.total_bytes -= self._get_tile_bytes(self.tiles.pop(key))
+            self.tiles[key] = tile
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, old = self.tiles.popitem(last=False)
+                self.total_bytes -= self._get_tile_bytes(old)
+
+    def clear(self):
+        with self.lock:
+            self.tiles.clear()
+            self.total_bytes = 0
+
+raster_cache = RasterCache(RASTER_CACHE_MAX_BYTES)
+
+BG_CACHE_MAX_BYTES = 128 * 1024 * 1024
+# 背景生成的最大分辨率(长边)，超过时降采样生成后再放大，渐变和模糊背景放大后的损失可以忽略
+BG_GEN_MAX_SIDE = 512
+
+# 渐变和图片背景的缓存，key前缀为 gradient / image_bg
+bg_cache = RasterCache(BG_CACHE_MAX_BYTES)
+
+# 图片对象的缓存标识，保存弱引用以确认id没有被其他对象复用
+_bg_src_ids: Dict[int, Tuple[weakref.ref, int]] = {}
+_bg_src_next_id = 0
+_bg_src_lock = threading.Lock()
+
+def _remove_bg_src_id(ref: weakref.ref):
+    for k, item in list(_bg_src_ids.items()):
+        if item[0] is ref:
+            _bg_src_ids.pop(k, None)
+
+def _get_bg_src_key(img: Union[str, Image.Image]) -> str:
+    global _bg_src_next_id
+    if isinstance(img, str):
+        return f"path_{img}_{os.path.getmtime(img)}"
+    with _bg_src_lock:
+        item = _bg_src_ids.get(id(img))
+        if item is None or item[0]() is not img:
+            _bg_src_next_id += 1
+            item = (weakref.ref(img, _remove_bg_src_id), _bg_src_next_id)
+            _bg_src_ids[id(img)] = item
+        return f"img_{item[1]}"
+
+
 # =========================== 布局类型 =========================== #
 
 DEFAULT_PADDING = 0
@@ -458,25 +869,67 @@ class RoundRectBg(WidgetBg):
         p.roundrect((0, 0), p.size, self.fill, self.radius, self.stroke, self.stroke_width, self.corners)
 
 class ImageBg(WidgetBg):
+    BLUR_RADIUS = 3
+
     def __init__(self, img: Union[str, Image.Image], align: str='c', mode='fit', blur=True, fade=0.1):
+        src_key = _get_bg_src_key(img)
         if isinstance(img, str):
-            self.img = Image.open(img)
-        else:
-            self.img = img
+            img = Image.open(img)
         assert align in ALIGN_MAP
         self.align = align
         assert mode in ('fit', 'fill', 'fixed', 'repeat')
         self.mode = mode
-        if blur:
-            self.img = self.img.filter(ImageFilter.GaussianBlur(radius=3))
-        if fade > 0:
-            self.img = ImageEnhance.Brightness(self.img).enhance(1 - fade)
+        self.blur = blur
+        self.fade = fade
+        self.src_img = img
+        self.key = f"image_bg:{src_key}_{blur}_{fade}"
+        self._img = None
+
+    @property
+    def img(self) -> Image.Image:
+        # 原尺寸的处理结果，只有固定、平铺模式和放大时需要，首次使用时生成，在相同的图片和参数间共享
+        if self._img is None:
+            self._img = bg_cache.get(self.key)
+            if self._img is None:
+                self._img = self._process(self.src_img, 1.0)
+                bg_cache.set(self.key, self._img)
+        return self._img
+
+    def _process(self, img: Image.Image, scale: float) -> Image.Image:
+        if self.blur:
+            img = img.filter(ImageFilter.GaussianBlur(radius=self.BLUR_RADIUS * scale))
+        if self.fade > 0:
+            img = ImageEnhance.Brightness(img).enhance(1 - self.fade)
+        return img
+
+    def _get_fit_img(self, size: Size, region: Tuple[int, int, int, int] = None) -> Image.Image:
+        # 缩放到目标尺寸的结果，region不为None时只生成其中 (x0, y0, x1, y1) 的可见部分
+        # 缩小时先缩放再以目标尺寸模糊，只处理可见部分及模糊半径范围内的边缘
+        region = region or (0, 0, size[0], size[1])
+        key = f"{self.key}_{size[0]}x{size[1]}_{region}"
+        img = bg_cache.get(key)
+        if img is None:
+            scale = size[0] / self.src_img.size[0]
+            sx, sy = self.src_img.size[0] / size[0], self.src_img.size[1] / size[1]
+            if scale < 1.0:
+                pad = int(self.BLUR_RADIUS * scale * 3) + 1 if self.blur else 0
+                x0, y0 = max(0, region[0] - pad), max(0, region[1] - pad)
+                x1, y1 = min(size[0], region[2] + pad), min(size[1], region[3] + pad)
+                resample = Image.Resampling.BILINEAR if scale < 0.5 else Image.Resampling.BICUBIC
+                img = self.src_img.resize((x1 - x0, y1 - y0), resample, box=(x0 * sx, y0 * sy, x1 * sx, y1 * sy))
+                img = self._process(img, scale)
+                img = img.crop((region[0] - x0, region[1] - y0, region[2] - x0, region[3] - y0))
+            else:
+                box = (region[0] * sx, region[1] * sy, region[2] * sx, region[3] * sy)
+                img = self.img.resize((region[2] - region[0], region[3] - region[1]), box=box)
+            bg_cache.set(key, img)
+        return img
 
     def draw(self, p: Painter):
         if self.mode == 'fit':
             ha, va = ALIGN_MAP[self.align]
-            scale = max(p.w / self.img.size[0], p.h / self.img.size[1])
-            w, h = int(self.img.size[0] * scale), int(self.img.size[1] * scale)
+            scale = max(p.w / self.src_img.size[0], p.h / self.src_img.size[1])
+            w, h = int(self.src_img.size[0] * scale), int(self.src_img.size[1] * scale)
             if va == 'c':
                 y = (p.h - h) // 2
             elif va == 't':
@@ -489,9 +942,13 @@ class ImageBg(WidgetBg):
                 x = 0
             else:
                 x = p.w - w
-            p.paste(self.img, (x, y), (w, h))
+            # 覆盖模式下缩放后的图像大于区域，只生成区域内可见的部分
+            x0, y0 = max(0, -x), max(0, -y)
+            x1, y1 = min(w, p.w - x), min(h, p.h - y)
+            if x1 > x0 and y1 > y0:
+                p.paste(self._get_fit_img((w, h), (x0, y0, x1, y1)), (x + x0, y + y0))
         if self.mode == 'fill':
-            p.paste(self.img, (0, 0), p.size)
+            p.paste(self._get_fit_img(p.size), (0, 0))
         if self.mode == 'fixed':
             ha, va = ALIGN_MAP[self.align]
             if va == 'c':
@@ -514,10 +971,18 @@ class ImageBg(WidgetBg):
                     p.paste(self.img, (x, y))
 
 
+# 布局测量统计，记录当前线程中控件内容尺寸的实际计算次数
+_layout_local = threading.local()
+
+def get_layout_measure_count() -> int:
+    return getattr(_layout_local, 'measure_count', 0)
+
 class Widget:
     _thread_local = contextvars.ContextVar('local', default=None)
 
     def __init__(self):
+        # 布局缓存，保存测量得到的尺寸、换行结果等，任何set_*调用都会使自身及所有祖先的缓存失效
+        self._layout_cache = {}
         self.parent: Optional[Widget] = None
 
         self.content_halign = 'l'
@@ -533,10 +998,8 @@ class Widget:
         self.offset = (0, 0)
         self.offset_xanchor = 'l'
         self.offset_yanchor = 't'
+        self.cache_key = None
 
-        self._calc_w = None
-        self._calc_h = None
-        
         self.draw_funcs = []
 
         if Widget.get_current_widget():
@@ -579,6 +1042,25 @@ class Widget:
     def add_item(self, item: Widget):
         raise NotImplementedError()
 
+    def _invalidate_layout(self):
+        w = self
+        while w is not None:
+            w._layout_cache.clear()
+            w = w.parent
+
+    def _get_layout_cached(self, key: str, func):
+        cache = self._layout_cache
+        if key not in cache:
+            cache[key] = func()
+        return cache[key]
+
+    def _measure_content(self):
+        _layout_local.measure_count = get_layout_measure_count() + 1
+        return self._get_content_size()
+
+    def _get_cached_content_size(self):
+        return self._get_layout_cached('content_size', self._measure_content)
+
     def set_parent(self, parent: Widget):
         self.parent = parent
         return self
@@ -587,6 +1069,7 @@ class Widget:
         if align not in ALIGN_MAP:
             raise ValueError('Invalid align')
         self.content_halign, self.content_valign = ALIGN_MAP[align]
+        self._invalidate_layout()
         return self
 
     def set_margin(self, margin: Union[int, Tuple[int, int]]):
@@ -596,6 +1079,7 @@ class Widget:
         else:
             self.hmargin = margin[0]
             self.vmargin = margin[1]
+        self._invalidate_layout()
         return self
 
     def set_padding(self, padding: Union[int, Tuple[int, int]]):
@@ -605,59 +1089,81 @@ class Widget:
         else:
             self.hpadding = padding[0]
             self.vpadding = padding[1]
+        self._invalidate_layout()
         return self
 
     def set_size(self, size: Tuple[int, int]):
         if not size: size = (None, None)
         self.w = size[0]
         self.h = size[1]
+        self._invalidate_layout()
         return self
 
     def set_w(self, w: int):
         self.w = w
+        self._invalidate_layout()
         return self
     
     def set_h(self, h: int):
         self.h = h
+        self._invalidate_layout()
         return self
 
     def set_offset(self, offset: Tuple[int, int]):
         self.offset = offset
+        self._invalidate_layout()
         return self
     
     def set_offset_anchor(self, anchor: str):
         if anchor not in ALIGN_MAP:
             raise ValueError('Invalid anchor')
         self.offset_xanchor, self.offset_yanchor = ALIGN_MAP[anchor]
+        self._invalidate_layout()
         return self
 
     def set_bg(self, bg: WidgetBg):
         self.bg = bg
+        self._invalidate_layout()
         return self
 
     def set_omit_parent_bg(self, omit: bool):
         self.omit_parent_bg = omit
+        self._invalidate_layout()
+        return self
+
+    def set_cache_key(self, key: Optional[str]):
+        """
+        设置后该控件子树的渲染结果按key缓存，之后相同key的控件直接使用缓存的图像，跳过子树的测量与绘制。
+        key需要能唯一确定子树的内容，格式为 "前缀:内容"
+        """
+        self.cache_key = key
+        self._invalidate_layout()
         return self
 
     def _get_content_size(self):
         return (0, 0)
     
+    def _calc_self_size(self):
+        if self.cache_key is not None and (tile := raster_cache.peek(self.cache_key)) is not None:
+            return tile.size
+        content_w, content_h = self._get_cached_content_size()
+        content_w_limit = self.w - self.hpadding * 2 if self.w is not None else content_w
+        content_h_limit = self.h - self.vpadding * 2 if self.h is not None else content_h
+        if content_w > content_w_limit or content_h > content_h_limit:
+            raise ValueError(f'Content size is too large with ({content_w}, {content_h}) > ({content_w_limit}, {content_h_limit})')
+        return (
+            int(content_w_limit + self.hmargin * 2 + self.hpadding * 2), 
+            int(content_h_limit + self.vmargin * 2 + self.vpadding * 2),
+        )
+
     def _get_self_size(self):
-        if not all([self._calc_w, self._calc_h]):
-            content_w, content_h = self._get_content_size()
-            content_w_limit = self.w - self.hpadding * 2 if self.w is not None else content_w
-            content_h_limit = self.h - self.vpadding * 2 if self.h is not None else content_h
-            if content_w > content_w_limit or content_h > content_h_limit:
-                raise ValueError(f'Content size is too large with ({content_w}, {content_h}) > ({content_w_limit}, {content_h_limit})')
-            self._calc_w = content_w_limit + self.hmargin * 2 + self.hpadding * 2
-            self._calc_h = content_h_limit + self.vmargin * 2 + self.vpadding * 2
-        return (int(self._calc_w), int(self._calc_h))
+        return self._get_layout_cached('self_size', self._calc_self_size)
 
     def _get_content_pos(self):
         w, h = self._get_self_size()
         w -= self.hpadding * 2 + self.hmargin * 2
         h -= self.vpadding * 2 + self.vmargin * 2
-        cw, ch = self._get_content_size()
+        cw, ch = self._get_cached_content_size()
         if self.content_halign == 'l':
             cx = 0
         elif self.content_halign == 'r':
@@ -680,7 +1186,7 @@ class Widget:
             font = get_font(DEFAULT_FONT, 16)
             s = f"{self.__class__.__name__}({p.w},{p.h})"
             s += f"self={self._get_self_size()}"
-            s += f"content={self._get_content_size()}"
+            s += f"content={self._get_cached_content_size()}"
             p.text(s, (3, 3), font=font, fill=color)
             print(f"Draw {self.__class__.__name__} at {p.offset} size={p.size}")
         
@@ -701,9 +1207,7 @@ class Widget:
         self.draw_funcs.clear()
         return self
     
-    def draw(self, p: Painter):
-        assert p.size == self._get_self_size()
-
+    def _get_offset_pos(self, p: Painter) -> Position:
         if self.offset_xanchor == 'l': 
             offset_x = self.offset[0]
         elif self.offset_xanchor == 'r':
@@ -716,8 +1220,24 @@ class Widget:
             offset_y = self.offset[1] - p.h
         else:
             offset_y = self.offset[1] - p.h // 2
+        return (offset_x, offset_y)
 
-        p.move_region((offset_x, offset_y))
+    def draw(self, p: Painter):
+        assert p.size == self._get_self_size()
+        offset = self._get_offset_pos(p)
+        if self.cache_key is None:
+            return self._draw_at(p, offset)
+        # 子树绘制到透明图像上缓存，再合成到目标位置
+        tile = raster_cache.get(self.cache_key)
+        if tile is None or tile.size != p.size:
+            tp = Painter(Image.new('RGBA', p.size, TRANSPARENT))
+            self._draw_at(tp, (0, 0))
+            tile = tp.get()
+            raster_cache.set(self.cache_key, tile)
+        p.composite(tile, offset)
+
+    def _draw_at(self, p: Painter, offset: Position):
+        p.move_region(offset)
         p.shrink_region((self.hmargin, self.vmargin))
         self._draw_self(p)
 
@@ -740,6 +1260,7 @@ class Frame(Widget):
     def add_item(self, item: Widget):
         item.set_parent(self)
         self.items.append(item)
+        self._invalidate_layout()
         return self
     
     def set_items(self, items: List[Widget]):
@@ -748,6 +1269,7 @@ class Frame(Widget):
         self.items = items
         for item in self.items:
             item.set_parent(self)
+        self._invalidate_layout()
         return self
 
     def _get_content_size(self):
@@ -758,7 +1280,7 @@ class Frame(Widget):
         return size
     
     def _draw_content(self, p: Painter):
-        cw, ch = self._get_content_size()
+        cw, ch = self._get_cached_content_size()
         for item in self.items:
             w, h = item._get_self_size()
             x, y = 0, 0
@@ -800,37 +1322,47 @@ class HSplit(Widget):
         self.items = items
         for item in self.items:
             item.set_parent(self)
+        self._invalidate_layout()
         return self
     
     def add_item(self, item: Widget):
         item.set_parent(self)
         self.items.append(item)
+        self._invalidate_layout()
         return self
 
     def set_item_align(self, align: str):
         if align not in ALIGN_MAP:
             raise ValueError('Invalid align')
         self.item_halign, self.item_valign = ALIGN_MAP[align]
+        self._invalidate_layout()
         return self
 
     def set_sep(self, sep: int):
         self.sep = sep  
+        self._invalidate_layout()
         return self
 
     def set_ratios(self, ratios: List[float]):
         self.ratios = ratios
+        self._invalidate_layout()
         return self
 
     def set_item_size_mode(self, mode: str):
         assert mode in ('expand', 'fixed')
         self.item_size_mode = mode
+        self._invalidate_layout()
         return self
 
     def set_item_bg(self, bg: WidgetBg):
         self.item_bg = bg
+        self._invalidate_layout()
         return self
 
     def _get_item_sizes(self):
+        return self._get_layout_cached('item_sizes', self._calc_item_sizes)
+
+    def _calc_item_sizes(self):
         ratios = self.ratios if self.ratios else [item._get_self_size()[0] for item in self.items]
         if self.item_size_mode == 'expand':
             assert self.w is not None, 'Expand mode requires width'
@@ -903,37 +1435,47 @@ class VSplit(Widget):
         self.items = items
         for item in self.items:
             item.set_parent(self)
+        self._invalidate_layout()
         return self
         
     def add_item(self, item: Widget):
         item.set_parent(self)
         self.items.append(item)
+        self._invalidate_layout()
         return self
 
     def set_item_align(self, align: str):
         if align not in ALIGN_MAP:
             raise ValueError('Invalid align')
         self.item_halign, self.item_valign = ALIGN_MAP[align]
+        self._invalidate_layout()
         return self
     
     def set_sep(self, sep: int):
         self.sep = sep  
+        self._invalidate_layout()
         return self
 
     def set_ratios(self, ratios: List[float]):
         self.ratios = ratios
+        self._invalidate_layout()
         return self
 
     def set_item_size_mode(self, mode: str):
         assert mode in ('expand', 'fixed')
         self.item_size_mode = mode
+        self._invalidate_layout()
         return self
 
     def set_item_bg(self, bg: WidgetBg):
         self.item_bg = bg
+        self._invalidate_layout()
         return self
 
     def _get_item_sizes(self):
+        return self._get_layout_cached('item_sizes', self._calc_item_sizes)
+
+    def _calc_item_sizes(self):
         ratios = self.ratios if self.ratios else [item._get_self_size()[1] for item in self.items]
         if self.item_size_mode == 'expand':
             assert self.h is not None, 'Expand mode requires height'
@@ -1006,6 +1548,7 @@ class Grid(Widget):
 
     def set_vertical(self, vertical: bool):
         self.vertical = vertical
+        self._invalidate_layout()
         return self
 
     def set_items(self, items: List[Widget]):
@@ -1014,17 +1557,20 @@ class Grid(Widget):
         self.items = items
         for item in self.items:
             item.set_parent(self)
+        self._invalidate_layout()
         return self
         
     def add_item(self, item: Widget):
         item.set_parent(self)
         self.items.append(item)
+        self._invalidate_layout()
         return self
     
     def set_item_align(self, align: str):
         if align not in ALIGN_MAP:
             raise ValueError('Invalid align')
         self.item_halign, self.item_valign = ALIGN_MAP[align]
+        self._invalidate_layout()
         return self
 
     def set_sep(self, hsep=None, vsep=None):
@@ -1032,28 +1578,36 @@ class Grid(Widget):
             self.hsep = hsep
         if vsep is not None:
             self.vsep = vsep
+        self._invalidate_layout()
         return self
 
     def set_row_count(self, count: int):
         self.row_count = count
         self.col_count = None
+        self._invalidate_layout()
         return self
 
     def set_col_count(self, count: int):
         self.col_count = count
         self.row_count = None
+        self._invalidate_layout()
         return self
 
     def set_item_size_mode(self, mode: str):
         assert mode in ('expand', 'fixed')
         self.item_size_mode = mode
+        self._invalidate_layout()
         return self
 
     def set_item_bg(self, bg: WidgetBg):
         self.item_bg = bg
+        self._invalidate_layout()
         return self
 
     def _get_grid_rc_and_size(self):
+        return self._get_layout_cached('grid_rc_and_size', self._calc_grid_rc_and_size)
+
+    def _calc_grid_rc_and_size(self):
         r, c = self.row_count, self.col_count
         assert r and not c or c and not r, 'Either row_count or col_count should be None'
         if not r: r = (len(self.items) + c - 1) // c
@@ -1135,27 +1689,34 @@ class TextBox(Widget):
 
     def set_text(self, text: str):
         self.text = text
+        self._invalidate_layout()
         return self
 
     def set_style(self, style: TextStyle):
         self.style = style
+        self._invalidate_layout()
         return self
    
     def set_line_count(self, count: int):
         self.line_count = count
+        self._invalidate_layout()
         return self
     
     def set_line_sep(self, sep: int):
         self.line_sep = sep
+        self._invalidate_layout()
         return self
 
     def set_wrap(self, wrap: bool):
         self.wrap = wrap
+        self._invalidate_layout()
         return self
 
     def set_overflow(self, overflow: str):
         assert overflow in ('shrink', 'clip')
         self.overflow = overflow
+        self._invalidate_layout()
+        return self
 
     def _get_pil_font(self):
         return get_font(self.style.font, self.style.size)
@@ -1165,16 +1726,20 @@ class TextBox(Widget):
         w, _ = get_text_size(font, text + suffix)
         if w <= width:
             return None
-        l, r = 0, len(text)
-        while l <= r:
-            m = (l + r) // 2
-            w, _ = get_text_size(font, text[:m] + suffix)
-            if   w < width: l = m + 1
-            elif w > width: r = m - 1
-            else: return m
-        return r
+        # 用字符前进宽度的前缀和估计截断位置，再用实际宽度修正估计误差
+        prefix = get_text_advance_prefix_sums(font, text)
+        suffix_w = sum(get_char_advance(font, ch) for ch in suffix)
+        m = max(0, bisect_right(prefix, width - suffix_w) - 1)
+        while m > 0 and get_text_size(font, text[:m] + suffix)[0] > width:
+            m -= 1
+        while m < len(text) and get_text_size(font, text[:m + 1] + suffix)[0] <= width:
+            m += 1
+        return m
 
     def _get_lines(self):
+        return self._get_layout_cached('lines', self._calc_lines)
+
+    def _calc_lines(self):
         lines = self.text.split('\n')  
         clipped_lines = []
         for line in lines:
@@ -1271,10 +1836,12 @@ class ImageBox(Widget):
 
     def set_alpha_adjust(self, alpha_adjust: float):
         self.alpha_adjust = alpha_adjust
+        self._invalidate_layout()
         return self
 
     def set_use_alphablend(self, use_alphablend):
         self.use_alphablend = use_alphablend
+        self._invalidate_layout()
         return self
 
     def set_image(self, image: Union[str, Image.Image]):
@@ -1282,11 +1849,13 @@ class ImageBox(Widget):
             self.image = Image.open(image)
         else:
             self.image = image
+        self._invalidate_layout()
         return self
 
     def set_image_size_mode(self, mode: str):
         assert mode in ('fit', 'fill', 'original')
         self.image_size_mode = mode
+        self._invalidate_layout()
         return self
 
     def _get_content_size(self):
@@ -1310,7 +1879,7 @@ class ImageBox(Widget):
                 return (int(w * scale), int(h * scale))
     
     def _draw_content(self, p: Painter):
-        w, h = self._get_content_size()
+        w, h = self._get_cached_content_size()
         if self.use_alphablend:
             p.paste_with_alphablend(self.image, (0, 0), (w, h), self.alpha_adjust)
         else:
@@ -1337,16 +1906,35 @@ class Canvas(Frame):
         self.set_margin(0)
 
     def get_img(self, scale: float = None) -> Image.Image:
-        size = self._get_self_size()
+        # 先完成测量，绘制时只读取缓存的布局结果，measure_count记录本次每个控件的实际测量次数之和
+        measure_count = get_layout_measure_count()
+        with profile_span('layout'):
+            size = self._get_self_size()
         assert size[0] * size[1] < 4096 * 4096, f'Canvas size is too large ({size[0]} x {size[1]})'
-        img = Image.new('RGBA', size, TRANSPARENT)
-        p = Painter(img)
-        self.draw(p)
-        img = p.get()
-        if scale:
-            img = img.resize((int(size[0] * scale), int(size[1] * scale)), Image.Resampling.BILINEAR)
+        with profile_span('raster'):
+            img = Image.new('RGBA', size, TRANSPARENT)
+            p = Painter(img)
+            self.draw(p)
+            img = p.get()
+            if scale:
+                img = img.resize((int(size[0] * scale), int(size[1] * scale)), Image.Resampling.BILINEAR)
+        self.measure_count = get_layout_measure_count() - measure_count
         return img
 
+    def get_display_list(self, max_pixels: int = None) -> DisplayList:
+        """
+        测量并录制绘制指令，不进行光栅化，结果可交给 `rasterize_display_list` 在其他进程中按条带光栅化
+        录制不分配画布内存，按条带输出时可以通过 `max_pixels` 放宽尺寸限制
+        """
+        with profile_span('layout'):
+            size = self._get_self_size()
+        max_pixels = max_pixels or 4096 * 4096
+        assert size[0] * size[1] < max_pixels, f'Canvas size is too large ({size[0]} x {size[1]})'
+        with profile_span('record'):
+            p = Painter(size=size)
+            self.draw(p)
+        return p.display_list
+
 
 # =========================== 控件函数 =========================== #
 
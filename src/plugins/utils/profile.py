@@ -0,0 +1,144 @@
+from typing import Dict, List, Optional, Tuple
+from collections import deque
+from contextlib import contextmanager
+import contextvars
+import threading
+import time
+import os
+import orjson
+
+
+# =========================== 指令耗时分析 =========================== #
+
+class CmdProfile:
+    """
+    单次指令处理的耗时记录，span为 (阶段名, 开始时间, 结束时间, 线程名)，时间为perf_counter秒
+    """
+    def __init__(self, cmd: str, index: int, start: float = None):
+        self.cmd = cmd
+        self.index = index
+        self.start = start if start is not None else time.perf_counter()
+        self.end = None
+        self.spans: List[Tuple[str, float, float, str]] = []
+        self.error = False
+
+    def add_span(self, name: str, start: float, end: float):
+        self.spans.append((name, start, end, threading.current_thread().name))
+
+    def get_stage_times(self) -> Dict[str, float]:
+        # 同名阶段的耗时累加，total为指令总耗时
+        ret = { 'total': (self.end or time.perf_counter()) - self.start }
+        for name, start, end, _ in self.spans:
+            ret[name] = ret.get(name, 0.) + end - start
+        return ret
+
+
+_current_profile: contextvars.ContextVar[Optional[CmdProfile]] = contextvars.ContextVar('cmd_profile', default=None)
+
+# 获取当前上下文的指令耗时记录
+def get_current_profile() -> Optional[CmdProfile]:
+    return _current_profile.get()
+
+# 记录一个阶段的耗时，不在指令处理上下文中时不做任何事
+@contextmanager
+def profile_span(name: str):
+    profile = _current_profile.get()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add_span(name, start, time.perf_counter())
+
+# 计算已排序样本的分位数
+def get_percentile(sorted_samples: List[float], q: float) -> float:
+    if not sorted_samples:
+        return 0.
+    return sorted_samples[min(len(sorted_samples) - 1, int(len(sorted_samples) * q))]
+
+
+class CmdProfiler:
+    """
+    聚合指令耗时记录，每个指令每个阶段保留最近 `sample_num` 个样本用于计算分位数，
+    同时保留最近 `trace_num` 次完整记录用于导出Chrome trace
+    """
+    def __init__(self, sample_num: int = 512, trace_num: int = 256):
+        self.sample_num = sample_num
+        self.samples: Dict[str, Dict[str, deque]] = {}
+        self.counts: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self.traces: deque = deque(maxlen=trace_num)
+        self.next_index = 0
+
+    def begin(self, cmd: str, start: float = None) -> Tuple[CmdProfile, contextvars.Token]:
+        self.next_index += 1
+        profile = CmdProfile(cmd, self.next_index, start)
+        return profile, _current_profile.set(profile)
+
+    def end(self, profile: CmdProfile, token: contextvars.Token, error: bool = False):
+        _current_profile.reset(token)
+        profile.end = time.perf_counter()
+        profile.error = error
+        cmd_samples = self.samples.setdefault(profile.cmd, {})
+        for stage, t in profile.get_stage_times().items():
+            if stage not in cmd_samples:
+                cmd_samples[stage] = deque(maxlen=self.sample_num)
+            cmd_samples[stage].append(t)
+        self.counts[profile.cmd] = self.counts.get(profile.cmd, 0) + 1
+        if error:
+            self.errors[profile.cmd] = self.errors.get(profile.cmd, 0) + 1
+        self.traces.append(profile)
+
+    def get_stage_percentiles(self, cmd: str) -> Dict[str, Dict[str, float]]:
+        ret = {}
+        for stage, samples in self.samples.get(cmd, {}).items():
+            s = sorted(samples)
+            ret[stage] = {
+                'n': len(s),
+                'sum': sum(s),
+                'p50': get_percentile(s, 0.5),
+                'p95': get_percentile(s, 0.95),
+                'p99': get_percentile(s, 0.99),
+            }
+        return ret
+
+    def get_hottest(self, limit: int = 10) -> List[Tuple[str, Dict[str, Dict[str, float]]]]:
+        """
+        按样本窗口内的总耗时排序获取最热的指令
+        """
+        ret = [(cmd, self.get_stage_percentiles(cmd)) for cmd in self.samples]
+        ret.sort(key=lambda x: -x[1]['total']['sum'])
+        return ret[:limit]
+
+    def export_chrome_trace(self, path: str) -> int:
+        """
+        导出保留的原始记录为Chrome trace格式(chrome://tracing 或 Perfetto)，每次指令处理占一个tid，返回导出的记录数
+        """
+        traces = list(self.traces)
+        base = min((p.start for p in traces), default=0.)
+        us = lambda t: round((t - base) * 1e6, 1)
+        events = []
+        for p in traces:
+            events.append({ 'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': p.index, 'args': { 'name': f'{p.cmd} #{p.index}' } })
+            end = p.end or time.perf_counter()
+            events.append({
+                'name': p.cmd, 'cat': 'cmd', 'ph': 'X', 'pid': 1, 'tid': p.index,
+                'ts': us(p.start), 'dur': us(end) - us(p.start), 'args': { 'error': p.error },
+            })
+            for name, start, end, thread in p.spans:
+                events.append({
+                    'name': name, 'cat': 'stage', 'ph': 'X', 'pid': 1, 'tid': p.index,
+                    'ts': us(start), 'dur': us(end) - us(start), 'args': { 'thread': thread },
+                })
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps({ 'traceEvents': events, 'displayTimeUnit': 'ms' }))
+        return len(traces)
+
+    def clear(self):
+        self.samples.clear()
+        self.counts.clear()
+        self.errors.clear()
+        self.traces.clear()